@@ -1,5 +1,15 @@
+import secrets
+import smtplib
+import threading
+import time
+from datetime import timedelta
+
 from flask import current_app
 from flask_mail import Message
+from markupsafe import Markup
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
+from werkzeug.security import generate_password_hash
 from main import mail, db
 
 STATUS_LABELS = {
@@ -16,9 +26,181 @@ def _is_mail_configured():
     return bool(org and org.mail_server and org.mail_username)
 
 
-def send_ticket_notification(event, ticket, **kwargs):
+class WarmSMTPConnection:
+    """
+    A Flask-Mail connection kept open between sends.
+
+    The outbox dispatcher pushes every message through one SMTP session
+    instead of a TLS handshake and login per ``mail.send()``. The session is
+    reused for the next batch while it has been idle for less than
+    SMTP_IDLE_TIMEOUT seconds, and reopened once if the server has dropped
+    it in the meantime. ``handshakes`` / ``messages`` count connections
+    opened and messages sent by this process.
     """
-    Send email notifications for ticket events.
+
+    def __init__(self):
+        self._connection = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+        self.handshakes = 0
+        self.messages = 0
+
+    def _open(self):
+        connection = mail.connect()
+        connection.__enter__()
+        self._connection = connection
+        self.handshakes += 1
+
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass  # already dropped by the server
+            self._connection = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def close_if_idle(self):
+        with self._lock:
+            if time.monotonic() - self._last_used > current_app.config['SMTP_IDLE_TIMEOUT']:
+                self._close()
+
+    def send(self, msg):
+        with self._lock:
+            if time.monotonic() - self._last_used > current_app.config['SMTP_IDLE_TIMEOUT']:
+                self._close()
+            if self._connection is None:
+                self._open()
+            try:
+                try:
+                    self._connection.send(msg)
+                except smtplib.SMTPServerDisconnected:
+                    self._close()
+                    self._open()
+                    self._connection.send(msg)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+                raise  # the server rejected this message; the session is still usable
+            except Exception:
+                self._close()
+                raise
+            finally:
+                self._last_used = time.monotonic()
+            self.messages += 1
+
+
+smtp_connection = WarmSMTPConnection()
+
+
+# Choices offered on the profile page for User.email_digest_minutes
+DIGEST_CHOICES = [
+    (0, 'Send each update right away'),
+    (15, 'One summary every 15 minutes'),
+    (60, 'One summary every hour'),
+]
+
+
+@listens_for(Session, 'after_commit')
+@listens_for(Session, 'after_rollback')
+def _forget_queued_notifications(session):
+    session.info.pop('email_outbox', None)
+
+
+def _digest_release_at(user):
+    """When the digest that a new notification for ``user`` joins will be sent."""
+    from application.models import EmailOutbox, _utcnow
+    now = _utcnow()
+    open_digest = db.session.query(db.func.max(EmailOutbox.next_attempt_at)).filter(
+        EmailOutbox.recipient_id == user.id,
+        EmailOutbox.digest.is_(True),
+        EmailOutbox.status == 'pending',
+        EmailOutbox.attempts == 0,
+        EmailOutbox.claim_token.is_(None),
+        EmailOutbox.next_attempt_at > now,
+    ).scalar()
+    return open_digest or now + timedelta(minutes=user.email_digest_minutes)
+
+
+def _ticket_context(ticket):
+    """The ticket details every recipient of an event sees, computed once per event."""
+    return {
+        'id': ticket.id,
+        'title': ticket.title.title_name,
+        'status': STATUS_LABELS.get(ticket.tck_status, ticket.tck_status),
+        'creator': ticket.user.get_full_name() if ticket.user else '',
+    }
+
+
+def _render_event(event, ticket_context, **context):
+    """
+    Render one ticket event in text and HTML. Returns (subject, text, html)
+    where text/html are the template modules: str() gives the event section
+    and ``.header`` the ticket header.
+
+    Flask's Jinja environment compiles each template once and caches it,
+    so this costs one render per event however many recipients there are.
+    """
+    env = current_app.jinja_env
+    context.update(event=event, ticket=ticket_context)
+    text = env.get_template('email/ticket_event.txt').make_module(context)
+    html = env.get_template('email/ticket_event.html').make_module(context)
+    return str(text.subject).strip(), text, html
+
+
+def _fill(row, rendered):
+    """Set an outbox row's subject and text/HTML bodies from a rendered event."""
+    subject, text, html = rendered
+    row.subject = subject
+    row.body = f"{str(text.header).strip()}\n\n{str(text).strip()}"
+    row.body_html = f"{str(html.header).strip()}\n{str(html).strip()}"
+
+
+def _queue(ticket, user, event, rendered):
+    """
+    Add one rendered notification for ``user`` to the current session (the caller commits).
+
+    Events for the same recipient and ticket within one transaction are
+    coalesced into a single outbox row, re-rendered as one 'update' event
+    from their sections, so a ticket save that changes the status,
+    reassigns and comments sends one email. Rows for users with a
+    digest window are held until the window closes. The address is copied
+    still encrypted and the greeting is added at send time, so the row is
+    the only per-recipient work.
+    """
+    from application.models import EmailOutbox
+    _, text, html = rendered
+    queued = db.session.info.setdefault('email_outbox', {})
+    section = (str(text).strip(), Markup(str(html).strip()))
+    if (user.id, ticket.id) in queued:
+        row, sections = queued[(user.id, ticket.id)]
+        sections.append(section)
+        row.event = 'update'
+        _fill(row, _render_event('update', _ticket_context(ticket), sections=sections))
+        return
+
+    row = EmailOutbox(
+        event=event,
+        ticket_id=ticket.id,
+        recipient_id=user.id,
+        recipient_enc=user.email_enc,  # same key as recipient_email, so no decrypt/re-encrypt
+    )
+    _fill(row, rendered)
+    if user.email_digest_minutes:
+        row.digest = True
+        row.next_attempt_at = _digest_release_at(user)
+    db.session.add(row)
+    queued[(user.id, ticket.id)] = row, [section]
+
+
+def queue_ticket_notification(event, ticket, **kwargs):
+    """
+    Queue email notifications for ticket events in the email outbox.
+
+    The rows join the caller's transaction, so they are committed together
+    with the ticket change (or not at all); the outbox dispatcher sends them.
+    Content lives in templates/email/ticket_event.{txt,html}.
 
     Events:
         'created'   - ticket was just created (notifies assignee)
@@ -29,119 +211,223 @@ def send_ticket_notification(event, ticket, **kwargs):
     """
     if not _is_mail_configured():
         return
-    try:
-        recipients = []
-        subject = ''
-        body = ''
-
-        creator = ticket.user
-        assignee = ticket.assigned_to
-        ticket_label = f"Ticket #{ticket.id} – {ticket.title.title_name}"
-
-        if event == 'created':
-            if assignee and assignee.email:
-                recipients = [assignee.email]
-                subject = f"New Ticket Assigned to You: #{ticket.id}"
-                initial_comment = kwargs.get('initial_comment', '').strip()
-                comment_section = f"\nDescription:\n{initial_comment}\n" if initial_comment else ''
-                body = (
-                    f"Hi {assignee.first_name},\n\n"
-                    f"A new ticket has been assigned to you.\n\n"
-                    f"Ticket: {ticket_label}\n"
-                    f"Status: {STATUS_LABELS.get(ticket.tck_status, ticket.tck_status)}\n"
-                    f"Submitted by: {creator.get_full_name()}\n"
-                    f"{comment_section}\n"
-                    f"Please log in to the system to view and respond to this ticket.\n\n"
-                    f"— AssistITK12 System"
-                )
 
-        elif event == 'status':
-            old_label = STATUS_LABELS.get(kwargs.get('old_status', ''), kwargs.get('old_status', ''))
-            new_label = STATUS_LABELS.get(kwargs.get('new_status', ''), kwargs.get('new_status', ''))
-            if creator and creator.email:
-                recipients = [creator.email]
-                subject = f"Your Ticket #{ticket.id} Status Changed"
-                body = (
-                    f"Hi {creator.first_name},\n\n"
-                    f"The status of your ticket has been updated.\n\n"
-                    f"Ticket: {ticket_label}\n"
-                    f"Status: {old_label} → {new_label}\n\n"
-                    f"Please log in to view the details.\n\n"
-                    f"— AssistITK12 System"
-                )
+    creator = ticket.user
+    assignee = ticket.assigned_to
 
-        elif event == 'assigned':
-            new_assignee = kwargs.get('new_assignee')
-            if new_assignee and new_assignee.email:
-                recipients = [new_assignee.email]
-                subject = f"Ticket #{ticket.id} Assigned to You"
-                body = (
-                    f"Hi {new_assignee.first_name},\n\n"
-                    f"A ticket has been assigned to you.\n\n"
-                    f"Ticket: {ticket_label}\n"
-                    f"Status: {STATUS_LABELS.get(ticket.tck_status, ticket.tck_status)}\n"
-                    f"Submitted by: {creator.get_full_name()}\n\n"
-                    f"Please log in to view and respond.\n\n"
-                    f"— AssistITK12 System"
-                )
+    if event == 'created':
+        recipients = [assignee]
+        context = {'initial_comment': kwargs.get('initial_comment', '').strip()}
+    elif event == 'status':
+        recipients = [creator]
+        context = {
+            'old_status': STATUS_LABELS.get(kwargs.get('old_status', ''), kwargs.get('old_status', '')),
+            'new_status': STATUS_LABELS.get(kwargs.get('new_status', ''), kwargs.get('new_status', '')),
+        }
+    elif event == 'assigned':
+        recipients = [kwargs.get('new_assignee')]
+        context = {}
+    elif event == 'escalated':
+        recipients = [creator, assignee]
+        context = {'escalated': bool(kwargs.get('escalated'))}
+    elif event == 'comment':
+        # Notify both creator and assignee, but never the commenter themselves
+        commenter = kwargs.get('commenter')
+        recipients = [u for u in (creator, assignee) if u and (not commenter or commenter.id != u.id)]
+        context = {
+            'commenter': commenter.get_full_name() if commenter else 'Someone',
+            'comment_text': kwargs.get('comment_text', '').strip(),
+        }
+    else:
+        return
 
-        elif event == 'escalated':
-            is_escalated = bool(kwargs.get('escalated', False))
-            action = 'escalated' if is_escalated else 'de-escalated'
-            emails = []
-            if creator and creator.email:
-                emails.append(creator.email)
-            if assignee and assignee.email and assignee.email not in emails:
-                emails.append(assignee.email)
-            recipients = emails
-            subject = f"Ticket #{ticket.id} Has Been {action.title()}"
-            body = (
-                f"This is a notification that Ticket #{ticket.id} has been {action}.\n\n"
-                f"Ticket: {ticket_label}\n"
-                f"Status: {STATUS_LABELS.get(ticket.tck_status, ticket.tck_status)}\n\n"
-                f"Please log in to review.\n\n"
-                f"— AssistITK12 System"
-            )
+    recipients = {u.id: u for u in recipients if u and u.email_enc}
+    if not recipients:
+        return
+    rendered = _render_event(event, _ticket_context(ticket), **context)
+    for user in recipients.values():
+        _queue(ticket, user, event, rendered)
 
-        elif event == 'comment':
-            commenter = kwargs.get('commenter')
-            commenter_name = commenter.get_full_name() if commenter else 'Someone'
-            comment_text = kwargs.get('comment_text', '').strip()
-            comment_section = f"\nComment:\n{comment_text}\n" if comment_text else ''
-            subject = f"New Comment on Ticket #{ticket.id}"
-
-            # Notify both creator and assignee, but never the commenter themselves
-            notify = {}
-            if creator and creator.email and (not commenter or commenter.id != creator.id):
-                notify[creator.email] = creator.first_name
-            if assignee and assignee.email and assignee.email not in notify \
-                    and (not commenter or commenter.id != assignee.id):
-                notify[assignee.email] = assignee.first_name
-
-            for email, first_name in notify.items():
-                msg = Message(
-                    subject=subject,
-                    recipients=[email],
-                    body=(
-                        f"Hi {first_name},\n\n"
-                        f"{commenter_name} added a comment to Ticket #{ticket.id}.\n\n"
-                        f"Ticket: {ticket_label}\n"
-                        f"{comment_section}\n"
-                        f"Please log in to view and reply.\n\n"
-                        f"— AssistITK12 System"
-                    )
-                )
-                mail.send(msg)
-                current_app.logger.info(f"Comment notification sent to {email}")
-            return  # individual emails already sent above
 
-        if recipients and subject and body:
-            msg = Message(subject=subject, recipients=recipients, body=body)
-            mail.send(msg)
-            current_app.logger.info(f"Ticket notification '{event}' sent to {recipients}")
+def _outbox_message(rows):
+    """Build one email, with text and HTML parts, from outbox rows that share a recipient."""
+    env = current_app.jinja_env
+    first = rows[0]
+    context = {'rows': rows, 'recipient_name': first.recipient.first_name if first.recipient else ''}
+    text = env.get_template('email/notification.txt').make_module(context)
+    msg = Message(subject=str(text.subject).strip(), recipients=[first.recipient_email], body=str(text).strip())
+    if all(row.body_html for row in rows):
+        msg.html = env.get_template('email/notification.html').render(context)
+    return msg
 
-    except Exception as e:
-        current_app.logger.error(f"Failed to send ticket notification (event={event}): {type(e).__name__}: {e}", exc_info=True)
+
+def _claim_due(model, limit):
+    """
+    Claim up to ``limit`` due pending rows of ``model`` for this worker.
+
+    A single UPDATE stamps a claim token and pushes next_attempt_at out by
+    EMAIL_OUTBOX_CLAIM_SECONDS, so two workers never take the same row and
+    a crashed worker's rows become due again. Returns the claimed rows.
+    """
+    from application.models import _utcnow
+    now = _utcnow()
+    due = [row_id for row_id, in model.query.with_entities(model.id).filter(
+        model.status == 'pending', model.next_attempt_at <= now
+    ).order_by(model.next_attempt_at, model.id).limit(limit)]
+    if not due:
+        return []
+
+    token = secrets.token_hex(16)
+    model.query.filter(
+        model.id.in_(due), model.status == 'pending', model.next_attempt_at <= now
+    ).update({
+        'claim_token': token,
+        'next_attempt_at': now + timedelta(seconds=current_app.config['EMAIL_OUTBOX_CLAIM_SECONDS']),
+    }, synchronize_session=False)
+    db.session.commit()
+    return model.query.filter_by(claim_token=token).order_by(model.id).all()
+
+
+def _record_failure(row, label, error):
+    """Schedule a retry with exponential backoff, or mark ``row`` dead after EMAIL_OUTBOX_MAX_ATTEMPTS."""
+    from application.models import _utcnow
+    config = current_app.config
+    row.last_error = f"{type(error).__name__}: {error}"
+    if row.attempts >= config['EMAIL_OUTBOX_MAX_ATTEMPTS']:
+        row.status = 'dead'
+        current_app.logger.error(f"{label} failed permanently: {row.last_error}")
+    else:
+        delay = config['EMAIL_OUTBOX_RETRY_BASE'] * 2 ** (row.attempts - 1)
+        row.next_attempt_at = _utcnow() + timedelta(seconds=delay)
+        current_app.logger.warning(f"{label} failed, retrying in {delay}s: {row.last_error}")
+
+
+def dispatch_email_outbox(limit=None):
+    """
+    Send due outbox rows. Returns (sent, failed) counted in emails.
+
+    Rows are claimed with ``_claim_due``, so two dispatchers never send the
+    same row. Due digest rows for the same recipient go out as one summary
+    email. A failed send is retried with exponential backoff
+    (EMAIL_OUTBOX_RETRY_BASE * 2^n seconds) until EMAIL_OUTBOX_MAX_ATTEMPTS,
+    after which the row is marked 'dead'. All messages go through the shared
+    ``smtp_connection``.
+    """
+    from application.models import EmailOutbox, _utcnow
+    if not _is_mail_configured():
+        return 0, 0
+
+    claimed = _claim_due(EmailOutbox, limit or current_app.config['EMAIL_OUTBOX_BATCH_SIZE'])
+    if not claimed:
+        smtp_connection.close_if_idle()
+        return 0, 0
+
+    emails = {}
+    for row in claimed:
+        key = ('digest', row.recipient_id) if row.digest and row.recipient_id else ('row', row.id)
+        emails.setdefault(key, []).append(row)
+
+    sent = failed = 0
+    handshakes = smtp_connection.handshakes
+    for rows in emails.values():
+        for row in rows:
+            row.attempts += 1
+            row.claim_token = None
+        try:
+            smtp_connection.send(_outbox_message(rows))
+        except Exception as e:
+            failed += 1
+            for row in rows:
+                _record_failure(row, f"Email outbox #{row.id} ({row.event})", e)
+        else:
+            sent += 1
+            for row in rows:
+                row.status = 'sent'
+                row.sent_at = _utcnow()
+        db.session.commit()  # per email, so a crash mid-batch never re-sends what already went out
+    current_app.logger.info(
+        f"Email outbox batch: {sent + failed} messages, "
+        f"{smtp_connection.handshakes - handshakes} new SMTP connection(s)"
+    )
+    return sent, failed
+
+
+def purge_sent_email_outbox():
+    """Delete sent outbox rows older than EMAIL_OUTBOX_RETENTION_DAYS. Returns the number removed."""
+    from application.models import EmailOutbox, _utcnow
+    cutoff = _utcnow() - timedelta(days=current_app.config['EMAIL_OUTBOX_RETENTION_DAYS'])
+    removed = EmailOutbox.query.filter(
+        EmailOutbox.status == 'sent', EmailOutbox.sent_at < cutoff
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return removed
+
+
+def queue_onboarding_emails(log):
+    """
+    Queue a welcome email for every user created by ``log``'s import who is
+    still active and has not set a password yet (caller commits).
+    Users who were already queued are skipped. Returns the number queued.
+    """
+    from application.models import OnboardingEmail, User
+    already_queued = db.session.query(OnboardingEmail.id).filter(OnboardingEmail.user_id == User.id).exists()
+    user_ids = [user_id for user_id, in db.session.query(User.id).filter(
+        User.import_log_id == log.id,
+        User.status == 'Active',
+        User.must_change_password.is_(True),
+        ~already_queued,
+    ).order_by(User.id)]
+    db.session.add_all(OnboardingEmail(import_log_id=log.id, user_id=user_id) for user_id in user_ids)
+    return len(user_ids)
+
+
+def send_onboarding_emails(limit=None):
+    """
+    Send up to ONBOARDING_EMAILS_PER_MINUTE queued welcome emails. Returns (sent, failed).
+
+    The scheduler runs this once a minute, which keeps a large import under
+    the mail provider's sending quota. Each email carries a fresh temporary
+    password that is set on the user in the same commit that marks the row
+    sent, so an interrupted run resumes with the next unsent row. Users who
+    have set their own password or been deactivated since are skipped.
+    """
+    from application.models import OnboardingEmail, _utcnow
+    if not _is_mail_configured():
+        return 0, 0
+
+    sent = failed = 0
+    for row in _claim_due(OnboardingEmail, limit or current_app.config['ONBOARDING_EMAILS_PER_MINUTE']):
+        row.attempts += 1
+        row.claim_token = None
+        user = row.user
+        if user.status != 'Active' or not user.must_change_password:
+            row.status = 'skipped'
+            db.session.commit()
+            continue
+        temp_password = secrets.token_urlsafe(12)
+        try:
+            smtp_connection.send(Message(
+                subject="Welcome to AssistITK12 — Your Account Is Ready",
+                recipients=[user.email],
+                body=(
+                    f"Hi {user.first_name},\n\n"
+                    f"An account has been created for you. Use the details below to log in.\n\n"
+                    f"Email: {user.email}\n"
+                    f"Temporary Password: {temp_password}\n\n"
+                    f"You will be required to change your password immediately after logging in.\n\n"
+                    f"— AssistITK12 System"
+                )
+            ))
+        except Exception as e:
+            failed += 1
+            _record_failure(row, f"Onboarding email #{row.id}", e)
+        else:
+            sent += 1
+            user.password = generate_password_hash(temp_password)
+            row.status = 'sent'
+            row.sent_at = _utcnow()
+        db.session.commit()
+    return sent, failed
 
 
 def send_temp_password_email(user, temp_password):
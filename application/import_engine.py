@@ -0,0 +1,710 @@
+"""
+Roster import engine shared by the CSV upload, manual FTP and scheduled FTP paths.
+
+Every import runs in two phases:
+
+* ``plan_sites`` / ``plan_users`` validate the CSV rows and diff them against
+  the database using batched prefetch queries. They never write, so they can
+  run inside ``read_only_transaction()`` for a dry-run preview.
+* ``apply_site_plan`` / ``apply_user_plan`` write a previously computed plan
+  with a native upsert keyed on ``site.site_name`` / ``user.email_hash`` —
+  one INSERT ... ON DUPLICATE KEY UPDATE (MySQL) or ON CONFLICT DO UPDATE
+  (SQLite, PostgreSQL) statement per batch. Other databases look the keys
+  up first and then insert or update.
+
+Plans are row deltas: an existing row is only listed as updated when one of
+its imported columns differs from the database, so re-importing the same
+nightly roster issues no UPDATEs and the logged counts reflect real changes.
+
+``import_users_chunked`` is the optional alternative for very large rosters:
+it plans and applies users.csv a chunk of rows at a time, committing and
+checkpointing after each one so a failed run can be resumed.
+
+Plans are plain picklable objects, so a preview can be cached (keyed by the
+file hash) and applied later without re-parsing or re-diffing the file.
+"""
+import csv
+import ftplib
+import functools
+import hashlib
+import io
+import posixpath
+import secrets
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import bindparam, or_, select, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from werkzeug.security import generate_password_hash
+
+from main import db, cache
+from application.models import User, Site, Role, BulkUploadLog, _utcnow
+from application.utils import hash_email, encrypt_mail_password
+
+SITE_REQUIRED = ['site_name', 'site_acronyms', 'site_cds', 'site_code', 'site_address', 'site_type']
+USER_REQUIRED = ['first_name', 'last_name', 'email', 'role_id', 'site_name', 'rm_num']
+
+# Columns an import writes, in fingerprint order
+SITE_FIELDS = ['site_acronyms', 'site_cds', 'site_code', 'site_address', 'site_type']
+USER_FIELDS = ['first_name', 'middle_name', 'last_name', 'rm_num', 'role_id', 'site_name', 'status']
+
+# Values per IN (...) clause in prefetch/update queries — keeps every statement
+# well under SQLite's bound-parameter limit and MySQL's max_allowed_packet.
+BATCH_SIZE = 500
+
+# How long a dry-run preview stays available to be applied (seconds)
+PREVIEW_TIMEOUT = 30 * 60
+
+# Cap on the invalid-row messages kept in a plan (the file is rejected anyway)
+MAX_INVALID_ROWS = 200
+
+
+@dataclass
+class SitePlan:
+    """Change set computed from a sites.csv file."""
+    total: int = 0
+    added: list = field(default_factory=list)      # field dicts for new sites
+    updated: list = field(default_factory=list)    # (site_id, field dict) — changed rows only
+    invalid: list = field(default_factory=list)    # row error messages
+    unchanged: int = 0                             # existing sites already up to date
+
+    @property
+    def new_site_names(self):
+        return {fields['site_name'] for fields in self.added}
+
+
+@dataclass
+class UserPlan:
+    """Change set computed from a users.csv file."""
+    total: int = 0
+    added: list = field(default_factory=list)        # field dicts for new users
+    updated: list = field(default_factory=list)      # (user_id, field dict) — changed rows only
+    deactivated: list = field(default_factory=list)  # ids of Active users absent from the file
+    invalid: list = field(default_factory=list)      # row error messages
+    unchanged: int = 0                               # existing users already up to date
+
+
+@dataclass
+class ImportPreview:
+    """A cached dry run: the plans plus the log labels to use when it is applied."""
+    digest: str
+    source: str                 # 'upload' or 'ftp'
+    created_by_id: int = None
+    sites: SitePlan = None
+    users: UserPlan = None
+    sites_label: str = ''
+    users_label: str = ''
+
+    @property
+    def is_valid(self):
+        return not any(plan.invalid for plan in (self.sites, self.users) if plan)
+
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+
+def _chunks(values, size=BATCH_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _prefetch(query, column, values):
+    """Run ``query`` filtered by ``column IN values``, one batch at a time."""
+    results = []
+    for chunk in _chunks(values):
+        results.extend(query.filter(column.in_(chunk)).all())
+    return results
+
+
+def _fingerprint(values, names):
+    """
+    Comparable snapshot of the imported columns of one row. Blank and NULL
+    compare equal, since the CSV cannot tell them apart.
+    """
+    return tuple(values[name] if values[name] not in ('', None) else None for name in names)
+
+
+_UPSERT_INSERTS = {'mysql': mysql.insert, 'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def _upsert(model, rows, key, columns, defaults=None):
+    """
+    Insert ``rows`` into ``model``'s table; where ``key`` already exists,
+    update only ``columns`` instead. One statement per batch on the
+    databases in _UPSERT_INSERTS; elsewhere the batch's keys are looked up
+    first and the rows inserted or updated accordingly.
+
+    ``defaults`` maps columns some rows leave out to a function making the
+    value used if such a row is inserted. It is only called when a batch
+    needs it: for the native upsert, whenever such a row is in the batch.
+    """
+    table = model.__table__
+    dialect = db.session.get_bind().dialect.name
+    defaults = defaults or {}
+    for chunk in _chunks(rows):
+        if dialect in _UPSERT_INSERTS:
+            stmt = _UPSERT_INSERTS[dialect](table).values(_fill(chunk, defaults))
+            if dialect == 'mysql':
+                stmt = stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in columns})
+            else:
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[table.c[key]], set_={c: stmt.excluded[c] for c in columns}
+                )
+            db.session.execute(stmt)
+            continue
+
+        existing = set(db.session.scalars(select(table.c[key]).where(table.c[key].in_([r[key] for r in chunk]))))
+        updates = [row for row in chunk if row[key] in existing]
+        inserts = [row for row in chunk if row[key] not in existing]
+        if updates:
+            db.session.execute(
+                table.update().where(table.c[key] == bindparam('match_key'))
+                .values({c: bindparam(f'new_{c}') for c in columns}),
+                [{'match_key': row[key], **{f'new_{c}': row[c] for c in columns}} for row in updates]
+            )
+        if inserts:
+            db.session.execute(table.insert(), _fill(inserts, defaults))
+
+
+def _fill(rows, defaults):
+    """``rows`` with the columns in ``defaults`` filled in where missing."""
+    if not any(column not in row for row in rows for column in defaults):
+        return rows
+    values = {column: make() for column, make in defaults.items()}
+    return [{**values, **row} for row in rows]
+
+
+@functools.lru_cache(maxsize=1)
+def _unused_password_hash():
+    """
+    Password for a changed user that has to be inserted after all (deleted
+    since planning); nobody knows it. Computed on first use: a full password
+    hash is too slow to run on every import.
+    """
+    return generate_password_hash(secrets.token_urlsafe(16))
+
+
+def _raise_if_invalid(plan):
+    if plan.invalid:
+        raise ValueError(plan.invalid[0])
+
+
+def _add_invalid(plan, message):
+    if len(plan.invalid) < MAX_INVALID_ROWS:
+        plan.invalid.append(message)
+
+
+def _normalize_cds(raw):
+    """Convert Excel scientific-notation CDS codes (e.g. '1.23457E+13') to integer strings."""
+    raw = raw.strip()
+    try:
+        return str(int(float(raw)))
+    except (ValueError, OverflowError):
+        return raw
+
+
+def file_digest(*parts):
+    """SHA-256 over one or more byte strings — the cache key for an import preview."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def parse_csv(data):
+    """Decode raw CSV bytes (UTF-8) into a list of row dicts."""
+    return list(csv.DictReader(data.decode('utf-8').splitlines()))
+
+
+@contextmanager
+def read_only_transaction():
+    """
+    Run the enclosed queries in a transaction the database itself refuses to
+    write in, then roll it back. Used for dry-run previews so a bug in the
+    planning code can never modify data.
+    """
+    db.session.rollback()  # transaction characteristics can only be set before it starts
+    connection = db.session.connection()
+    dialect = connection.dialect.name
+    if dialect in ('mysql', 'mariadb', 'postgresql'):
+        connection.exec_driver_sql('SET TRANSACTION READ ONLY')
+    elif dialect == 'sqlite':
+        connection.exec_driver_sql('PRAGMA query_only = ON')
+    try:
+        yield
+    finally:
+        if dialect == 'sqlite':
+            # query_only is per connection, not per transaction. Reset it on the
+            # raw DBAPI connection, which works even if the session's
+            # transaction failed, before the connection goes back to the pool.
+            connection.connection.driver_connection.execute('PRAGMA query_only = OFF')
+        db.session.rollback()
+
+
+# ---------------------------------------------------------------------------
+# Sites
+# ---------------------------------------------------------------------------
+
+def plan_sites(rows):
+    """Validate sites.csv rows and diff them against the ``site`` table."""
+    plan = SitePlan(total=len(rows))
+
+    for i, row in enumerate(rows, start=2):
+        missing = [f for f in SITE_REQUIRED if not (row.get(f) or '').strip()]
+        if missing:
+            _add_invalid(plan, f'Row {i} is missing required fields: {", ".join(missing)}')
+    if plan.invalid:
+        return plan
+
+    names = {row['site_name'].strip() for row in rows}
+    columns = [Site.site_name, Site.id] + [getattr(Site, name) for name in SITE_FIELDS]
+    existing = {
+        row.site_name: (row.id, _fingerprint(row._mapping, SITE_FIELDS))
+        for row in _prefetch(Site.query.with_entities(*columns), Site.site_name, names)
+    }
+
+    pending = {}
+    changed = {}
+    for row in rows:
+        name = row['site_name'].strip()
+        fields = {
+            'site_acronyms': row['site_acronyms'].strip(),
+            'site_cds':      _normalize_cds(row['site_cds']),
+            'site_code':     row['site_code'].strip(),
+            'site_address':  row['site_address'].strip(),
+            'site_type':     row['site_type'].strip(),
+        }
+        if name in existing:
+            changed[name] = {'site_name': name, **fields}  # the later row wins here too
+        elif name in pending:
+            pending[name].update(fields)  # name repeated in the CSV — the later row wins
+        else:
+            pending[name] = {'site_name': name, **fields}
+            plan.added.append(pending[name])
+
+    for name, fields in changed.items():
+        site_id, current = existing[name]
+        if _fingerprint(fields, SITE_FIELDS) == current:
+            plan.unchanged += 1
+        else:
+            plan.updated.append((site_id, fields))
+    return plan
+
+
+def apply_site_plan(plan):
+    """
+    Write a SitePlan (caller commits). Returns (added, updated).
+
+    The counts come from the plan: unchanged sites are never sent, and a
+    site created since planning is simply updated by the upsert.
+    """
+    _raise_if_invalid(plan)
+    _upsert(Site, plan.added + [fields for _, fields in plan.updated], 'site_name', SITE_FIELDS)
+    return len(plan.added), len(plan.updated)
+
+
+# ---------------------------------------------------------------------------
+# Users
+# ---------------------------------------------------------------------------
+
+def _user_row_error(row, valid_role_ids, known_sites):
+    missing = [f for f in USER_REQUIRED if not (row.get(f) or '').strip()]
+    if missing:
+        return f'missing required fields: {", ".join(missing)}'
+    try:
+        role_id = int(row['role_id'])
+    except ValueError:
+        return f"role_id {row['role_id']!r} is not a number"
+    if role_id not in valid_role_ids:
+        return f"'{row['email'].strip()}' has invalid role_id {role_id!r}"
+    if row['site_name'].strip() not in known_sites:
+        return f"site '{row['site_name'].strip()}' not found"
+    return None
+
+
+def _scan_user_rows(plan, rows, key, pending_site_names=(), first_row=2):
+    """
+    Validate rows into ``plan.invalid``. Returns (valid rows keyed by email
+    hash, hashes of every email in the rows).
+    """
+    valid_role_ids = {r.id for r in Role.query.with_entities(Role.id).all()}
+    names = {(row.get('site_name') or '').strip() for row in rows} - {''}
+    known_sites = {name for name, in _prefetch(Site.query.with_entities(Site.site_name), Site.site_name, names)}
+    known_sites |= set(pending_site_names)
+
+    # Hashes of every email in the file, valid or not — a row that merely
+    # fails validation must not make its user look absent from the file.
+    seen_hashes = set()
+    rows_by_hash = {}
+    for i, row in enumerate(rows, start=first_row):
+        email = (row.get('email') or '').strip()
+        email_hash = hash_email(email, key) if email else None
+        if email_hash:
+            seen_hashes.add(email_hash)
+        error = _user_row_error(row, valid_role_ids, known_sites)
+        if error:
+            _add_invalid(plan, f'Row {i}: {error}')
+        else:
+            rows_by_hash[email_hash] = row  # email repeated in the CSV — the later row wins
+    return rows_by_hash, seen_hashes
+
+
+def _absent_user_ids(seen_hashes):
+    """
+    Active users whose email is not in the file. Admin accounts (role_id=1)
+    are excluded to prevent accidental lockout.
+    """
+    active = User.query.with_entities(User.id, User.email_hash).filter(
+        User.status == 'Active', User.role_id != 1
+    )
+    return [uid for uid, email_hash in active if email_hash not in seen_hashes]
+
+
+def _deactivate(user_ids):
+    deactivated = 0
+    for chunk in _chunks(user_ids):
+        deactivated += User.query.filter(
+            User.id.in_(chunk), User.status == 'Active'
+        ).update({'status': 'Inactive'}, synchronize_session=False)
+    return deactivated
+
+
+def plan_users(rows, key, pending_site_names=(), first_row=2, deactivate=True):
+    """
+    Validate users.csv rows and diff them against the ``user`` table.
+
+    ``pending_site_names`` are sites that an accompanying sites.csv will
+    create, so a combined preview doesn't reject users assigned to them.
+    Existing users and sites are fetched in batches rather than per row.
+    ``first_row`` and ``deactivate=False`` let a caller plan one chunk of a
+    larger file.
+    """
+    plan = UserPlan(total=len(rows))
+    rows_by_hash, seen_hashes = _scan_user_rows(plan, rows, key, pending_site_names, first_row)
+
+    # Current values of the imported columns, fetched in the same batches
+    columns = [User.email_hash, User.id] + [
+        Site.site_name if name == 'site_name' else getattr(User, name) for name in USER_FIELDS
+    ]
+    query = User.query.with_entities(*columns).outerjoin(Site, User.site_id == Site.id)
+    existing = {
+        row.email_hash: (row.id, _fingerprint(row._mapping, USER_FIELDS))
+        for row in _prefetch(query, User.email_hash, rows_by_hash)
+    }
+
+    for email_hash, row in rows_by_hash.items():
+        fields = {
+            'first_name':  row['first_name'],
+            'middle_name': row.get('middle_name') or None,
+            'last_name':   row['last_name'],
+            'rm_num':      row['rm_num'],
+            'role_id':     int(row['role_id']),
+            'site_name':   row['site_name'].strip(),
+            'status':      row.get('status') or 'Active',
+        }
+        fields['email'] = row['email'].strip()
+        if email_hash in existing:
+            user_id, current = existing[email_hash]
+            if _fingerprint(fields, USER_FIELDS) == current:
+                plan.unchanged += 1
+            else:
+                plan.updated.append((user_id, fields))
+        else:
+            plan.added.append(fields)
+
+    if deactivate:
+        plan.deactivated = _absent_user_ids(seen_hashes)
+    return plan
+
+
+def apply_user_plan(plan, log=None):
+    """
+    Write a UserPlan (caller commits). Returns (added, updated, deactivated).
+
+    New and changed users go out in one upsert per batch; a conflict only
+    touches the imported columns, never the password or lockout state.
+    New users are linked to ``log`` (a flushed BulkUploadLog) so the
+    onboarding mailer can find everyone a run created.
+    """
+    _raise_if_invalid(plan)
+
+    names = {fields['site_name'] for fields in plan.added}
+    names |= {fields['site_name'] for _, fields in plan.updated}
+    site_ids = dict(_prefetch(Site.query.with_entities(Site.site_name, Site.id), Site.site_name, names))
+    missing = names - set(site_ids)
+    if missing:
+        raise ValueError(f"Site '{sorted(missing)[0]}' not found. Please verify the CSV file.")
+
+    key = current_app.config['SECRET_KEY']
+
+    def values(fields, import_log_id=None):
+        return {
+            **{name: fields[name] for name in USER_FIELDS if name != 'site_name'},
+            'site_id': site_ids[fields['site_name']],
+            'email_enc': encrypt_mail_password(fields['email'], key),
+            'email_hash': hash_email(fields['email'], key),
+            'must_change_password': True,
+            'failed_login_attempts': 0,
+            'import_log_id': import_log_id,
+        }
+
+    log_id = log.id if log is not None else None
+    rows = [{**values(fields, log_id), 'password': generate_password_hash(secrets.token_urlsafe(16))}
+            for fields in plan.added]
+    # Changed users already exist, so they only need a password if the row was
+    # deleted since planning
+    rows += [values(fields) for _, fields in plan.updated]
+    columns = [name for name in USER_FIELDS if name != 'site_name'] + ['site_id']
+    _upsert(User, rows, 'email_hash', columns, defaults={'password': _unused_password_hash})
+    return len(plan.added), len(plan.updated), _deactivate(plan.deactivated)
+
+
+def _resumable():
+    """Filter for logs of chunked imports that are no longer running."""
+    stale_before = _utcnow() - timedelta(seconds=current_app.config['IMPORT_STALE_SECONDS'])
+    return or_(
+        BulkUploadLog.status == 'interrupted',
+        (BulkUploadLog.status == 'in_progress')
+        & (db.func.coalesce(BulkUploadLog.checkpoint_at, BulkUploadLog.uploaded_at) < stale_before),
+    )
+
+
+def resumable_import_log(filename, fingerprint):
+    """
+    The most recent chunked import of this exact file that was interrupted,
+    or whose process stopped committing IMPORT_STALE_SECONDS ago, if any.
+    """
+    return BulkUploadLog.query.filter(
+        BulkUploadLog.filename == filename,
+        BulkUploadLog.file_fingerprint == fingerprint,
+        _resumable(),
+    ).order_by(BulkUploadLog.id.desc()).first()
+
+
+def _import_running(filename, fingerprint):
+    return db.session.query(BulkUploadLog.query.filter(
+        BulkUploadLog.filename == filename,
+        BulkUploadLog.file_fingerprint == fingerprint,
+        BulkUploadLog.status == 'in_progress',
+        ~_resumable(),
+    ).exists()).scalar()
+
+
+def import_users_chunked(rows, key, filename, fingerprint, chunk_size, uploaded_by_id=None):
+    """
+    Import users.csv ``chunk_size`` rows at a time, committing after each chunk.
+
+    Progress is recorded on a BulkUploadLog (status ``in_progress``, counts,
+    ``checkpoint_row`` and ``checkpoint_at``). If an earlier run of the same
+    file was interrupted or went silent (``resumable_import_log``), its log
+    is claimed and the rows before its checkpoint are skipped; while a run
+    of the file is still going, a ValueError is raised instead.
+    Users absent from the file are only deactivated after every chunk has
+    committed. Every failure is recorded and re-raised: before the
+    checkpoint log is committed (e.g. an invalid file) as a new ``error``
+    log, since nothing was imported; after it, by marking the log
+    ``interrupted``, keeping the chunks committed so far.
+    Returns (added, updated, deactivated).
+    """
+    try:
+        # Reject a bad file before the first commit — validation is cheap, and
+        # all-or-nothing is still the right answer for bad data.
+        scan = UserPlan(total=len(rows))
+        _, seen_hashes = _scan_user_rows(scan, rows, key)
+        _raise_if_invalid(scan)
+
+        log = resumable_import_log(filename, fingerprint)
+        started = {'uploaded_by_id': uploaded_by_id, 'total_records': len(rows), 'status': 'in_progress',
+                   'error_message': None, 'checkpoint_at': _utcnow()}
+        if log is not None:
+            # Claim it; the same file uploaded twice at once must not run twice
+            claimed = db.session.execute(
+                update(BulkUploadLog).where(BulkUploadLog.id == log.id, _resumable()).values(**started)
+            ).rowcount == 1
+            db.session.commit()
+            if not claimed:
+                raise ValueError(f'{filename} is already being imported.')
+            db.session.refresh(log)
+        elif _import_running(filename, fingerprint):
+            raise ValueError(f'{filename} is already being imported.')
+        else:
+            log = BulkUploadLog(filename=filename, file_fingerprint=fingerprint, checkpoint_row=0,
+                                users_added=0, users_updated=0, **started)
+            db.session.add(log)
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        db.session.add(BulkUploadLog(
+            filename=filename, file_fingerprint=fingerprint, uploaded_by_id=uploaded_by_id,
+            total_records=len(rows), users_added=0, users_updated=0,
+            status='error', error_message=str(e)
+        ))
+        db.session.commit()
+        raise
+
+    try:
+        for start in range(log.checkpoint_row or 0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            added, updated, _ = apply_user_plan(
+                plan_users(chunk, key, first_row=start + 2, deactivate=False), log
+            )
+            log.users_added += added
+            log.users_updated += updated
+            log.checkpoint_row = start + len(chunk)
+            log.checkpoint_at = _utcnow()
+            db.session.commit()
+
+        deactivated = _deactivate(_absent_user_ids(seen_hashes))
+        log.status = 'success'
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        log.status = 'interrupted'
+        log.error_message = str(e)
+        db.session.commit()
+        raise
+    return log.users_added, log.users_updated, deactivated
+
+
+# ---------------------------------------------------------------------------
+# Previews
+# ---------------------------------------------------------------------------
+
+def build_preview(digest, source, site_rows=None, user_rows=None, key=None, **labels):
+    """Plan the given rows inside a read-only transaction and return an ImportPreview."""
+    preview = ImportPreview(digest=digest, source=source, **labels)
+    with read_only_transaction():
+        if site_rows is not None:
+            preview.sites = plan_sites(site_rows)
+        if user_rows is not None:
+            pending = preview.sites.new_site_names if preview.sites else ()
+            preview.users = plan_users(user_rows, key, pending_site_names=pending)
+    return preview
+
+
+def save_preview(preview):
+    cache.set(f'import_preview:{preview.digest}', preview, timeout=PREVIEW_TIMEOUT)
+    # A new preview of a file that was applied before can be applied again
+    cache.delete(f'import_preview_lock:{preview.digest}')
+
+
+def load_preview(digest):
+    if not digest:
+        return None
+    return cache.get(f'import_preview:{digest}')
+
+
+def claim_preview(digest):
+    """
+    Take a preview for applying and discard it. True for exactly one caller,
+    however many submit the same preview at once (``cache.add`` only sets a
+    key that isn't there; atomic on Redis).
+    """
+    if not cache.add(f'import_preview_lock:{digest}', True, timeout=PREVIEW_TIMEOUT):
+        return False
+    cache.delete(f'import_preview:{digest}')
+    return True
+
+
+# ---------------------------------------------------------------------------
+# FTP transport
+# ---------------------------------------------------------------------------
+
+def normalize_ftp_dir(path):
+    """Strip a legacy trailing ``.csv`` filename and any trailing slash from the saved FTP path."""
+    path = path or ''
+    if path.lower().endswith('.csv'):
+        path = posixpath.dirname(path)
+    return path.rstrip('/')
+
+
+@dataclass
+class RosterFile:
+    """One roster file fetched from the FTP server."""
+    fingerprint: str     # '<size>:<mdtm>:<sha256>'; size/mdtm are blank if the server doesn't report them
+    data: bytes = None   # None when the file matched the last imported fingerprint
+
+    @property
+    def unchanged(self):
+        return self.data is None
+
+
+def _split_fingerprint(fingerprint):
+    parts = (fingerprint or '').split(':')
+    return tuple(parts) if len(parts) == 3 else ('', '', '')
+
+
+def _remote_metadata(ftp, path):
+    """Return (SIZE, MDTM) for ``path`` as strings; blank when the server doesn't support them."""
+    try:
+        size = str(ftp.size(path) or '')
+    except (ftplib.error_perm, ftplib.error_reply):
+        size = ''
+    try:
+        mdtm = ftp.sendcmd(f'MDTM {path}').split()[-1]
+    except (ftplib.error_perm, ftplib.error_reply):
+        mdtm = ''
+    return size, mdtm
+
+
+def _fetch_roster_file(ftp, path, known=None, optional=False):
+    """
+    Download ``path`` unless it matches the ``known`` fingerprint.
+
+    SIZE/MDTM are checked first so an untouched file isn't transferred at
+    all. Otherwise the download is hashed as it streams in, and a file whose
+    content is identical (e.g. re-exported with a new timestamp) is still
+    reported as unchanged. Returns None if ``optional`` and the file is absent.
+    """
+    size, mdtm = _remote_metadata(ftp, path)
+    known_size, known_mdtm, known_hash = _split_fingerprint(known)
+    if size and mdtm and (size, mdtm) == (known_size, known_mdtm):
+        return RosterFile(fingerprint=known)
+
+    digest = hashlib.sha256()
+    buf = io.BytesIO()
+
+    def _write(chunk):
+        digest.update(chunk)
+        buf.write(chunk)
+
+    try:
+        ftp.retrbinary(f'RETR {path}', _write)
+    except ftplib.error_perm:
+        if optional:
+            return None
+        raise
+    fingerprint = f'{size}:{mdtm}:{digest.hexdigest()}'
+    if known and digest.hexdigest() == known_hash:
+        return RosterFile(fingerprint=fingerprint)
+    return RosterFile(fingerprint=fingerprint, data=buf.getvalue())
+
+
+def download_roster(host, port, username, password, ftp_dir, use_tls, known=(None, None)):
+    """
+    Fetch ``sites.csv`` (optional) and ``users.csv`` from ``ftp_dir``.
+
+    ``known`` holds the (sites, users) fingerprints of the last successful
+    import; a file matching its fingerprint comes back with ``unchanged`` set
+    and no data. Returns (sites RosterFile or None, users RosterFile).
+    ftplib/socket errors are propagated unchanged so callers can turn them
+    into friendly messages.
+    """
+    ftp = ftplib.FTP_TLS() if use_tls else ftplib.FTP()
+    ftp.connect(host, port, timeout=30)
+    try:
+        ftp.login(username, password)
+        if use_tls:
+            ftp.prot_p()
+        ftp.voidcmd('TYPE I')  # SIZE is only reliable in binary mode
+        sites = _fetch_roster_file(ftp, f'{ftp_dir}/sites.csv', known[0], optional=True)
+        users = _fetch_roster_file(ftp, f'{ftp_dir}/users.csv', known[1])
+        ftp.quit()
+    except BaseException:
+        ftp.close()
+        raise
+    return sites, users
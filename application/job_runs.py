@@ -0,0 +1,135 @@
+"""
+Run history for scheduled jobs.
+
+Each job body runs inside ``track_run(job_id)``, which writes a ``job_run``
+row when the run starts and fills in the end time, duration, rows processed,
+peak memory and outcome when it finishes. A run that never finishes (the
+process died) stays 'running'. Jobs that run every few seconds pass
+``record_idle=False``: their runs are only written once finished, and only
+if they processed something or failed. Rows older than
+JOB_RUN_RETENTION_DAYS are purged about once an hour.
+
+Peak memory is how far the run raised the process's peak resident set
+size (``getrusage``), which costs nothing but reads 0 for a run that stayed
+under an earlier peak. The long jobs (the FTP import and the orphan scan)
+pass ``trace_memory=True``: with JOB_RUN_TRACK_MEMORY on they record the
+peak of Python allocations instead, measured with tracemalloc. tracemalloc
+is process-wide, slows every thread while it runs, and overlapping traced
+runs share one peak, so it is off by default. Durations also go to
+/metrics when it is on (see application/metrics.py).
+"""
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import timedelta
+
+from flask import current_app
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from main import db
+from application.metrics import observe_job
+from application.models import JobRun, _utcnow
+from application.scheduler_lock import holder_id
+
+logger = logging.getLogger(__name__)
+
+PURGE_INTERVAL = 3600  # seconds
+
+# tracemalloc is process-wide: it runs while at least one traced run does
+_tracing = {'runs': 0, 'owned': False}
+_last_purge = {'at': None}
+_tracing_lock = threading.Lock()
+
+
+def _start_tracing():
+    with _tracing_lock:
+        if _tracing['runs'] == 0:
+            _tracing['owned'] = not tracemalloc.is_tracing()
+            if _tracing['owned']:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        _tracing['runs'] += 1
+
+
+def _stop_tracing():
+    """Peak traced memory in KB since tracing started (or was last reset)."""
+    with _tracing_lock:
+        peak = tracemalloc.get_traced_memory()[1] // 1024
+        _tracing['runs'] -= 1
+        if _tracing['runs'] == 0 and _tracing['owned']:
+            tracemalloc.stop()
+    return peak
+
+
+def _max_rss_kb():
+    """The process's peak resident set size so far, in KB; None where unsupported."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak  # bytes on macOS
+
+
+def purge_job_runs():
+    """Delete run history older than JOB_RUN_RETENTION_DAYS."""
+    cutoff = _utcnow() - timedelta(days=current_app.config['JOB_RUN_RETENTION_DAYS'])
+    deleted = JobRun.query.filter(JobRun.started_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+@contextmanager
+def track_run(job_id, record_idle=True, trace_memory=False):
+    """
+    Record one run of ``job_id``. Yields the JobRun row: the job sets
+    ``rows_processed``, and ``outcome``/``error_message`` when it skips or
+    handles its own failure. An exception escaping the block is recorded
+    as an error and re-raised. ``trace_memory`` measures peak memory with
+    tracemalloc when JOB_RUN_TRACK_MEMORY is on. Runs in an app context.
+    """
+    now = time.monotonic()
+    if _last_purge['at'] is None or now - _last_purge['at'] >= PURGE_INTERVAL:
+        _last_purge['at'] = now
+        purge_job_runs()
+
+    run = JobRun(job_id=job_id, host=holder_id(), started_at=_utcnow(), outcome='running')
+    if record_idle:
+        db.session.add(run)
+        db.session.commit()
+
+    traced = trace_memory and current_app.config.get('JOB_RUN_TRACK_MEMORY')
+    if traced:
+        _start_tracing()
+    else:
+        rss_before = _max_rss_kb()
+    started = time.perf_counter()
+    try:
+        yield run
+    except Exception as e:
+        db.session.rollback()
+        run.outcome = 'error'
+        run.error_message = str(e)
+        raise
+    finally:
+        run.duration_seconds = round(time.perf_counter() - started, 3)
+        run.finished_at = _utcnow()
+        if traced:
+            run.peak_memory_kb = _stop_tracing()
+        elif rss_before is not None:
+            run.peak_memory_kb = _max_rss_kb() - rss_before
+        if run.outcome == 'running':
+            run.outcome = 'success'
+        observe_job(job_id, run.outcome, run.duration_seconds)
+        try:
+            if not record_idle and (run.rows_processed or run.outcome == 'error'):
+                db.session.add(run)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f'Could not record run of job {job_id}: {e}', exc_info=True)
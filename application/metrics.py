@@ -0,0 +1,208 @@
+"""
+Prometheus metrics, served at /metrics when METRICS_ENABLED is on.
+
+- Request latency per endpoint, method and status.
+- SQL statements and SQL time per request, per endpoint (counted by
+  application/request_timing.py).
+- Flask-Caching hits and misses, by key prefix (hit ratio = hits / all).
+- Scheduled job durations, by job and outcome (see job_runs.track_run).
+- Email outbox and background task queue depth, read from the database when
+  /metrics is scraped.
+
+Needs the optional ``metrics`` extra (``pip install assistitk12[metrics]``).
+
+Under gunicorn each worker counts on its own. Point PROMETHEUS_MULTIPROC_DIR
+at an empty directory before the workers (and any ``flask run-scheduler``
+process on the same host) start, and empty it on every restart. Each
+process then writes its counters there and every scrape adds them all up.
+There are no per-process gauges, so no gunicorn ``child_exit`` hook is
+needed.
+
+/metrics needs ``Authorization: Bearer <METRICS_TOKEN>``. Without a token
+it only answers requests from localhost.
+"""
+import hmac
+import logging
+import os
+import re
+import time
+
+from flask import Response, abort, current_app, g, request
+
+from main import cache, db, limiter
+
+try:
+    import prometheus_client
+    from prometheus_client import CollectorRegistry, Counter, Histogram
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:  # optional 'metrics' extra
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'assistitk12_'
+LOCAL_ADDRS = ('127.0.0.1', '::1')
+
+# Created by _define_metrics() on first use
+_metrics = {}
+
+
+def _define_metrics():
+    """
+    The metric objects, kept in their own registry. In multiprocess mode
+    prometheus_client writes their values to PROMETHEUS_MULTIPROC_DIR.
+    """
+    if _metrics:
+        return _metrics
+    registry = CollectorRegistry()
+    _metrics.update(
+        registry=registry,
+        request_duration=Histogram(
+            PREFIX + 'request_duration_seconds', 'Time to handle a request.',
+            ['endpoint', 'method', 'status'], registry=registry,
+        ),
+        request_sql_queries=Histogram(
+            PREFIX + 'request_sql_queries', 'SQL statements run by one request.',
+            ['endpoint'], registry=registry,
+            buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, float('inf')),
+        ),
+        request_sql_seconds=Histogram(
+            PREFIX + 'request_sql_duration_seconds', 'Time one request spent in SQL statements.',
+            ['endpoint'], registry=registry,
+        ),
+        cache_requests=Counter(
+            PREFIX + 'cache_requests', 'Flask-Caching lookups by key prefix and result (hit/miss).',
+            ['cache', 'result'], registry=registry,
+        ),
+        job_duration=Histogram(
+            PREFIX + 'job_duration_seconds', 'Duration of scheduled job runs.',
+            ['job', 'outcome'], registry=registry,
+            buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, float('inf')),
+        ),
+    )
+    return _metrics
+
+
+class QueueCollector:
+    """Queue depths, counted in the database at scrape time."""
+
+    def collect(self):
+        from application.models import EmailOutbox, Task
+
+        outbox = GaugeMetricFamily(
+            PREFIX + 'email_outbox_messages', 'Notification emails in the outbox by status.', labels=['status']
+        )
+        counts = dict(
+            db.session.query(EmailOutbox.status, db.func.count(EmailOutbox.id))
+            .filter(EmailOutbox.status != 'sent').group_by(EmailOutbox.status).all()
+        )
+        for status in ('pending', 'dead'):
+            outbox.add_metric([status], counts.get(status, 0))
+        yield outbox
+
+        tasks = GaugeMetricFamily(
+            PREFIX + 'background_tasks', 'Background tasks waiting or running.', labels=['status']
+        )
+        counts = dict(
+            db.session.query(Task.status, db.func.count(Task.id))
+            .filter(Task.status.in_(('queued', 'running'))).group_by(Task.status).all()
+        )
+        for status in ('queued', 'running'):
+            tasks.add_metric([status], counts.get(status, 0))
+        yield tasks
+
+
+def observe_job(job_id, outcome, seconds):
+    """Record one scheduled job run (called by job_runs.track_run)."""
+    if _metrics:
+        _metrics['job_duration'].labels(job_id, outcome).observe(seconds)
+
+
+# ****************** Cache lookups *******************************
+
+def _cache_name(key):
+    """Key prefix used as the label: 'import_preview:<digest>' -> 'import_preview'."""
+    return (re.split(r'[:/]', str(key), maxsplit=1)[0] or 'view')[:50]
+
+
+def _instrument_cache(app):
+    """Count hits and misses on this app's cache backend."""
+    backend = app.extensions['cache'][cache]
+    get = backend.get
+    counter = _metrics['cache_requests']
+
+    def counted_get(key):
+        value = get(key)
+        counter.labels(_cache_name(key), 'miss' if value is None else 'hit').inc()
+        return value
+    backend.get = counted_get
+
+
+# ****************** Request hooks and the endpoint *******************************
+
+def _record_request(response):
+    started = g.get('request_started')
+    if started is None or request.endpoint == 'metrics':
+        return response
+    endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+    _metrics['request_duration'].labels(endpoint, request.method, str(response.status_code)).observe(
+        time.perf_counter() - started
+    )
+    _metrics['request_sql_queries'].labels(endpoint).observe(g.sql_queries)
+    _metrics['request_sql_seconds'].labels(endpoint).observe(g.sql_seconds)
+    return response
+
+
+def _allowed():
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+        return hmac.compare_digest(supplied.encode(), token.encode())
+    return request.remote_addr in LOCAL_ADDRS
+
+
+@limiter.exempt
+def metrics_view():
+    """Every metric in the Prometheus text format."""
+    if not _allowed():
+        abort(404)
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        # Add up the values every worker wrote
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = _metrics['registry']
+    output = prometheus_client.generate_latest(registry)
+    try:
+        output += prometheus_client.generate_latest(_queue_registry())
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f'Could not read queue depths for /metrics: {e}', exc_info=True)
+    return Response(output, mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def _queue_registry():
+    if 'queue_registry' not in _metrics:
+        registry = CollectorRegistry()
+        registry.register(QueueCollector())
+        _metrics['queue_registry'] = registry
+    return _metrics['queue_registry']
+
+
+def init_metrics(app):
+    """
+    Hook metrics into the app (METRICS_ENABLED); needs prometheus_client.
+    Call after init_request_timing.
+    """
+    if not app.config.get('METRICS_ENABLED'):
+        return
+    if prometheus_client is None:
+        raise RuntimeError(
+            "METRICS_ENABLED needs prometheus_client. Install it with: pip install assistitk12[metrics]"
+        )
+    _define_metrics()
+    _instrument_cache(app)
+    # Request start and SQL counts come from request_timing's hooks
+    app.after_request(_record_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -35,6 +35,9 @@ class Organization(db.Model):
     ftp_schedule_days    = db.Column(db.String(50), default='*', nullable=True)  # '*' or 'mon,tue,...'
     ftp_last_run_at      = db.Column(db.DateTime, nullable=True)
     ftp_last_run_status  = db.Column(db.String(20), nullable=True)
+    # '<size>:<mdtm>:<sha256>' of the last successfully imported roster files
+    ftp_sites_fingerprint = db.Column(db.String(128), nullable=True)
+    ftp_users_fingerprint = db.Column(db.String(128), nullable=True)
     ftp_schedule_start_date = db.Column(db.Date, nullable=True)
     ftp_schedule_stop_date  = db.Column(db.Date, nullable=True)
 
@@ -75,6 +78,9 @@ class User(db.Model, UserMixin):
     rm_num = db.Column(db.String(45), nullable=True)
     role_id = db.Column(db.Integer, db.ForeignKey('role.id', ondelete='CASCADE'), nullable=False)
     site_id = db.Column(db.Integer, db.ForeignKey('site.id', ondelete='CASCADE'), nullable=False)
+    email_digest_minutes = db.Column(db.Integer, nullable=False, default=0)  # 0 = send ticket emails right away
+    # The bulk import that created this user, for the onboarding mailer
+    import_log_id = db.Column(db.Integer, db.ForeignKey('bulk_upload_log.id', ondelete='SET NULL'), nullable=True, index=True)
 
     def get_full_name(self):
         return f"{self.first_name} {self.middle_name or ''} {self.last_name}".strip()
@@ -157,6 +163,45 @@ class Ticket_attachment(db.Model):
     attach_image = db.Column(db.String(255), nullable=False)  # This column should exist
     uploaded_at = db.Column(db.DateTime, default=_utcnow, nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    # Stored content; NULL for attachments saved before content-addressed storage,
+    # which still live flat in UPLOAD_ATTACHMENT under attach_image
+    blob_sha256 = db.Column(db.String(64), db.ForeignKey('attachment_blob.sha256'), nullable=True, index=True)
+    # Bytes as uploaded; blob.size is what is stored after any downscaling
+    original_size = db.Column(db.BigInteger, nullable=True)
+
+    blob = db.relationship('AttachmentBlob')
+
+
+class AttachmentBlob(db.Model):
+    """
+    One stored attachment file, named by the SHA-256 of its content.
+    ref_count is the number of Ticket_attachment rows using it; the file is
+    removed once it drops to zero.
+    """
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=_utcnow, nullable=False)
+    # Images get a small preview from the thumbnail job: NULL for files that
+    # have none (PDFs), else 'pending', 'ready' or 'failed'
+    thumbnail_status = db.Column(db.String(10), nullable=True, index=True)
+    thumbnail_format = db.Column(db.String(4), nullable=True)  # 'webp' or 'jpeg'
+
+
+class AttachmentTombstone(db.Model):
+    """
+    A stored file waiting to be deleted. Written in the same transaction as
+    the attachment delete that released it and removed by the background
+    sweeper, so requests never wait on (or fail because of) file deletion.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    storage_key = db.Column(db.String(255), nullable=False)
+    # Set for content-addressed blobs: the file goes only if the blob is
+    # still unreferenced when the sweeper gets to it
+    blob_sha256 = db.Column(db.String(64), nullable=True)
+    created_at = db.Column(db.DateTime, default=_utcnow, nullable=False, index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
 
 
 
@@ -170,5 +215,154 @@ class BulkUploadLog(db.Model):
     users_updated = db.Column(db.Integer, default=0)
     status = db.Column(db.String(20), default='success')
     error_message = db.Column(db.Text, nullable=True)
+    # Chunked imports: SHA-256 of the file and the number of CSV rows already
+    # committed, so an interrupted run can resume where it stopped, and when
+    # the running import last committed (a silent one is presumed dead).
+    file_fingerprint = db.Column(db.String(64), nullable=True, index=True)
+    checkpoint_row = db.Column(db.Integer, nullable=True)
+    checkpoint_at = db.Column(db.DateTime, nullable=True)
 
     uploader = db.relationship('User', foreign_keys=[uploaded_by_id])
+
+
+class OnboardingEmail(db.Model):
+    """
+    A queued welcome email for a user created by a bulk import.
+    The temporary password is generated and set when the email is sent, so it
+    is never stored. status: 'pending', 'sent', 'skipped' (the user has
+    already set a password or is inactive), or 'dead' (gave up).
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    import_log_id = db.Column(db.Integer, db.ForeignKey('bulk_upload_log.id', ondelete='CASCADE'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, unique=True)
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=_utcnow, index=True)
+    claim_token = db.Column(db.String(32), nullable=True)  # set while the worker holds the row
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=_utcnow, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    user = db.relationship('User', foreign_keys=[user_id])
+    import_log = db.relationship('BulkUploadLog', backref=db.backref('onboarding_emails', lazy='dynamic'))
+
+
+class EmailOutbox(db.Model):
+    """
+    One queued notification email. Rows are written in the same transaction
+    as the change they describe and sent later by the outbox dispatcher.
+    status: 'pending' (waiting or retrying), 'sent', or 'dead' (gave up).
+    Rows with digest set are held until the recipient's digest window closes
+    and sent together as one summary email.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    event = db.Column(db.String(30), nullable=False)
+    ticket_id = db.Column(db.Integer, db.ForeignKey('ticket.id', ondelete='SET NULL'), nullable=True, index=True)
+    recipient_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    recipient_enc = db.Column(db.Text, nullable=False)  # Fernet-encrypted address, like user.email_enc
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    body_html = db.Column(db.Text, nullable=True)  # HTML part; rows queued before it existed go out as text only
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=_utcnow, index=True)
+    claim_token = db.Column(db.String(32), nullable=True)  # set while a dispatcher holds the row
+    digest = db.Column(db.Boolean, nullable=False, default=False)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=_utcnow, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    recipient = db.relationship('User', foreign_keys=[recipient_id])
+
+    @property
+    def recipient_email(self):
+        from flask import current_app
+        from application.utils import decrypt_mail_password
+        return decrypt_mail_password(self.recipient_enc or '', current_app.config['SECRET_KEY'])
+
+    @recipient_email.setter
+    def recipient_email(self, value):
+        from flask import current_app
+        from application.utils import encrypt_mail_password
+        self.recipient_enc = encrypt_mail_password(value or '', current_app.config['SECRET_KEY'])
+
+
+class SchedulerLock(db.Model):
+    """
+    Lease that elects one process to run scheduled jobs. The holder renews
+    it every heartbeat; once expires_at passes without a renewal any other
+    process may take it over.
+    """
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(255), nullable=False)  # '<host>:<pid>:<random>'
+    acquired_at = db.Column(db.DateTime, nullable=False, default=_utcnow)
+    heartbeat_at = db.Column(db.DateTime, nullable=False, default=_utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class JobRun(db.Model):
+    """
+    One run of a scheduled job, for the Job History page.
+    outcome: 'running' (or the process died mid-run), 'success', 'skipped'
+    (nothing to do, e.g. an unchanged roster) or 'error'.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    job_id = db.Column(db.String(100), nullable=False, index=True)
+    host = db.Column(db.String(255), nullable=True)  # scheduler lease holder that ran it
+    started_at = db.Column(db.DateTime, nullable=False, default=_utcnow, index=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    duration_seconds = db.Column(db.Float, nullable=True)
+    rows_processed = db.Column(db.Integer, nullable=True)
+    peak_memory_kb = db.Column(db.Integer, nullable=True)  # see job_runs.track_run
+    outcome = db.Column(db.String(20), nullable=False, default='running')
+    error_message = db.Column(db.Text, nullable=True)
+
+
+class Task(db.Model):
+    """
+    One background task queued from a page (see application/tasks.py).
+    status: 'queued', 'running', 'succeeded', 'failed' or 'cancelled'.
+    Finished tasks and their results are purged after TASK_RETENTION_HOURS.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String(50), nullable=False)
+    params = db.Column(db.Text, nullable=True)  # JSON keyword arguments
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    created_by_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=_utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True, index=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)  # touched by the runner while it runs
+    worker = db.Column(db.String(255), nullable=True)  # scheduler lease holder running it
+    progress_done = db.Column(db.Integer, nullable=False, default=0)
+    progress_total = db.Column(db.Integer, nullable=True)
+    progress_message = db.Column(db.String(255), nullable=True)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    result = db.Column(db.Text, nullable=True)  # JSON returned by the task
+    result_filename = db.Column(db.String(255), nullable=True)
+    # Not loaded with the row; status polls never need it
+    result_file = db.deferred(db.Column(db.LargeBinary(length=2**32 - 1), nullable=True))
+    error_message = db.Column(db.Text, nullable=True)
+
+    created_by = db.relationship('User', foreign_keys=[created_by_id])
+
+
+class RequestProfile(db.Model):
+    """
+    A request an admin ran under the profiler (see application/profiler.py).
+    Only the newest PROFILER_KEEP are kept.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=_utcnow, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    method = db.Column(db.String(10), nullable=False)
+    path = db.Column(db.String(255), nullable=False)  # with the query string
+    endpoint = db.Column(db.String(100), nullable=True)
+    status_code = db.Column(db.Integer, nullable=True)
+    duration_ms = db.Column(db.Float, nullable=True)
+    sql_queries = db.Column(db.Integer, nullable=True)  # when request timing or metrics are on
+    summary = db.Column(db.Text, nullable=True)  # slowest functions, as printed by pstats
+    # marshalled pstats data, the format of a .prof file; not loaded with the row
+    stats = db.deferred(db.Column(db.LargeBinary(length=2**32 - 1), nullable=False))
+
+    user = db.relationship('User', foreign_keys=[user_id])
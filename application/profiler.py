@@ -0,0 +1,152 @@
+"""
+On-demand profiling of live requests, for admins.
+
+With PROFILER_ENABLED on, an admin adds ``_profile=1`` to a URL's query
+string (or sends ``X-Profile: 1``) and that request runs under cProfile.
+The response carries ``X-Profile-Id``. The profile is kept in
+request_profile: the Request Profiles page lists the slowest functions by
+cumulative time, and the download is a .prof file for ``python -m pstats``,
+snakeviz, or a flame graph tool such as flameprof.
+
+The flag is ignored for everyone but admins. Each admin may profile at most
+PROFILER_RATE_LIMIT requests, counted in the rate limiter's storage so the
+limit holds across workers (per process if RATELIMIT_ENABLED is off). A
+process profiles one request at a time, because cProfile cannot profile
+two at once. A refused request is served normally with
+``X-Profile: refused``. The newest PROFILER_KEEP profiles are kept.
+"""
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import threading
+import time
+
+from flask import current_app, g, request
+from flask_login import current_user
+from limits import parse
+from limits.storage import MemoryStorage
+from limits.strategies import FixedWindowRateLimiter
+from sqlalchemy import delete, insert, select
+
+from main import db, limiter
+from application.models import RequestProfile
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_LINES = 40  # functions listed on the Request Profiles page
+_busy = threading.Lock()  # one profiled request per process
+# Counts profiles when app-wide rate limiting is off (RATELIMIT_ENABLED)
+_local_limiter = FixedWindowRateLimiter(MemoryStorage())
+
+
+def _requested():
+    return request.args.get('_profile') == '1' or request.headers.get('X-Profile') == '1'
+
+
+def _within_rate_limit(user_id):
+    """Count one profile against the admin's PROFILER_RATE_LIMIT."""
+    counter = limiter.limiter if limiter.enabled else _local_limiter
+    try:
+        return counter.hit(current_app.extensions['profiler_rate_limit'], 'request_profile', str(user_id))
+    except Exception as e:  # the rate limit storage is unreachable
+        logger.error(f'Could not check the profiler rate limit: {e}')
+        return False
+
+
+def _start_profile():
+    if not _requested() or request.endpoint == 'static':
+        return
+    if not (current_user.is_authenticated and current_user.is_admin):
+        return
+    if not _busy.acquire(blocking=False):
+        g.profile_refused = True
+        return
+    profile = cProfile.Profile()
+    try:
+        allowed = _within_rate_limit(current_user.id)
+        if allowed:
+            profile.enable()
+    except ValueError:  # another profiler is active in this process
+        allowed = False
+    if not allowed:
+        _busy.release()
+        g.profile_refused = True
+        return
+    g.profile = profile
+    g.profile_started = time.perf_counter()
+
+
+def _stop_profile():
+    """Stop this request's profiler, if it has one; returns it."""
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.disable()
+        _busy.release()
+    return profile
+
+
+def _finish_profile(response):
+    profile = _stop_profile()
+    if profile is None:
+        if g.pop('profile_refused', False):
+            response.headers['X-Profile'] = 'refused'
+        return response
+    duration_ms = (time.perf_counter() - g.profile_started) * 1000
+    try:
+        profile_id = save_profile(profile, response.status_code, duration_ms)
+    except Exception as e:
+        logger.error(f'Could not save the profile of {request.path}: {e}', exc_info=True)
+    else:
+        response.headers['X-Profile-Id'] = str(profile_id)
+    return response
+
+
+def _abandon_profile(exc):
+    # after_request didn't run (an error while finishing the response)
+    _stop_profile()
+
+
+def save_profile(profile, status_code, duration_ms):
+    """
+    Store a finished profile and drop all but the newest PROFILER_KEEP, on
+    a connection of its own so the request's session is left alone.
+    """
+    stats = pstats.Stats(profile)
+    data = marshal.dumps(stats.stats)  # what pstats.Stats.dump_stats writes
+    summary = io.StringIO()
+    stats.stream = summary
+    stats.strip_dirs().sort_stats('cumulative').print_stats(SUMMARY_LINES)
+
+    path = request.full_path.rstrip('?')
+    with db.engine.begin() as conn:
+        profile_id = conn.execute(insert(RequestProfile).values(
+            user_id=current_user.id,
+            method=request.method,
+            path=path[:255],
+            endpoint=request.endpoint,
+            status_code=status_code,
+            duration_ms=round(duration_ms, 1),
+            sql_queries=g.get('sql_queries'),
+            summary=summary.getvalue(),
+            stats=data,
+        )).inserted_primary_key[0]
+        oldest_kept = conn.execute(
+            select(RequestProfile.id).order_by(RequestProfile.id.desc())
+            .offset(current_app.config['PROFILER_KEEP'] - 1).limit(1)
+        ).scalar()
+        if oldest_kept:
+            conn.execute(delete(RequestProfile).where(RequestProfile.id < oldest_kept))
+    return profile_id
+
+
+def init_profiler(app):
+    """Let admins profile requests on demand (PROFILER_ENABLED)."""
+    if not app.config.get('PROFILER_ENABLED'):
+        return
+    # Parsed here so a malformed PROFILER_RATE_LIMIT fails at startup
+    app.extensions['profiler_rate_limit'] = parse(app.config['PROFILER_RATE_LIMIT'])
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    app.teardown_request(_abandon_profile)
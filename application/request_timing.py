@@ -0,0 +1,139 @@
+"""
+Per-request SQL and render timing.
+
+SQLAlchemy engine events count and time the SQL statements each request
+runs (``g.sql_queries``, ``g.sql_seconds``), and Flask's template signals
+time rendering (``g.render_seconds``). /metrics reports the counts (see
+application/metrics.py).
+
+With REQUEST_TIMING_ENABLED every response also gets a Server-Timing
+header (db, render, total), which browser dev tools show for the request.
+A request that runs more than SQL_QUERY_BUDGET statements, or spends more
+than SQL_TIME_BUDGET_MS in them, is logged with its most repeated
+statements. One statement run once per row is the usual sign of an N+1
+query, e.g. a relationship lazy-loaded inside a template loop.
+
+Statements run while a template renders count towards both db and render.
+"""
+import hashlib
+import logging
+import re
+import time
+from collections import Counter
+
+from flask import before_render_template, current_app, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+REPEATED_SHOWN = 3  # statements listed in an over-budget log line
+_PLACEHOLDER_LIST = re.compile(r'\((?:\s*(?:\?|%s|:\w+)\s*,)+\s*(?:\?|%s|:\w+)\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+_SELECT_LIST = re.compile(r'^SELECT .+? FROM ')
+
+
+# ****************** SQL statements *******************************
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._timing_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_timing_started', None)
+    if started is None or not has_request_context() or 'sql_queries' not in g:
+        return
+    g.sql_queries += 1
+    g.sql_seconds += time.perf_counter() - started
+    if g.sql_statements is not None:
+        g.sql_statements[statement] += 1
+
+
+def fingerprint(statement):
+    """
+    The statement with IN lists of any length folded to one placeholder and
+    whitespace collapsed, and a short hash of that, so the same query shape
+    matches across requests and log lines.
+    """
+    normalized = _WHITESPACE.sub(' ', _PLACEHOLDER_LIST.sub('(?)', statement)).strip()
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:8], normalized
+
+
+def repeated_statements(statements):
+    """``[(fingerprint, count, statement)]`` run more than once, most repeated first."""
+    shapes = {}
+    for statement, count in statements.items():
+        key, normalized = fingerprint(statement)
+        _, total, _ = shapes.get(key, (key, 0, normalized))
+        shapes[key] = (key, total + count, normalized)
+    return sorted((s for s in shapes.values() if s[1] > 1), key=lambda s: s[1], reverse=True)
+
+
+# ****************** Template rendering *******************************
+
+def _before_render(sender, template, context, **extra):
+    if has_request_context() and 'render_seconds' in g:
+        g.render_stack.append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    if has_request_context() and g.get('render_stack'):
+        started = g.render_stack.pop()
+        if not g.render_stack:  # a template rendered inside another is already counted
+            g.render_seconds += time.perf_counter() - started
+
+
+# ****************** Request hooks *******************************
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0.0
+    g.render_seconds = 0.0
+    g.render_stack = []
+    g.sql_statements = Counter() if current_app.config.get('REQUEST_TIMING_ENABLED') else None
+
+
+def _finish_request(response):
+    if g.get('sql_statements') is None:
+        return response
+    total = time.perf_counter() - g.request_started
+    response.headers['Server-Timing'] = (
+        f'db;dur={g.sql_seconds * 1000:.1f};desc="{g.sql_queries} queries", '
+        f'render;dur={g.render_seconds * 1000:.1f}, '
+        f'total;dur={total * 1000:.1f}'
+    )
+    _check_budget()
+    return response
+
+
+def _check_budget():
+    """Log the request if it ran more statements, or spent longer in SQL, than budgeted."""
+    max_queries = current_app.config.get('SQL_QUERY_BUDGET')
+    max_ms = current_app.config.get('SQL_TIME_BUDGET_MS')
+    db_ms = g.sql_seconds * 1000
+    if not ((max_queries and g.sql_queries > max_queries) or (max_ms and db_ms > max_ms)):
+        return
+    repeated = '; '.join(
+        f'[{key}] x{count} {_SELECT_LIST.sub("SELECT ... FROM ", statement, count=1)[:200]}'
+        for key, count, statement in repeated_statements(g.sql_statements)[:REPEATED_SHOWN]
+    )
+    logger.warning(
+        f'SQL budget exceeded: {request.method} {request.path} ({request.endpoint}) ran '
+        f'{g.sql_queries} statements in {db_ms:.0f} ms (budget {max_queries or "-"} statements, '
+        f'{max_ms or "-"} ms). Repeated: {repeated or "none"}'
+    )
+
+
+def init_request_timing(app):
+    """Count SQL statements and render time per request when timing or metrics are on."""
+    if not (app.config.get('REQUEST_TIMING_ENABLED') or app.config.get('METRICS_ENABLED')):
+        return
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
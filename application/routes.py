@@ -1,24 +1,26 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash, abort, current_app, send_from_directory, jsonify, session
+from flask import Blueprint, render_template, redirect, url_for, request, flash, abort, current_app, jsonify, session, stream_with_context
 from flask_limiter.util import get_remote_address
 from flask_login import login_user, login_required, logout_user, current_user
 from flask_paginate import Pagination, get_page_args
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from .models import User, Role, Site, Notification, Organization, Ticket, Title, Ticket_content, Ticket_attachment, BulkUploadLog
+from .models import User, Role, Site, Notification, Organization, Ticket, Title, Ticket_content, Ticket_attachment, BulkUploadLog, EmailOutbox, OnboardingEmail, JobRun, Task, RequestProfile
 from .forms import LoginForm, UserForm, RoleForm, SiteForm, NotificationForm, OrganizationForm, EmailConfigForm, TicketForm, TitleForm, TicketContentForm
 from .utils import validate_password, validate_file_upload, encrypt_mail_password, decrypt_mail_password, hash_email, get_app_version
-from .email_utils import send_ticket_notification, send_temp_password_email, send_password_updated_email
-from main import db, login_manager, mail, limiter, scheduler
+from .email_utils import (DIGEST_CHOICES, queue_ticket_notification, queue_onboarding_emails, send_temp_password_email,
+                          send_password_updated_email, smtp_connection)
+from .attachments import (RejectedUpload, add_attachment, release_attachment, send_attachment, send_thumbnail,
+                          iter_attachments_zip, zip_entries)
+from .import_engine import (plan_sites, apply_site_plan, plan_users, apply_user_plan, parse_csv, file_digest,
+                            import_users_chunked, resumable_import_log, build_preview, save_preview, load_preview,
+                            claim_preview, download_roster, normalize_ftp_dir)
+from main import db, login_manager, mail, limiter, scheduler, cache
 from flask_mail import Message
 from datetime import datetime, timedelta, timezone
-import time, os, re, csv, logging, secrets, ftplib, io, socket
+import time, re, csv, functools, logging, secrets, ftplib, socket
 from sqlalchemy.sql import func
-from flask_caching import Cache
 from sqlalchemy import case
-
-# Cache configuration for storing database query results
-# Using simple cache type with 2-hour expiration for assigned users query
-cache = Cache(config={'CACHE_TYPE': 'simple'})
+from sqlalchemy.exc import IntegrityError
 
 # Cached function to retrieve users with specific roles (1 and 2)
 # This avoids repeated database queries for frequently accessed user data
@@ -38,10 +40,15 @@ def get_assigned_users():
 # This allows for modular application structure and route organization
 routes_blueprint = Blueprint('routes', __name__)
 
-# Fixed hash checked (and discarded) when a login is attempted for an email
-# that doesn't exist, so check_password_hash() always runs and the response
-# time can't be used to enumerate which accounts exist.
-_DUMMY_PASSWORD_HASH = generate_password_hash(secrets.token_urlsafe(32))
+@functools.lru_cache(maxsize=1)
+def _dummy_password_hash():
+    """
+    Fixed hash checked (and discarded) when a login is attempted for an email
+    that doesn't exist, so check_password_hash() always runs and the response
+    time can't be used to enumerate which accounts exist. Computed on first
+    use: a full password hash is too slow to run on every import.
+    """
+    return generate_password_hash(secrets.token_urlsafe(32))
 
 @routes_blueprint.app_context_processor
 def inject_active_notifications():
@@ -186,6 +193,17 @@ def forbidden_error(error):
     return render_template('error.html'), 403
 
 
+# ****************** Rejected Upload *******************************
+@routes_blueprint.app_errorhandler(RejectedUpload)
+def rejected_upload(error):
+    """
+    An attachment was refused while the request body was still arriving
+    (wrong file type or too large). Show the reason on the same page.
+    """
+    flash(error.description, 'error')
+    return redirect(request.url)
+
+
 # ****************** Login Page *******************************
 @routes_blueprint.route('/login', methods=['GET', 'POST'])
 @limiter.limit("10 per minute", key_func=get_remote_address)
@@ -219,7 +237,7 @@ def login():
         # locked one, so response time doesn't reveal which case occurred
         # (account enumeration via timing side-channel).
         password_ok = check_password_hash(
-            user.password if user else _DUMMY_PASSWORD_HASH, form.password.data
+            user.password if user else _dummy_password_hash(), form.password.data
         )
 
         if user and not locked and password_ok and user.status == 'Active':
@@ -373,6 +391,7 @@ def email_config():
         )
         current_app.config['MAIL_DEFAULT_SENDER'] = organization.mail_default_sender
         mail.init_app(current_app)
+        smtp_connection.close()  # the warm outbox connection was opened with the old settings
 
         flash('Email settings updated successfully!', 'success')
     else:
@@ -418,6 +437,241 @@ def test_email():
         return jsonify({'success': False, 'message': 'Failed to send email. Check server logs for details.'}), 500
 
 
+# ****************** Email Queue *******************************
+@routes_blueprint.route('/email-outbox', methods=['GET'])
+@login_required
+def email_outbox():
+    """Queue depth and failed notification emails."""
+    is_admin()
+    current_path = request.path
+    current_page_name = 'Email Queue'
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    counts = dict(
+        db.session.query(EmailOutbox.status, func.count(EmailOutbox.id)).group_by(EmailOutbox.status).all()
+    )
+    stats = {
+        'pending': counts.get('pending', 0),
+        'retrying': EmailOutbox.query.filter(EmailOutbox.status == 'pending', EmailOutbox.attempts > 0).count(),
+        'dead': counts.get('dead', 0),
+        'sent_24h': EmailOutbox.query.filter(
+            EmailOutbox.status == 'sent', EmailOutbox.sent_at >= now - timedelta(hours=24)
+        ).count(),
+        'oldest_pending': db.session.query(func.min(EmailOutbox.created_at)).filter(
+            EmailOutbox.status == 'pending'
+        ).scalar(),
+        # Connection reuse by this worker's dispatcher since it started
+        'smtp_handshakes': smtp_connection.handshakes,
+        'smtp_messages': smtp_connection.messages,
+    }
+
+    # Failures only: dead rows and pending rows that have already failed once
+    page, per_page, offset = get_page_args(page_parameter="page", per_page_parameter="per_page")
+    failures = EmailOutbox.query.filter(
+        (EmailOutbox.status == 'dead') | ((EmailOutbox.status == 'pending') & (EmailOutbox.attempts > 0))
+    ).order_by(EmailOutbox.id.desc())
+    total = failures.count()
+    pagination = Pagination(page=page, per_page=per_page, total=total, css_framework='bootstrap5')
+    return render_template('email_outbox.html', stats=stats, failures=failures.offset(offset).limit(per_page).all(),
+        pagination=pagination, per_page=per_page, total=total,
+        current_path=current_path,
+        current_page_name=current_page_name
+    )
+
+
+@routes_blueprint.route('/email-outbox/<int:outbox_id>/retry', methods=['POST'])
+@login_required
+def retry_email_outbox(outbox_id):
+    """Put a failed email back in the queue with a fresh set of attempts."""
+    is_admin()
+    row = EmailOutbox.query.get_or_404(outbox_id)
+    if row.status != 'sent':
+        row.status = 'pending'
+        row.attempts = 0
+        row.claim_token = None
+        row.next_attempt_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        db.session.commit()
+        flash('Email queued for another attempt.', 'success')
+    return redirect(url_for('routes.email_outbox'))
+
+
+@routes_blueprint.route('/email-outbox/<int:outbox_id>/delete', methods=['POST'])
+@login_required
+def delete_email_outbox(outbox_id):
+    """Drop a queued or failed email without sending it."""
+    is_admin()
+    row = EmailOutbox.query.get_or_404(outbox_id)
+    db.session.delete(row)
+    db.session.commit()
+    flash('Email removed from the queue.', 'success')
+    return redirect(url_for('routes.email_outbox'))
+
+
+# ****************** Job History *******************************
+@routes_blueprint.route('/job-runs', methods=['GET'])
+@login_required
+def job_runs():
+    """Scheduled jobs with their next run and recent timings, and the run history."""
+    is_admin()
+    from .scheduler_lock import current_lease
+    current_path = request.path
+    current_page_name = 'Job History'
+
+    # Per-job timings over the last 30 days, next to each job's next run
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    since = now - timedelta(days=30)
+    timings = {
+        row[0]: row for row in db.session.query(
+            JobRun.job_id,
+            func.max(JobRun.started_at),
+            func.avg(JobRun.duration_seconds),
+            func.max(JobRun.duration_seconds),
+            func.sum(case((JobRun.outcome == 'error', 1), else_=0)),
+        ).filter(JobRun.started_at >= since).group_by(JobRun.job_id).all()
+    }
+    next_runs = {job.id: job.next_run_time for job in scheduler.get_jobs()}
+    jobs = []
+    for job_id in sorted(set(timings) | set(next_runs)):
+        _, last_run, avg_duration, max_duration, errors = timings.get(job_id, (job_id, None, None, None, 0))
+        jobs.append({
+            'id': job_id, 'next_run': next_runs.get(job_id), 'last_run': last_run,
+            'avg_duration': avg_duration, 'max_duration': max_duration, 'errors': errors or 0,
+        })
+
+    job_filter = request.args.get('job', '').strip()
+    runs = JobRun.query
+    if job_filter:
+        runs = runs.filter_by(job_id=job_filter)
+    runs = runs.order_by(JobRun.started_at.desc(), JobRun.id.desc())
+    page, per_page, offset = get_page_args(page_parameter="page", per_page_parameter="per_page")
+    total = runs.count()
+    pagination = Pagination(page=page, per_page=per_page, total=total, css_framework='bootstrap5')
+    lease = current_lease()
+    return render_template('job_runs.html', jobs=jobs, job_filter=job_filter,
+        lease=lease if lease and lease.expires_at > now else None,
+        runs=runs.offset(offset).limit(per_page).all(),
+        pagination=pagination, per_page=per_page, total=total,
+        current_path=current_path,
+        current_page_name=current_page_name
+    )
+
+
+# ****************** Background Tasks *******************************
+@routes_blueprint.route('/tasks', methods=['GET'])
+@login_required
+def tasks():
+    """Queued, running and recently finished background tasks."""
+    is_admin()
+    from .tasks import task_label
+    current_path = request.path
+    current_page_name = 'Background Tasks'
+
+    page, per_page, offset = get_page_args(page_parameter="page", per_page_parameter="per_page")
+    query = Task.query.order_by(Task.id.desc())
+    total = query.count()
+    pagination = Pagination(page=page, per_page=per_page, total=total, css_framework='bootstrap5')
+    return render_template('tasks.html', tasks=query.offset(offset).limit(per_page).all(),
+        task_label=task_label, pagination=pagination, per_page=per_page, total=total,
+        current_path=current_path,
+        current_page_name=current_page_name
+    )
+
+
+def _get_task_or_404(task_id):
+    """A task its creator or an admin may see; 404 for anyone else."""
+    task = Task.query.get_or_404(task_id)
+    if current_user.role_id != 1 and task.created_by_id != current_user.id:
+        abort(404)
+    return task
+
+
+@routes_blueprint.route('/tasks/<int:task_id>', methods=['GET'])
+@login_required
+def task_status(task_id):
+    """JSON status of one task, polled by pages waiting on it."""
+    from .tasks import task_status as status_of
+    return jsonify(status_of(_get_task_or_404(task_id)))
+
+
+@routes_blueprint.route('/tasks/<int:task_id>/cancel', methods=['POST'])
+@login_required
+def cancel_task(task_id):
+    """Cancel a queued task, or ask a running one to stop."""
+    from .tasks import cancel, FINISHED
+    task = _get_task_or_404(task_id)
+    if task.status in FINISHED:
+        flash('That task has already finished.', 'warning')
+    else:
+        cancel(task)
+        flash('Task cancelled.' if task.status == 'cancelled' else 'The task will stop at its next checkpoint.', 'success')
+    return redirect(url_for('routes.tasks'))
+
+
+@routes_blueprint.route('/tasks/<int:task_id>/download', methods=['GET'])
+@login_required
+def download_task_result(task_id):
+    """The file a finished task produced, e.g. an export."""
+    task = _get_task_or_404(task_id)
+    if task.status != 'succeeded' or not task.result_filename:
+        abort(404)
+    response = current_app.response_class(
+        task.result_file,
+        mimetype='text/csv' if task.result_filename.endswith('.csv') else 'application/octet-stream',
+    )
+    response.headers.set('Content-Disposition', 'attachment', filename=task.result_filename)
+    return response
+
+
+@routes_blueprint.route('/tasks/export-tickets', methods=['POST'])
+@login_required
+def export_tickets():
+    """Queue a CSV export of the tickets matching the list's status/site filters."""
+    is_admin()
+    from .tasks import enqueue
+    params = {}
+    status = request.form.get('status_filter', '').strip()
+    if status:
+        params['status'] = status
+    site = request.form.get('site_filter', '')
+    if site.isdigit():
+        params['site_id'] = int(site)
+    enqueue('export_tickets', params, user_id=current_user.id)
+    flash('Ticket export queued. It will be ready to download here shortly.', 'success')
+    return redirect(url_for('routes.tasks'))
+
+
+# ****************** Request Profiles *******************************
+@routes_blueprint.route('/profiles', methods=['GET'])
+@login_required
+def request_profiles():
+    """Requests admins ran under the profiler, newest first."""
+    is_admin()
+    current_path = request.path
+    current_page_name = 'Request Profiles'
+
+    page, per_page, offset = get_page_args(page_parameter="page", per_page_parameter="per_page")
+    query = RequestProfile.query.order_by(RequestProfile.id.desc())
+    total = query.count()
+    pagination = Pagination(page=page, per_page=per_page, total=total, css_framework='bootstrap5')
+    return render_template('request_profiles.html', profiles=query.offset(offset).limit(per_page).all(),
+        pagination=pagination, per_page=per_page, total=total,
+        current_path=current_path,
+        current_page_name=current_page_name
+    )
+
+
+@routes_blueprint.route('/profiles/<int:profile_id>/download', methods=['GET'])
+@login_required
+def download_request_profile(profile_id):
+    """A profile as a .prof file (pstats format)."""
+    is_admin()
+    profile = RequestProfile.query.get_or_404(profile_id)
+    response = current_app.response_class(profile.stats, mimetype='application/octet-stream')
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename=f"profile-{profile.id}-{profile.endpoint or 'request'}.prof")
+    return response
+
+
 # *****************************************************************
 #-------------------- Site Template Pages ---------------------
 # *****************************************************************
@@ -561,7 +815,7 @@ def profile():
         if not current_password or not check_password_hash(current_user.password, current_password):
             flash('Current password is incorrect.', 'danger')
             return render_template('profile.html', user=current_user, role=current_user.role,
-                current_path=current_path, current_page_name=current_page_name)
+                current_path=current_path, current_page_name=current_page_name, digest_choices=DIGEST_CHOICES)
         # Validate new passwords
         if not password or not confirm_password:
             flash('Both password fields are required.', 'danger')
@@ -573,7 +827,7 @@ def profile():
             if not is_valid:
                 flash(error_message, 'danger')
                 return render_template('profile.html', user=current_user, role=current_user.role,
-                    current_path=current_path, current_page_name=current_page_name)
+                    current_path=current_path, current_page_name=current_page_name, digest_choices=DIGEST_CHOICES)
 
             # Password is valid, proceed with update
             current_user.password = generate_password_hash(password)
@@ -589,10 +843,32 @@ def profile():
     role = current_user.role  # Assuming current_user has a 'role' attribute
     return render_template('profile.html', user=current_user, role=role,
         current_path=current_path, 
-        current_page_name=current_page_name
+        current_page_name=current_page_name,
+        digest_choices=DIGEST_CHOICES
     )
 
 
+@routes_blueprint.route('/profile/notifications', methods=['POST'])
+@login_required
+def profile_notifications():
+    try:
+        minutes = int(request.form.get('email_digest_minutes', ''))
+    except ValueError:
+        minutes = None
+    if minutes not in dict(DIGEST_CHOICES):
+        flash('Please choose a valid email frequency.', 'danger')
+        return redirect(url_for('routes.profile'))
+    current_user.email_digest_minutes = minutes
+    try:
+        db.session.commit()
+        flash('Email preferences updated.', 'success')
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"profile email preference update failed for user {current_user.id}: {e}", exc_info=True)
+        flash('An error occurred while saving your email preferences. Please try again.', 'danger')
+    return redirect(url_for('routes.profile'))
+
+
 
 # *********************************************************************
 # ****************** Users Management Page ****************************
@@ -833,55 +1109,9 @@ def delete_user(user_id):
 
 
 
-SITE_REQUIRED = ['site_name', 'site_acronyms', 'site_cds', 'site_code', 'site_address', 'site_type']
-
-def _normalize_cds(raw):
-    """Convert Excel scientific-notation CDS codes (e.g. '1.23457E+13') to integer strings."""
-    raw = raw.strip()
-    try:
-        return str(int(float(raw)))
-    except (ValueError, OverflowError):
-        return raw
-
-
 def _process_sites_rows(rows):
     """Upsert sites from a list of CSV dicts. Returns (added, updated). Raises ValueError on bad data."""
-    added = updated = 0
-
-    # Validate all rows first (no DB interaction)
-    for i, row in enumerate(rows, start=2):
-        missing = [f for f in SITE_REQUIRED if not row.get(f, '').strip()]
-        if missing:
-            raise ValueError(f'Row {i} is missing required fields: {", ".join(missing)}')
-
-    # Pre-fetch all matching sites in one query to avoid mid-loop auto-flush
-    names = [row['site_name'].strip() for row in rows]
-    site_cache = {s.site_name: s for s in Site.query.filter(Site.site_name.in_(names)).all()}
-
-    for row in rows:
-        name = row['site_name'].strip()
-        cds  = _normalize_cds(row['site_cds'])
-        site = site_cache.get(name)
-        if site:
-            site.site_acronyms = row['site_acronyms'].strip()
-            site.site_cds      = cds
-            site.site_code     = row['site_code'].strip()
-            site.site_address  = row['site_address'].strip()
-            site.site_type     = row['site_type'].strip()
-            updated += 1
-        else:
-            new_site = Site(
-                site_name     = name,
-                site_acronyms = row['site_acronyms'].strip(),
-                site_cds      = cds,
-                site_code     = row['site_code'].strip(),
-                site_address  = row['site_address'].strip(),
-                site_type     = row['site_type'].strip(),
-            )
-            db.session.add(new_site)
-            site_cache[name] = new_site  # prevent duplicate inserts if name appears twice in CSV
-            added += 1
-    return added, updated
+    return apply_site_plan(plan_sites(rows))
 
 
 # ****************** Upload Users Page *******************************
@@ -894,6 +1124,21 @@ def upload_users():
     user_logs = BulkUploadLog.query.order_by(
         BulkUploadLog.uploaded_at.desc()
     ).paginate(page=log_page, per_page=per_page, error_out=False)
+    # Welcome email progress per log on this page: {log_id: {status: count}},
+    # and the logs whose import created users who could still be welcomed
+    onboarding = {}
+    welcome_ready = set()
+    log_ids = [log.id for log in user_logs.items]
+    if log_ids:
+        welcome_ready = {log_id for log_id, in db.session.query(User.import_log_id).filter(
+            User.import_log_id.in_(log_ids)
+        ).distinct()}
+        for log_id, status, count in db.session.query(
+            OnboardingEmail.import_log_id, OnboardingEmail.status, func.count(OnboardingEmail.id)
+        ).filter(OnboardingEmail.import_log_id.in_(log_ids)).group_by(
+            OnboardingEmail.import_log_id, OnboardingEmail.status
+        ):
+            onboarding.setdefault(log_id, {})[status] = count
     org  = db.session.get(Organization, 1)
     ftp_host_plain     = ''
     ftp_username_plain = ''
@@ -904,34 +1149,49 @@ def upload_users():
         ftp_username_plain = decrypt_mail_password(org.ftp_username_enc or '', key)
         if org.ftp_schedule_hour is not None:
             schedule_time = f"{org.ftp_schedule_hour:02d}:{org.ftp_schedule_minute or 0:02d}"
+    preview_id = request.args.get('preview', '')
+    preview = load_preview(preview_id)
+    if preview_id and preview is None:
+        flash('That import preview has expired. Please run the preview again.', 'warning')
     return render_template('bulk_upload_data.html',
                            user_logs=user_logs,
+                           onboarding=onboarding,
+                           welcome_ready=welcome_ready,
                            org=org,
                            ftp_host_plain=ftp_host_plain,
                            ftp_username_plain=ftp_username_plain,
                            ftp_schedule_time=schedule_time,
+                           preview=preview,
                            current_page_name='Bulk Data Upload')
 
 
-# ****************** Import Bulk Users *******************************
-@routes_blueprint.route('/bulk-upload-users', methods=['POST'])
-@login_required
-def bulk_upload_users():
-    is_admin()
-
+def _read_upload_files():
+    """Return the submitted CSV files (sites.csv first), or flash an error and return None."""
     files = request.files.getlist('csvFile')
     files = [f for f in files if f and f.filename]
     if not files:
         flash('No file selected.', 'danger')
-        return redirect(url_for('routes.upload_users'))
+        return None
 
     for f in files:
         if not f.filename.lower().endswith('.csv'):
             flash(f'Invalid file: {f.filename}. Only .csv files are accepted.', 'danger')
-            return redirect(url_for('routes.upload_users'))
+            return None
 
     # Process sites.csv before users.csv
     files.sort(key=lambda f: (0 if f.filename.lower() == 'sites.csv' else 1))
+    return files
+
+
+# ****************** Import Bulk Users *******************************
+@routes_blueprint.route('/bulk-upload-users', methods=['POST'])
+@login_required
+def bulk_upload_users():
+    is_admin()
+
+    files = _read_upload_files()
+    if files is None:
+        return redirect(url_for('routes.upload_users'))
 
     flash_messages = []
 
@@ -939,14 +1199,15 @@ def bulk_upload_users():
         filename = secure_filename(file.filename)
         is_sites = filename.lower() == 'sites.csv'
         added = updated = total = 0
+        chunked = False
 
         try:
-            stream = file.stream.read().decode('UTF-8')
-            rows = list(csv.DictReader(stream.splitlines()))
+            data = file.stream.read()
+            rows = parse_csv(data)
             total = len(rows)
 
             if is_sites:
-                added, updated = _process_sites_rows(rows)
+                added, updated = apply_site_plan(plan_sites(rows))
                 db.session.commit()
                 db.session.add(BulkUploadLog(
                     filename=f'[Sites] {filename}',
@@ -958,76 +1219,26 @@ def bulk_upload_users():
                 ))
                 db.session.commit()
                 flash_messages.append(f'Sites: {added} added, {updated} updated.')
+            elif current_app.config.get('IMPORT_CHUNK_SIZE'):
+                chunked = True
+                added, updated, deactivated = import_users_chunked(
+                    rows, current_app.config['SECRET_KEY'], filename, file_digest(data),
+                    current_app.config['IMPORT_CHUNK_SIZE'], current_user.id
+                )
             else:
-                # Build site lookup cache and validate all rows
-                csv_emails = set()
-                site_cache = {}
-                valid_role_ids = {r.id for r in Role.query.with_entities(Role.id).all()}
-                for row in rows:
-                    if not all([row.get('first_name'), row.get('last_name'), row.get('email'),
-                                row.get('role_id'), row.get('site_name'), row.get('rm_num')]):
-                        raise ValueError('Some rows in the CSV file are missing required fields.')
-                    raw_role_id = int(row['role_id'])
-                    if raw_role_id not in valid_role_ids:
-                        raise ValueError(f"Row for '{row.get('email')}' has invalid role_id {raw_role_id!r}.")
-                    name = row['site_name'].strip()
-                    if name not in site_cache:
-                        site = Site.query.filter_by(site_name=name).first()
-                        if not site:
-                            raise ValueError(f"Site '{name}' not found. Please verify the CSV file.")
-                        site_cache[name] = site.id
-                    csv_emails.add(row['email'].strip().lower())
-
-                # Upsert users
-                _bulk_key = current_app.config['SECRET_KEY']
-                for row in rows:
-                    site_id = site_cache[row['site_name'].strip()]
-                    raw_role_id = int(row['role_id'])
-                    existing_user = User.query.filter_by(email_hash=hash_email(row['email'].strip(), _bulk_key)).first()
-                    if existing_user:
-                        existing_user.first_name  = row['first_name']
-                        existing_user.middle_name = row.get('middle_name') or None
-                        existing_user.last_name   = row['last_name']
-                        existing_user.rm_num      = row.get('rm_num') or existing_user.rm_num
-                        existing_user.role_id     = raw_role_id
-                        existing_user.site_id     = site_id
-                        existing_user.status      = row.get('status') or 'Active'
-                        updated += 1
-                    else:
-                        db.session.add(User(
-                            first_name=row['first_name'],
-                            middle_name=row.get('middle_name') or None,
-                            last_name=row['last_name'],
-                            email=row['email'].strip(),
-                            status=row.get('status') or 'Active',
-                            password=generate_password_hash(secrets.token_urlsafe(16)),
-                            must_change_password=True,
-                            rm_num=row.get('rm_num') or None,
-                            role_id=raw_role_id,
-                            site_id=site_id
-                        ))
-                        added += 1
-
-                # Flush pending inserts/updates, then deactivate absent users.
-                # Admin accounts (role_id=1) are excluded to prevent accidental lockout.
-                db.session.flush()
-                csv_email_hashes = {hash_email(e, _bulk_key) for e in csv_emails}
-                deactivated = User.query.filter(
-                    User.status == 'Active',
-                    User.role_id != 1,
-                    ~User.email_hash.in_(csv_email_hashes)
-                ).update({'status': 'Inactive'}, synchronize_session=False)
-
-                db.session.commit()
-                db.session.add(BulkUploadLog(
+                plan = plan_users(rows, current_app.config['SECRET_KEY'])
+                log = BulkUploadLog(
                     filename=filename,
                     uploaded_by_id=current_user.id,
                     total_records=total,
-                    users_added=added,
-                    users_updated=updated,
                     status='success'
-                ))
+                )
+                db.session.add(log)
+                db.session.flush()
+                added, updated, deactivated = apply_user_plan(plan, log)
+                log.users_added, log.users_updated = added, updated
                 db.session.commit()
+            if not is_sites:
                 msg = f'Users: {added} added, {updated} updated.'
                 if deactivated:
                     msg += f' {deactivated} marked Inactive (not in file).'
@@ -1035,38 +1246,167 @@ def bulk_upload_users():
 
         except ValueError as e:
             db.session.rollback()
-            db.session.add(BulkUploadLog(
-                filename=f'[Sites] {filename}' if is_sites else filename,
-                uploaded_by_id=current_user.id,
-                total_records=total,
-                users_added=added,
-                users_updated=updated,
-                status='error',
-                error_message=str(e)
-            ))
-            db.session.commit()
+            # A chunked import records its own failure
+            if not chunked:
+                db.session.add(BulkUploadLog(
+                    filename=f'[Sites] {filename}' if is_sites else filename,
+                    uploaded_by_id=current_user.id,
+                    total_records=total,
+                    users_added=added,
+                    users_updated=updated,
+                    status='error',
+                    error_message=str(e)
+                ))
+                db.session.commit()
             flash(f'Error processing {filename}: {e}', 'danger')
             return redirect(url_for('routes.upload_users'))
         except Exception as e:
             db.session.rollback()
             current_app.logger.error(f"Bulk upload failed for {filename}: {e}", exc_info=True)
+            if not chunked:
+                db.session.add(BulkUploadLog(
+                    filename=f'[Sites] {filename}' if is_sites else filename,
+                    uploaded_by_id=current_user.id,
+                    total_records=total,
+                    users_added=added,
+                    users_updated=updated,
+                    status='error',
+                    error_message=str(e)
+                ))
+                db.session.commit()
+            # Only a chunked import that got past its first checkpoint can be resumed
+            if chunked and resumable_import_log(filename, file_digest(data)):
+                flash(f'The import of {filename} was interrupted. Upload the same file again to resume it.', 'danger')
+            else:
+                flash(f'An unexpected error occurred while processing {filename}.', 'danger')
+            return redirect(url_for('routes.upload_users'))
+
+    if flash_messages:
+        flash(' | '.join(flash_messages), 'success')
+
+    return redirect(url_for('routes.upload_users'))
+
+
+# ****************** Preview Bulk Import (dry run) *******************************
+@routes_blueprint.route('/bulk-upload-users/preview', methods=['POST'])
+@login_required
+def bulk_preview_users():
+    """Compute the change set for the uploaded CSV files without writing anything."""
+    is_admin()
+
+    files = _read_upload_files()
+    if files is None:
+        return redirect(url_for('routes.upload_users'))
+
+    site_rows = user_rows = None
+    labels = {}
+    contents = []
+    try:
+        for file in files:
+            filename = secure_filename(file.filename)
+            data = file.stream.read()
+            contents.append(filename.encode() + b'\0' + data)
+            if filename.lower() == 'sites.csv':
+                site_rows = parse_csv(data)
+                labels['sites_label'] = f'[Sites] {filename}'
+            else:
+                user_rows = parse_csv(data)
+                labels['users_label'] = filename
+        preview = build_preview(file_digest(*contents), 'upload', site_rows, user_rows,
+                                key=current_app.config['SECRET_KEY'],
+                                created_by_id=current_user.id, **labels)
+    except UnicodeDecodeError:
+        flash('Preview failed: file encoding not supported. Please save the CSV as UTF-8.', 'danger')
+        return redirect(url_for('routes.upload_users'))
+    except Exception as e:
+        current_app.logger.error(f"Bulk import preview failed: {e}", exc_info=True)
+        flash('An unexpected error occurred while previewing the import.', 'danger')
+        return redirect(url_for('routes.upload_users'))
+
+    save_preview(preview)
+    return redirect(url_for('routes.upload_users', preview=preview.digest))
+
+
+# ****************** Apply Previewed Import *******************************
+@routes_blueprint.route('/bulk-upload-users/apply/<preview_id>', methods=['POST'])
+@login_required
+def bulk_apply_preview(preview_id):
+    """Write a previously previewed change set exactly as it was shown."""
+    is_admin()
+    tab = '?tab=ftp' if request.args.get('tab') == 'ftp' else ''
+    preview = load_preview(preview_id)
+    if preview is None:
+        flash('That import preview has expired. Please run the preview again.', 'warning')
+        return redirect(url_for('routes.upload_users') + tab)
+    if not preview.is_valid:
+        flash('This import has invalid rows. Fix the file and preview it again.', 'danger')
+        return redirect(url_for('routes.upload_users', preview=preview_id))
+
+    # Claim it up front so a double-submit can't apply the same change set twice
+    if not claim_preview(preview_id):
+        flash('This import is already being applied.', 'warning')
+        return redirect(url_for('routes.upload_users') + tab)
+    messages = []
+    label = preview.sites_label or preview.users_label
+    total = 0
+    try:
+        if preview.sites:
+            total = preview.sites.total
+            added, updated = apply_site_plan(preview.sites)
             db.session.add(BulkUploadLog(
-                filename=f'[Sites] {filename}' if is_sites else filename,
+                filename=preview.sites_label,
                 uploaded_by_id=current_user.id,
                 total_records=total,
                 users_added=added,
                 users_updated=updated,
+                status='success'
+            ))
+            db.session.commit()
+            messages.append(f'Sites: {added} added, {updated} updated.')
+        if preview.users:
+            label, total = preview.users_label, preview.users.total
+            log = BulkUploadLog(
+                filename=preview.users_label,
+                uploaded_by_id=current_user.id,
+                total_records=total,
+                status='success'
+            )
+            db.session.add(log)
+            db.session.flush()
+            added, updated, deactivated = apply_user_plan(preview.users, log)
+            log.users_added, log.users_updated = added, updated
+            db.session.commit()
+            msg = f'Users: {added} added, {updated} updated.'
+            if deactivated:
+                msg += f' {deactivated} marked Inactive (not in file).'
+            messages.append(msg)
+    except Exception as e:
+        db.session.rollback()
+        if isinstance(e, IntegrityError):
+            friendly = 'The data changed since this preview was made. Please run the preview again.'
+        elif isinstance(e, ValueError):
+            friendly = str(e)
+        else:
+            current_app.logger.error(f"Applying import preview failed: {e}", exc_info=True)
+            friendly = 'An unexpected error occurred while applying the import.'
+        try:
+            db.session.add(BulkUploadLog(
+                filename=label,
+                uploaded_by_id=current_user.id,
+                total_records=total,
+                users_added=0,
+                users_updated=0,
                 status='error',
-                error_message=str(e)
+                error_message=friendly
             ))
             db.session.commit()
-            flash(f'An unexpected error occurred while processing {filename}.', 'danger')
-            return redirect(url_for('routes.upload_users'))
-
-    if flash_messages:
-        flash(' | '.join(flash_messages), 'success')
+        except Exception:
+            db.session.rollback()
+        flash(friendly, 'danger')
+        return redirect(url_for('routes.upload_users') + tab)
 
-    return redirect(url_for('routes.upload_users'))
+    flash(' | '.join(messages), 'success')
+    return redirect(url_for('routes.upload_users') + tab)
 
 
 # ****************** FTP Bulk Upload Users *******************************
@@ -1077,6 +1417,7 @@ def ftp_save_settings():
     is_admin()
     org = Organization.query.get_or_404(1)
     key = current_app.config['SECRET_KEY']
+    previous_source = _saved_ftp_source(org, key)
 
     # --- Credentials ---
     raw_host = re.sub(r'^ftps?://', '', request.form.get('ftp_host', '').strip(), flags=re.IGNORECASE)
@@ -1091,6 +1432,9 @@ def ftp_save_settings():
     org.ftp_port    = int(request.form.get('ftp_port') or 21)
     org.ftp_path    = request.form.get('ftp_path', '').strip() or None
     org.ftp_use_tls = request.form.get('ftp_use_tls') == 'on'
+    if _saved_ftp_source(org, key) != previous_source:
+        # The saved fingerprints describe files on the old server or folder
+        org.ftp_sites_fingerprint = org.ftp_users_fingerprint = None
 
     # --- Schedule ---
     schedule_enabled = request.form.get('ftp_schedule_enabled') == 'on'
@@ -1119,26 +1463,10 @@ def ftp_save_settings():
     db.session.add(org)
     db.session.commit()
 
-    # Sync APScheduler job (non-fatal if scheduler unavailable)
-    try:
-        from application.scheduled_jobs import run_org_ftp_schedule
-        if schedule_enabled and org.ftp_schedule_hour is not None:
-            scheduler.add_job(
-                id='org_ftp_schedule',
-                func=run_org_ftp_schedule,
-                trigger='cron',
-                day_of_week=org.ftp_schedule_days,
-                hour=org.ftp_schedule_hour,
-                minute=org.ftp_schedule_minute,
-                replace_existing=True
-            )
-        else:
-            try:
-                scheduler.remove_job('org_ftp_schedule')
-            except Exception:
-                pass
-    except Exception:
-        pass
+    # Sync the APScheduler job (non-fatal if scheduler unavailable). With the
+    # database job store this reaches the leader, whichever worker saved it.
+    from main import _register_org_ftp_schedule
+    _register_org_ftp_schedule()
 
     if schedule_enabled:
         flash('FTP settings and schedule saved.', 'success')
@@ -1156,11 +1484,14 @@ def ftp_save_settings():
     return redirect(url_for('routes.upload_users') + '?tab=ftp')
 
 
-@routes_blueprint.route('/ftp-upload-users', methods=['POST'])
-@login_required
-def ftp_bulk_upload_users():
-    is_admin()
+def _ftp_form_credentials():
+    """
+    Resolve FTP connection details from the submitted form, falling back to the
+    saved (encrypted) Organization settings for blank fields.
 
+    Returns (host, port, username, password, ftp_dir, use_tls), or None after
+    flashing an error.
+    """
     ftp_host     = re.sub(r'^ftps?://', '', request.form.get('ftp_host', '').strip(), flags=re.IGNORECASE)
     ftp_port     = request.form.get('ftp_port', '21').strip()
     ftp_username = request.form.get('ftp_username', '').strip()
@@ -1184,40 +1515,68 @@ def ftp_bulk_upload_users():
 
     if not all([ftp_host, ftp_username, ftp_path]):
         flash('FTP host, username, and remote directory are required.', 'danger')
-        return redirect(url_for('routes.upload_users') + '?tab=ftp')
+        return None
 
     try:
         port = int(ftp_port)
     except ValueError:
         flash('FTP port must be a valid number.', 'danger')
-        return redirect(url_for('routes.upload_users') + '?tab=ftp')
+        return None
+
+    return ftp_host, port, ftp_username, ftp_password, normalize_ftp_dir(ftp_path), use_tls
+
 
-    # Normalise: if the stored path still has a .csv filename (old format), strip it
-    if ftp_path.lower().endswith('.csv'):
-        import posixpath as _pp
-        ftp_path = _pp.dirname(ftp_path)
-    ftp_dir = ftp_path.rstrip('/')
-    users_path = f'{ftp_dir}/users.csv'
-    sites_path = f'{ftp_dir}/sites.csv'
+def _saved_ftp_source(org, key):
+    """(host, port, remote directory) of the Organization's saved FTP settings."""
+    host = decrypt_mail_password(org.ftp_host_enc or '', key)
+    return host.lower(), org.ftp_port or 21, normalize_ftp_dir(org.ftp_path or '')
+
+
+def _ftp_error_message(e, ftp_host, port):
+    """Translate an FTP/socket/CSV error into a message an admin can act on."""
+    if isinstance(e, socket.gaierror):
+        return f"Cannot reach FTP host '{ftp_host}'. Check that the hostname is correct and the server is reachable."
+    if isinstance(e, ConnectionRefusedError):
+        return f"Connection refused by '{ftp_host}:{port}'. Check the port number and that the FTP service is running."
+    if isinstance(e, TimeoutError):
+        return f"Connection to '{ftp_host}' timed out. The server may be down or blocked by a firewall."
+    if isinstance(e, ftplib.error_perm):
+        if any(code in str(e) for code in ('530', '331', '332')):
+            return 'FTP login failed. Check your username and password.'
+        return f'FTP error: {e}'
+    return str(e)
+
+
+@routes_blueprint.route('/ftp-upload-users', methods=['POST'])
+@login_required
+def ftp_bulk_upload_users():
+    is_admin()
+
+    creds = _ftp_form_credentials()
+    if creds is None:
+        return redirect(url_for('routes.upload_users') + '?tab=ftp')
+    ftp_host, port = creds[0], creds[1]
+    key = current_app.config['SECRET_KEY']
 
     users_added = users_updated = total_records = 0
     sites_added = sites_updated = sites_total = 0
+    chunk_size = current_app.config.get('IMPORT_CHUNK_SIZE')
+    chunked = False
 
     try:
-        ftp = ftplib.FTP_TLS() if use_tls else ftplib.FTP()
-        ftp.connect(ftp_host, port, timeout=30)
-        ftp.login(ftp_username, ftp_password)
-        if use_tls:
-            ftp.prot_p()
-
-        # --- Download and process sites.csv first ---
-        sites_buf = io.BytesIO()
-        try:
-            ftp.retrbinary(f'RETR {sites_path}', sites_buf.write)
-            sites_buf.seek(0)
-            site_rows   = list(csv.DictReader(sites_buf.read().decode('utf-8').splitlines()))
+        sites_file, users_file = download_roster(*creds)
+        org = db.session.get(Organization, 1)
+        # The scheduled import compares the saved server's files with these
+        # fingerprints; a roster fetched from anywhere else clears them instead
+        from_saved_source = org and (ftp_host.lower(), port, creds[4]) == _saved_ftp_source(org, key)
+
+        # --- Process sites.csv first ---
+        if sites_file is not None:
+            site_rows   = parse_csv(sites_file.data)
             sites_total = len(site_rows)
-            sites_added, sites_updated = _process_sites_rows(site_rows)
+            sites_added, sites_updated = apply_site_plan(plan_sites(site_rows))
+            if org:
+                org.ftp_sites_fingerprint = sites_file.fingerprint if from_saved_source else None
             db.session.commit()
             db.session.add(BulkUploadLog(
                 filename='[FTP Sites] sites.csv',
@@ -1228,81 +1587,29 @@ def ftp_bulk_upload_users():
                 status='success'
             ))
             db.session.commit()
-        except ftplib.error_perm:
-            pass  # sites.csv not found on server — skip silently
-
-        # --- Download and process users.csv ---
-        user_buf = io.BytesIO()
-        ftp.retrbinary(f'RETR {users_path}', user_buf.write)
-        ftp.quit()
 
-        user_buf.seek(0)
-        rows = list(csv.DictReader(user_buf.read().decode('UTF-8').splitlines()))
+        # --- Process users.csv ---
+        rows = parse_csv(users_file.data)
         total_records = len(rows)
-
-        # First pass: validate all rows and collect emails
-        csv_emails = set()
-        valid_role_ids = {r.id for r in Role.query.with_entities(Role.id).all()}
-        for row in rows:
-            if not all([row.get('first_name'), row.get('last_name'), row.get('email'),
-                        row.get('role_id'), row.get('site_name'), row.get('rm_num')]):
-                raise ValueError('Some rows in the CSV file are missing required fields.')
-            raw_role_id = int(row['role_id'])
-            if raw_role_id not in valid_role_ids:
-                raise ValueError(f"Row for '{row.get('email')}' has invalid role_id {raw_role_id!r}.")
-            site = Site.query.filter_by(site_name=row['site_name']).first()
-            if not site:
-                raise ValueError(f"Site '{row['site_name']}' not found. Please verify the CSV file.")
-            csv_emails.add(row['email'].strip().lower())
-
-        # Second pass: upsert users
-        for row in rows:
-            raw_role_id = int(row['role_id'])
-            site = Site.query.filter_by(site_name=row['site_name']).first()
-            existing_user = User.query.filter_by(email_hash=hash_email(row['email'].strip(), key)).first()
-            if existing_user:
-                existing_user.first_name  = row['first_name']
-                existing_user.middle_name = row.get('middle_name') or None
-                existing_user.last_name   = row['last_name']
-                existing_user.rm_num      = row.get('rm_num') or existing_user.rm_num
-                existing_user.role_id     = raw_role_id
-                existing_user.site_id     = site.id
-                existing_user.status      = row.get('status') or 'Active'
-                users_updated += 1
-            else:
-                db.session.add(User(
-                    first_name=row['first_name'],
-                    middle_name=row.get('middle_name', None),
-                    last_name=row['last_name'],
-                    email=row['email'].strip(),
-                    status=row.get('status', 'Active'),
-                    password=generate_password_hash(secrets.token_urlsafe(16)),
-                    must_change_password=True,
-                    rm_num=row.get('rm_num', None),
-                    role_id=raw_role_id,
-                    site_id=site.id
-                ))
-                users_added += 1
-
-        # Third pass: deactivate users absent from the CSV.
-        # Admin accounts (role_id=1) are excluded to prevent accidental lockout.
-        users_deactivated = 0
-        ftp_csv_hashes = {hash_email(e, key) for e in csv_emails}
-        for user in User.query.filter(User.status == 'Active', User.role_id != 1).all():
-            if user.email_hash not in ftp_csv_hashes:
-                user.status = 'Inactive'
-                users_deactivated += 1
-
-        db.session.commit()
-
-        db.session.add(BulkUploadLog(
-            filename='[FTP] users.csv',
-            uploaded_by_id=current_user.id,
-            total_records=total_records,
-            users_added=users_added,
-            users_updated=users_updated,
-            status='success'
-        ))
+        if chunk_size:
+            chunked = True
+            users_added, users_updated, users_deactivated = import_users_chunked(
+                rows, key, '[FTP] users.csv', file_digest(users_file.data), chunk_size, current_user.id
+            )
+        else:
+            log = BulkUploadLog(
+                filename='[FTP] users.csv',
+                uploaded_by_id=current_user.id,
+                total_records=total_records,
+                status='success'
+            )
+            db.session.add(log)
+            db.session.flush()
+            users_added, users_updated, users_deactivated = apply_user_plan(plan_users(rows, key), log)
+            log.users_added, log.users_updated = users_added, users_updated
+        # Remember what was imported so the scheduled job can skip an unchanged file
+        if org:
+            org.ftp_users_fingerprint = users_file.fingerprint if from_saved_source else None
         db.session.commit()
 
         msg = f'FTP import successful: {users_added} users added, {users_updated} updated.'
@@ -1314,33 +1621,21 @@ def ftp_bulk_upload_users():
 
     except (ftplib.Error, OSError, EOFError, UnicodeDecodeError, ValueError) as e:
         db.session.rollback()
-        if isinstance(e, socket.gaierror):
-            friendly = f"Cannot reach FTP host '{ftp_host}'. Check that the hostname is correct and the server is reachable."
-        elif isinstance(e, ConnectionRefusedError):
-            friendly = f"Connection refused by '{ftp_host}:{port}'. Check the port number and that the FTP service is running."
-        elif isinstance(e, TimeoutError):
-            friendly = f"Connection to '{ftp_host}' timed out. The server may be down or blocked by a firewall."
-        elif isinstance(e, ftplib.error_perm):
-            msg_lower = str(e)
-            if any(code in msg_lower for code in ('530', '331', '332')):
-                friendly = 'FTP login failed. Check your username and password.'
-            else:
-                friendly = f'FTP error: {e}'
-        else:
-            friendly = str(e)
-        try:
-            db.session.add(BulkUploadLog(
-                filename='[FTP] users.csv',
-                uploaded_by_id=current_user.id,
-                total_records=total_records,
-                users_added=users_added,
-                users_updated=users_updated,
-                status='error',
-                error_message=friendly
-            ))
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
+        friendly = _ftp_error_message(e, ftp_host, port)
+        if not chunked:  # a chunked import records its own failure
+            try:
+                db.session.add(BulkUploadLog(
+                    filename='[FTP] users.csv',
+                    uploaded_by_id=current_user.id,
+                    total_records=total_records,
+                    users_added=users_added,
+                    users_updated=users_updated,
+                    status='error',
+                    error_message=friendly
+                ))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
         flash(friendly, 'danger')
 
     except Exception as e:
@@ -1351,6 +1646,38 @@ def ftp_bulk_upload_users():
     return redirect(url_for('routes.upload_users'))
 
 
+@routes_blueprint.route('/ftp-upload-users/preview', methods=['POST'])
+@login_required
+def ftp_preview_users():
+    """Download the FTP roster and compute its change set without writing anything."""
+    is_admin()
+
+    creds = _ftp_form_credentials()
+    if creds is None:
+        return redirect(url_for('routes.upload_users') + '?tab=ftp')
+    ftp_host, port = creds[0], creds[1]
+
+    try:
+        sites_file, users_file = download_roster(*creds)
+        site_rows = parse_csv(sites_file.data) if sites_file is not None else None
+        digest = file_digest(sites_file.data if sites_file else b'', b'\0', users_file.data)
+        preview = build_preview(digest, 'ftp', site_rows, parse_csv(users_file.data),
+                                key=current_app.config['SECRET_KEY'],
+                                created_by_id=current_user.id,
+                                sites_label='[FTP Sites] sites.csv',
+                                users_label='[FTP] users.csv')
+    except (ftplib.Error, OSError, EOFError, UnicodeDecodeError, ValueError) as e:
+        flash(_ftp_error_message(e, ftp_host, port), 'danger')
+        return redirect(url_for('routes.upload_users') + '?tab=ftp')
+    except Exception as e:
+        current_app.logger.error(f'FTP import preview unexpected error: {e}', exc_info=True)
+        flash('An unexpected error occurred while previewing the FTP import.', 'danger')
+        return redirect(url_for('routes.upload_users') + '?tab=ftp')
+
+    save_preview(preview)
+    return redirect(url_for('routes.upload_users', preview=preview.digest, tab='ftp'))
+
+
 # ****************** Bulk Upload Sites (CSV) *******************************
 @routes_blueprint.route('/bulk-upload-sites', methods=['POST'])
 @login_required
@@ -1438,6 +1765,32 @@ def bulk_upload_sites():
     return redirect(url_for('routes.upload_users') + '?tab=sites')
 
 
+# ****************** Welcome Emails for Imported Users *******************************
+@routes_blueprint.route('/bulk-upload-log/<int:log_id>/welcome-emails', methods=['POST'])
+@login_required
+def queue_welcome_emails(log_id):
+    is_admin()
+    log = BulkUploadLog.query.get_or_404(log_id)
+    org = db.session.get(Organization, 1)
+    if not (org and org.mail_server and org.mail_username):
+        flash('Save your SMTP settings before sending welcome emails.', 'warning')
+        return redirect(url_for('routes.upload_users'))
+    try:
+        queued = queue_onboarding_emails(log)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Queueing welcome emails for upload log {log_id} failed: {e}", exc_info=True)
+        flash('An error occurred while queueing the welcome emails.', 'danger')
+        return redirect(url_for('routes.upload_users'))
+    if queued:
+        flash(f'{queued} welcome email(s) queued. They are sent in the background, '
+              f'up to {current_app.config["ONBOARDING_EMAILS_PER_MINUTE"]} per minute.', 'success')
+    else:
+        flash('No new users from this import are waiting for a welcome email.', 'info')
+    return redirect(url_for('routes.upload_users'))
+
+
 # *********************************************************************
 # ****************** Role Management Page *******************************
 @routes_blueprint.route('/roles')
@@ -1935,44 +2288,19 @@ def add_ticket():
     # Handle file upload
         uploaded_file = request.files.get('attachment')
         if uploaded_file and uploaded_file.filename:
-            is_valid, error_message = validate_file_upload(uploaded_file)
+            is_valid, error_message = validate_file_upload(uploaded_file, max_size_mb=current_app.config['ATTACHMENT_MAX_SIZE_MB'])
             if not is_valid:
                 flash(error_message, 'error')
                 return redirect(request.url)
 
-            file_ext = os.path.splitext(uploaded_file.filename)[1].lower()
-            # Generate a unique filename
-            new_filename = f"ticket_{ticket.id}_{datetime.now().strftime('%Y%m%d-%H%M%S')}{file_ext}"
-            filename = secure_filename(new_filename)
-            upload_folder = current_app.config['UPLOAD_ATTACHMENT']
-            os.makedirs(upload_folder, exist_ok=True)
-            filepath = os.path.join(upload_folder, filename)
-
-            # Save the file to disk
-            uploaded_file.save(filepath)
-
-            # Verify the file was saved correctly
-            if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
-                flash('Failed to save attachment (empty file)', 'error')
+            # Stored by content hash; identical files are kept only once
+            try:
+                add_attachment(ticket, uploaded_file, current_user.id)
+            except OSError as e:
+                current_app.logger.error(f"File save failed for new ticket: {e}", exc_info=True)
+                flash('Failed to save attachment. Please try again.', 'error')
                 return redirect(request.url)
 
-            # Check if this attachment already exists (prevent duplicates)
-            existing_attachment = Ticket_attachment.query.filter_by(
-                ticket_id=ticket.id,
-                attach_image=filename
-            ).first()
-
-            if not existing_attachment:  # Only add if it doesn't exist
-                new_attachment = Ticket_attachment(
-                    ticket_id=ticket.id,
-                    attach_image=filename,
-                    uploaded_at=datetime.now(timezone.utc),
-                    user_id=current_user.id
-                )
-                db.session.add(new_attachment)
-            else:
-                flash('This attachment already exists.', 'warning')
-
         # Add initial comment (if any)
         initial_comment = request.form.get('initial_comment')
         if initial_comment:
@@ -1984,9 +2312,9 @@ def add_ticket():
             )
             db.session.add(new_content)
 
-        # Commit all changes at once
+        # Commit all changes (and the queued notification) at once
+        queue_ticket_notification('created', ticket, initial_comment=initial_comment or '')
         db.session.commit()
-        send_ticket_notification('created', ticket, initial_comment=initial_comment or '')
         flash('Ticket created successfully!', 'success')
         return redirect(url_for('routes.tickets'))
     
@@ -2007,16 +2335,52 @@ def download_attachment(attachment_id):
     if not can_access_ticket(ticket):
         abort(403)
 
-    filename = attachment.attach_image.split('/')[-1]
-    upload_folder = current_app.config['UPLOAD_ATTACHMENT']
-
-    file_path = os.path.join(upload_folder, filename)
-    if not os.path.exists(file_path):
-        current_app.logger.error(f"Attachment not found at: {file_path}")
+    response = send_attachment(attachment)
+    if response is None:
+        current_app.logger.error(f"Attachment file not found for attachment {attachment.id}")
         flash('File not found.', 'error')
         return redirect(url_for('routes.tickets'))
 
-    return send_from_directory(upload_folder, filename, as_attachment=True)
+    return response
+
+
+# ****************** Download All Attachments *******************************
+@routes_blueprint.route('/download_attachments/<int:ticket_id>')
+@login_required
+def download_all_attachments(ticket_id):
+    ticket = Ticket.query.get_or_404(ticket_id)
+
+    # One access check covers every file in the archive
+    if not can_access_ticket(ticket):
+        abort(403)
+
+    entries = zip_entries(ticket)
+    if not entries:
+        flash('This ticket has no attachments.', 'warning')
+        return redirect(url_for('routes.edit_ticket', ticket_id=ticket_id))
+
+    response = current_app.response_class(
+        stream_with_context(iter_attachments_zip(entries)), mimetype='application/zip'
+    )
+    response.headers.set('Content-Disposition', 'attachment', filename=f'ticket_{ticket_id}_attachments.zip')
+    return response
+
+
+# ****************** Attachment Thumbnail *******************************
+@routes_blueprint.route('/attachment_thumbnail/<int:attachment_id>')
+@login_required
+@limiter.exempt  # a ticket page can show many; each response is cached for a year
+def attachment_thumbnail(attachment_id):
+    attachment = Ticket_attachment.query.get_or_404(attachment_id)
+    ticket = Ticket.query.get_or_404(attachment.ticket_id)
+
+    if not can_access_ticket(ticket):
+        abort(403)
+
+    response = send_thumbnail(attachment)
+    if response is None:
+        abort(404)
+    return response
 
 
 # ****************** Delete attachment Page *******************************
@@ -2041,23 +2405,9 @@ def delete_attachment(attachment_id):
         return redirect(url_for('routes.edit_ticket', ticket_id=ticket_id))
     
     try:
-        # Get filename for file deletion
-        if '/' in attachment.attach_image:
-            filename = attachment.attach_image.split('/')[-1]
-        else:
-            filename = attachment.attach_image
-        
-        # Get filepath
-        file_path = os.path.join(current_app.config['UPLOAD_ATTACHMENT'], filename)
-        current_app.logger.debug(f"Attempting to delete file: {file_path}")
-        
-        # Delete physical file if it exists
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            current_app.logger.info(f"File deleted successfully: {file_path}")
-        
-        # Delete database record
-        db.session.delete(attachment)
+        # Delete database record; the file is removed later by the
+        # attachment sweeper once no other attachment shares its content
+        release_attachment(attachment)
         ticket.updated_at = datetime.now(timezone.utc)  # Update ticket timestamp
         db.session.commit()
         current_app.logger.info(f"Attachment {attachment_id} deleted from database")
@@ -2080,7 +2430,10 @@ def edit_ticket(ticket_id):
     current_path = request.path
     current_page_name = 'Manage Ticket'
 
-    ticket = Ticket.query.options(db.joinedload(Ticket.contents)).get_or_404(ticket_id)
+    ticket = Ticket.query.options(
+        db.joinedload(Ticket.contents),
+        db.selectinload(Ticket.attachments).joinedload(Ticket_attachment.blob),
+    ).get_or_404(ticket_id)
 
     # Permission check
     if not can_access_ticket(ticket):
@@ -2129,40 +2482,20 @@ def edit_ticket(ticket_id):
         # Handle file upload
         uploaded_file = request.files.get('attachment')
         if uploaded_file and uploaded_file.filename != '':
-            is_valid, error_message = validate_file_upload(uploaded_file)
+            is_valid, error_message = validate_file_upload(uploaded_file, max_size_mb=current_app.config['ATTACHMENT_MAX_SIZE_MB'])
             if not is_valid:
                 flash(error_message, 'error')
                 return redirect(request.url)
 
-            file_ext = os.path.splitext(uploaded_file.filename)[1].lower()
-            # Create filename with ticket ID
-            new_filename = f"ticket_{ticket.id}_{datetime.now().strftime('%Y%m%d-%H%M%S')}{file_ext}"
-            filename = secure_filename(new_filename)
-            upload_folder = current_app.config['UPLOAD_ATTACHMENT']
-            os.makedirs(upload_folder, exist_ok=True)
-            filepath = os.path.join(upload_folder, filename)
-            
             try:
-                uploaded_file.save(filepath)
-                # Verify file was saved
-                if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
-                    raise Exception("File saved as 0 bytes")
-                    
-                new_attachment = Ticket_attachment(
-                    ticket_id=ticket.id,
-                    attach_image=filename,
-                    uploaded_at=datetime.now(timezone.utc),
-                    user_id=current_user.id
-                )
-                db.session.add(new_attachment)
-                changes_made = True
-                flash('Attachment added successfully!', 'success')
-                
+                if add_attachment(ticket, uploaded_file, current_user.id):
+                    changes_made = True
+                    flash('Attachment added successfully!', 'success')
+                else:
+                    flash('This attachment already exists.', 'warning')
             except Exception as e:
                 current_app.logger.error(f"File save failed for ticket {ticket.id}: {e}", exc_info=True)
                 flash('Failed to save attachment. Please try again.', 'danger')
-                if os.path.exists(filepath):
-                    os.remove(filepath)
                 return redirect(request.url)
 
         # Add ticket contents (text-based)
@@ -2182,21 +2515,23 @@ def edit_ticket(ticket_id):
         if changes_made:
             ticket.updated_at = datetime.now(timezone.utc)
             db.session.add(ticket)
-            db.session.commit()
+            db.session.flush()
+            db.session.expire(ticket)  # reload assignee/title from the flushed row
 
-            # Send email notifications for each change
+            # Queue email notifications for each change in the same transaction
             if ticket.tck_status != old_status:
-                send_ticket_notification('status', ticket,
-                                         old_status=old_status,
-                                         new_status=ticket.tck_status)
+                queue_ticket_notification('status', ticket,
+                                          old_status=old_status,
+                                          new_status=ticket.tck_status)
             if ticket.assigned_to_id != old_assigned_to_id:
                 new_assignee = db.session.get(User, ticket.assigned_to_id) if ticket.assigned_to_id else None
-                send_ticket_notification('assigned', ticket, new_assignee=new_assignee)
+                queue_ticket_notification('assigned', ticket, new_assignee=new_assignee)
             if bool(ticket.escalated) != old_escalated:
-                send_ticket_notification('escalated', ticket, escalated=bool(ticket.escalated))
+                queue_ticket_notification('escalated', ticket, escalated=bool(ticket.escalated))
             if new_comments:
-                send_ticket_notification('comment', ticket, commenter=current_user,
-                                         comment_text=new_comments[-1].content)
+                queue_ticket_notification('comment', ticket, commenter=current_user,
+                                          comment_text=new_comments[-1].content)
+            db.session.commit()
 
             flash('Ticket updated successfully!', 'success')
         else:
@@ -2234,14 +2569,13 @@ def add_comment(ticket_id):
         )
         db.session.add(comment)
         ticket.updated_at = datetime.now(timezone.utc)
+        queue_ticket_notification('comment', ticket, commenter=current_user, comment_text=content)
         db.session.commit()
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"add_comment failed: {e}")
         return jsonify({'success': False, 'message': 'Database error saving comment'}), 500
 
-    send_ticket_notification('comment', ticket, commenter=current_user, comment_text=content)
-
     return jsonify({
         'success': True,
         'comment': {
@@ -2267,29 +2601,10 @@ def delete_ticket(ticket_id):
         attachments = Ticket_attachment.query.filter_by(ticket_id=ticket_id).all()
         current_app.logger.debug(f"Found {len(attachments)} attachments to delete for ticket {ticket_id}")
 
+        # Drop the attachment rows; the attachment sweeper removes their
+        # files once no other ticket shares the same content
         for attachment in attachments:
-            if attachment.attach_image:
-                # Extract filename safely
-                filename = attachment.attach_image.split('/')[-1] if '/' in attachment.attach_image else attachment.attach_image
-                
-                # Construct full file path
-                file_path = os.path.join(current_app.config['UPLOAD_ATTACHMENT'], filename)
-                current_app.logger.debug(f"Attempting to delete file: {file_path}")
-                
-                # Verify and delete file
-                if os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                        current_app.logger.info(f"File deleted successfully: {file_path}")
-                    except OSError as e:
-                        current_app.logger.error(f"Error deleting file {file_path}: {str(e)}")
-                        raise  # Re-raise to trigger rollback
-                else:
-                    current_app.logger.warning(f"File not found: {file_path} (may have been deleted already)")
-                
-                # Delete attachment record
-                db.session.delete(attachment)
-                current_app.logger.debug(f"Attachment {attachment.id} marked for deletion")
+            release_attachment(attachment)
 
         # Delete the ticket
         db.session.delete(ticket)
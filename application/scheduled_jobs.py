@@ -2,74 +2,73 @@
 Background job functions for APScheduler.
 Each function runs inside a Flask application context pushed explicitly.
 """
-import ftplib
-import io
-import csv
-import secrets
 import logging
 from datetime import datetime, timezone
 
+from application.job_runs import track_run
+from application.scheduler_lock import leader_only
+
 logger = logging.getLogger(__name__)
 
 
+@leader_only
 def run_org_ftp_schedule():
     """Scheduled FTP import: downloads sites.csv then users CSV using credentials from Organization."""
     from main import db, scheduler
 
-    with scheduler.app.app_context():
+    with scheduler.app.app_context(), track_run('org_ftp_schedule', trace_memory=True) as run:
         from flask import current_app
-        from application.models import Organization, BulkUploadLog, User, Site, Role
-        from application.utils import decrypt_mail_password, hash_email
-        from application.routes import _process_sites_rows
-        from werkzeug.security import generate_password_hash
+        from application.models import Organization, BulkUploadLog
+        from application.utils import decrypt_mail_password
+        from application.import_engine import (plan_sites, apply_site_plan, plan_users, apply_user_plan,
+                                               import_users_chunked, parse_csv, file_digest,
+                                               download_roster, normalize_ftp_dir)
 
         org = db.session.get(Organization, 1)
         if not org or not org.ftp_schedule_enabled:
+            run.outcome = 'skipped'
             return
 
         today = datetime.now(timezone.utc).date()
         if org.ftp_schedule_start_date and today < org.ftp_schedule_start_date:
             logger.info('Scheduled FTP import skipped: before start date (%s).', org.ftp_schedule_start_date)
+            run.outcome = 'skipped'
             return
         if org.ftp_schedule_stop_date and today > org.ftp_schedule_stop_date:
             logger.info('Scheduled FTP import skipped: past stop date (%s).', org.ftp_schedule_stop_date)
+            run.outcome = 'skipped'
             return
 
         key      = current_app.config['SECRET_KEY']
         ftp_host = decrypt_mail_password(org.ftp_host_enc or '', key)
         username = decrypt_mail_password(org.ftp_username_enc or '', key)
         password = decrypt_mail_password(org.ftp_password_enc or '', key)
-        raw_path = org.ftp_path or ''
-        if raw_path.lower().endswith('.csv'):
-            import posixpath as _pp
-            raw_path = _pp.dirname(raw_path)
-        ftp_dir  = raw_path.rstrip('/')
+        ftp_dir  = normalize_ftp_dir(org.ftp_path)
         port     = org.ftp_port or 21
         use_tls  = bool(org.ftp_use_tls)
 
         if not all([ftp_host, username, ftp_dir]):
             logger.warning('Scheduled FTP import skipped: incomplete credentials in Organization.')
+            run.outcome = 'skipped'
             return
 
-        users_path = f'{ftp_dir}/users.csv'
-        sites_path = f'{ftp_dir}/sites.csv'
         users_added   = users_updated = total_records = 0
-        sites_added   = sites_updated = 0
+        sites_added   = sites_updated = site_records = 0
+        chunk_size    = current_app.config.get('IMPORT_CHUNK_SIZE')
+        chunked       = False
 
         try:
-            ftp = ftplib.FTP_TLS() if use_tls else ftplib.FTP()
-            ftp.connect(ftp_host, port, timeout=30)
-            ftp.login(username, password)
-            if use_tls:
-                ftp.prot_p()
+            sites_file, users_file = download_roster(
+                ftp_host, port, username, password, ftp_dir, use_tls,
+                known=(org.ftp_sites_fingerprint, org.ftp_users_fingerprint)
+            )
 
             # --- sites.csv (optional) ---
-            sites_buf = io.BytesIO()
-            try:
-                ftp.retrbinary(f'RETR {sites_path}', sites_buf.write)
-                sites_buf.seek(0)
-                site_rows   = list(csv.DictReader(sites_buf.read().decode('utf-8').splitlines()))
-                sites_added, sites_updated = _process_sites_rows(site_rows)
+            if sites_file is not None and not sites_file.unchanged:
+                site_rows   = parse_csv(sites_file.data)
+                site_records = len(site_rows)
+                sites_added, sites_updated = apply_site_plan(plan_sites(site_rows))
+                org.ftp_sites_fingerprint = sites_file.fingerprint
                 db.session.commit()
                 db.session.add(BulkUploadLog(
                     filename='[Sites] [Scheduled] sites.csv',
@@ -79,81 +78,50 @@ def run_org_ftp_schedule():
                     status='success'
                 ))
                 db.session.commit()
-            except ftplib.error_perm:
-                pass  # sites.csv absent — skip
+            elif sites_file is not None:
+                org.ftp_sites_fingerprint = sites_file.fingerprint  # may carry a newer MDTM
 
             # --- users.csv ---
-            user_buf = io.BytesIO()
-            ftp.retrbinary(f'RETR {users_path}', user_buf.write)
-            ftp.quit()
+            if users_file.unchanged:
+                org.ftp_users_fingerprint = users_file.fingerprint
+                org.ftp_last_run_at     = datetime.now(timezone.utc)
+                org.ftp_last_run_status = 'success'
+                db.session.add(BulkUploadLog(
+                    filename='[FTP] [Scheduled] users.csv',
+                    status='unchanged',
+                    error_message='No changes since the last successful import.'
+                ))
+                db.session.commit()
+                logger.info('Scheduled FTP import: users.csv unchanged since last import, skipped.')
+                run.outcome = 'skipped'
+                run.rows_processed = site_records
+                return
 
-            user_buf.seek(0)
-            rows = list(csv.DictReader(user_buf.read().decode('UTF-8').splitlines()))
+            rows = parse_csv(users_file.data)
             total_records = len(rows)
-
-            # First pass: validate all rows and collect emails
-            csv_emails = set()
-            valid_role_ids = {r.id for r in Role.query.with_entities(Role.id).all()}
-            for row in rows:
-                if not all([row.get('first_name'), row.get('last_name'), row.get('email'),
-                            row.get('role_id'), row.get('site_name'), row.get('rm_num')]):
-                    raise ValueError('Some rows are missing required fields.')
-                raw_role_id = int(row['role_id'])
-                if raw_role_id not in valid_role_ids:
-                    raise ValueError(f"Row for '{row.get('email')}' has invalid role_id {raw_role_id!r}.")
-                site = Site.query.filter_by(site_name=row['site_name']).first()
-                if not site:
-                    raise ValueError(f"Site '{row['site_name']}' not found.")
-                csv_emails.add(row['email'].strip().lower())
-
-            # Second pass: upsert users
-            for row in rows:
-                raw_role_id = int(row['role_id'])
-                site = Site.query.filter_by(site_name=row['site_name']).first()
-                existing = User.query.filter_by(email_hash=hash_email(row['email'].strip(), key)).first()
-                if existing:
-                    existing.first_name  = row['first_name']
-                    existing.middle_name = row.get('middle_name') or None
-                    existing.last_name   = row['last_name']
-                    existing.rm_num      = row.get('rm_num') or existing.rm_num
-                    existing.role_id     = raw_role_id
-                    existing.site_id     = site.id
-                    existing.status      = row.get('status') or 'Active'
-                    users_updated += 1
-                else:
-                    db.session.add(User(
-                        first_name=row['first_name'],
-                        middle_name=row.get('middle_name'),
-                        last_name=row['last_name'],
-                        email=row['email'].strip(),
-                        status=row.get('status', 'Active'),
-                        password=generate_password_hash(secrets.token_urlsafe(16)),
-                        must_change_password=True,
-                        rm_num=row.get('rm_num'),
-                        role_id=raw_role_id,
-                        site_id=site.id
-                    ))
-                    users_added += 1
-
-            # Third pass: deactivate users absent from the CSV.
-            # Admin accounts (role_id=1) are excluded to prevent accidental lockout.
-            sched_csv_hashes = {hash_email(e, key) for e in csv_emails}
-            for user in User.query.filter(User.status == 'Active', User.role_id != 1).all():
-                if user.email_hash not in sched_csv_hashes:
-                    user.status = 'Inactive'
-
+            if chunk_size:
+                # Resumes from the checkpoint if the previous run of this file was interrupted
+                chunked = True
+                users_added, users_updated, _ = import_users_chunked(
+                    rows, key, '[FTP] [Scheduled] users.csv', file_digest(users_file.data), chunk_size
+                )
+            else:
+                log = BulkUploadLog(
+                    filename='[FTP] [Scheduled] users.csv',
+                    total_records=total_records,
+                    status='success'
+                )
+                db.session.add(log)
+                db.session.flush()
+                users_added, users_updated, _ = apply_user_plan(plan_users(rows, key), log)
+                log.users_added, log.users_updated = users_added, users_updated
+            org.ftp_users_fingerprint = users_file.fingerprint
             db.session.commit()
 
             org.ftp_last_run_at     = datetime.now(timezone.utc)
             org.ftp_last_run_status = 'success'
             db.session.add(org)
-            db.session.add(BulkUploadLog(
-                filename='[FTP] [Scheduled] users.csv',
-                total_records=total_records,
-                users_added=users_added,
-                users_updated=users_updated,
-                status='success'
-            ))
+            run.rows_processed = site_records + total_records
             db.session.commit()
             logger.info(f'Scheduled FTP import: +{users_added} users added, ~{users_updated} updated.')
 
@@ -163,15 +131,136 @@ def run_org_ftp_schedule():
             org.ftp_last_run_status = 'error'
             try:
                 db.session.add(org)
-                db.session.add(BulkUploadLog(
-                    filename='[FTP] [Scheduled] users.csv',
-                    total_records=total_records,
-                    users_added=users_added,
-                    users_updated=users_updated,
-                    status='error',
-                    error_message=str(e)
-                ))
+                if not chunked:  # a chunked import records its own failure
+                    db.session.add(BulkUploadLog(
+                        filename='[FTP] [Scheduled] users.csv',
+                        total_records=total_records,
+                        users_added=users_added,
+                        users_updated=users_updated,
+                        status='error',
+                        error_message=str(e)
+                    ))
                 db.session.commit()
             except Exception:
                 db.session.rollback()
+            run.outcome = 'error'
+            run.error_message = str(e)
             logger.error(f'Scheduled FTP import failed: {e}', exc_info=True)
+
+
+@leader_only
+def run_email_outbox():
+    """Scheduled job: send due email outbox rows and purge old sent ones."""
+    from main import db, scheduler
+
+    with scheduler.app.app_context(), track_run('email_outbox', record_idle=False) as run:
+        from application.email_utils import dispatch_email_outbox, purge_sent_email_outbox
+        try:
+            sent, failed = dispatch_email_outbox()
+            purge_sent_email_outbox()
+        except Exception as e:
+            db.session.rollback()
+            run.outcome = 'error'
+            run.error_message = str(e)
+            logger.error(f'Email outbox dispatch failed: {e}', exc_info=True)
+            return
+        run.rows_processed = sent + failed
+        if sent or failed:
+            logger.info(f'Email outbox: {sent} sent, {failed} failed.')
+
+
+@leader_only
+def run_onboarding_emails():
+    """Scheduled job: send the next minute's share of queued welcome emails."""
+    from main import db, scheduler
+
+    with scheduler.app.app_context(), track_run('onboarding_emails', record_idle=False) as run:
+        from application.email_utils import send_onboarding_emails
+        try:
+            sent, failed = send_onboarding_emails()
+        except Exception as e:
+            db.session.rollback()
+            run.outcome = 'error'
+            run.error_message = str(e)
+            logger.error(f'Onboarding email run failed: {e}', exc_info=True)
+            return
+        run.rows_processed = sent + failed
+        if sent or failed:
+            logger.info(f'Onboarding emails: {sent} sent, {failed} failed.')
+
+
+@leader_only
+def run_attachment_sweeper():
+    """Scheduled job: delete the files of deleted attachments."""
+    from main import db, scheduler
+
+    with scheduler.app.app_context(), track_run('attachment_sweeper', record_idle=False) as run:
+        from application.attachments import sweep_tombstones
+        try:
+            removed, failed = sweep_tombstones()
+        except Exception as e:
+            db.session.rollback()
+            run.outcome = 'error'
+            run.error_message = str(e)
+            logger.error(f'Attachment sweep failed: {e}', exc_info=True)
+            return
+        run.rows_processed = removed + failed
+        if removed or failed:
+            logger.info(f'Attachment sweep: {removed} file(s) removed, {failed} failed.')
+
+
+@leader_only
+def run_attachment_orphan_scan():
+    """Scheduled job: reclaim stored attachment files that no row refers to."""
+    from main import db, scheduler
+
+    with scheduler.app.app_context(), track_run('attachment_orphan_scan', trace_memory=True) as run:
+        from application.attachments import reclaim_orphaned_files
+        try:
+            files, reclaimed = reclaim_orphaned_files()
+        except Exception as e:
+            db.session.rollback()
+            run.outcome = 'error'
+            run.error_message = str(e)
+            logger.error(f'Attachment orphan scan failed: {e}', exc_info=True)
+            return
+        run.rows_processed = files
+        logger.info(f'Attachment orphan scan: {files} orphaned file(s) removed, {reclaimed} bytes reclaimed.')
+
+
+@leader_only
+def run_thumbnails():
+    """Scheduled job: create thumbnails for newly attached images."""
+    from main import db, scheduler
+
+    with scheduler.app.app_context(), track_run('thumbnails', record_idle=False) as run:
+        from application.thumbnails import generate_thumbnails
+        try:
+            created, failed = generate_thumbnails()
+        except Exception as e:
+            db.session.rollback()
+            run.outcome = 'error'
+            run.error_message = str(e)
+            logger.error(f'Thumbnail run failed: {e}', exc_info=True)
+            return
+        run.rows_processed = created + failed
+        if created or failed:
+            logger.info(f'Thumbnails: {created} created, {failed} failed.')
+
+
+@leader_only
+def run_task_runner():
+    """Scheduled job: start queued background tasks."""
+    from main import db, scheduler
+
+    with scheduler.app.app_context(), track_run('task_runner', record_idle=False) as run:
+        from application.tasks import run_queued_tasks
+        try:
+            started = run_queued_tasks()
+        except Exception as e:
+            db.session.rollback()
+            run.outcome = 'error'
+            run.error_message = str(e)
+            logger.error(f'Task runner failed: {e}', exc_info=True)
+            return
+        run.rows_processed = started
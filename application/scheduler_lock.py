@@ -0,0 +1,179 @@
+"""
+Single-leader execution of scheduled jobs.
+
+Every gunicorn worker on every node starts the APScheduler, so without
+coordination each scheduled job would run once per process. Instead the
+processes compete for one lease row in ``scheduler_lock``:
+
+- ``heartbeat()`` runs every SCHEDULER_LEASE_SECONDS / 3 in each process,
+  from a thread started by ``start_heartbeat``. It renews the lease if this
+  process holds it, or takes it over once it has expired.
+- The scheduler is started paused and only runs while this process holds
+  the lease, so just one process works through the shared job store.
+  Jobs are also wrapped in ``leader_only``, so one that was already due
+  when the lease was lost does nothing.
+- If the leader dies, its lease expires within SCHEDULER_LEASE_SECONDS and
+  the next heartbeat elsewhere takes over. A clean shutdown releases it
+  straight away.
+
+Lease times come from each node's clock (like the email outbox claims),
+so nodes should run NTP. SCHEDULER_LEASE_SECONDS = 0 turns the lock off
+and every process runs every job, as before.
+"""
+import functools
+import logging
+import os
+import secrets
+import socket
+import threading
+from datetime import timedelta
+
+from apscheduler.schedulers.base import STATE_PAUSED, STATE_RUNNING
+from flask import current_app
+from sqlalchemy import case, or_
+from sqlalchemy.exc import IntegrityError
+
+from main import db, scheduler
+from application.models import SchedulerLock, _utcnow
+
+LOCK_NAME = 'scheduler'
+
+logger = logging.getLogger(__name__)
+
+# This process's view of its lease. Keyed by pid so a worker forked from a
+# leader (gunicorn --preload) doesn't think it leads too.
+_lease = {'pid': None, 'holder': None, 'expires_at': None}
+
+
+def holder_id():
+    """Identity of this process in the lease table."""
+    if _lease['pid'] != os.getpid():
+        _lease.update(pid=os.getpid(), expires_at=None,
+                      holder=f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}")
+    return _lease['holder']
+
+
+def _enabled():
+    return bool(scheduler.app.config.get('SCHEDULER_LEASE_SECONDS'))
+
+
+def is_leader():
+    """True if this process holds an unexpired lease (or locking is off)."""
+    if not _enabled():
+        return True
+    holder_id()
+    return _lease['expires_at'] is not None and _utcnow() < _lease['expires_at']
+
+
+def heartbeat():
+    """
+    Take or renew the scheduler lease. Returns True if this process leads.
+    Runs in an app context.
+    """
+    seconds = current_app.config.get('SCHEDULER_LEASE_SECONDS', 0)
+    if not seconds:
+        return True
+
+    me = holder_id()
+    now = _utcnow()
+    expires_at = now + timedelta(seconds=seconds)
+    taken = SchedulerLock.query.filter(
+        SchedulerLock.name == LOCK_NAME,
+        or_(SchedulerLock.holder == me, SchedulerLock.expires_at < now),
+    ).update([
+        # acquired_at first: MySQL evaluates SET left to right, so the CASE
+        # has to see the old holder
+        (SchedulerLock.acquired_at, case((SchedulerLock.holder == me, SchedulerLock.acquired_at), else_=now)),
+        (SchedulerLock.holder, me),
+        (SchedulerLock.heartbeat_at, now),
+        (SchedulerLock.expires_at, expires_at),
+    ], synchronize_session=False, update_args={'preserve_parameter_order': True})
+    if not taken and db.session.get(SchedulerLock, LOCK_NAME) is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(SchedulerLock(name=LOCK_NAME, holder=me, acquired_at=now,
+                                             heartbeat_at=now, expires_at=expires_at))
+            taken = 1
+        except IntegrityError:
+            pass  # another process created it first
+    db.session.commit()
+
+    was_leader = is_leader()
+    _lease['expires_at'] = expires_at if taken else None
+    if taken and not was_leader:
+        logger.info(f'Scheduler lease taken by {me}; this process now runs scheduled jobs.')
+    elif was_leader and not taken:
+        logger.warning(f'Scheduler lease lost by {me}; another process runs scheduled jobs now.')
+    return bool(taken)
+
+
+def release():
+    """Give up the lease if this process holds it, so another can take over at once."""
+    if not _enabled() or _lease['expires_at'] is None:
+        return
+    SchedulerLock.query.filter_by(name=LOCK_NAME, holder=holder_id()).update(
+        {'expires_at': _utcnow()}, synchronize_session=False
+    )
+    db.session.commit()
+    _lease['expires_at'] = None
+
+
+def current_lease():
+    """The lease row, for display; None if no process has taken it yet."""
+    return db.session.get(SchedulerLock, LOCK_NAME)
+
+
+def _sync_scheduler(leader):
+    """Run this process's scheduler only while it holds the lease."""
+    if leader and scheduler.state == STATE_PAUSED:
+        scheduler.resume()
+    elif leader and scheduler.state == STATE_RUNNING:
+        # Notice jobs that other processes saved to the shared job store
+        scheduler.scheduler.wakeup()
+    elif not leader and scheduler.state == STATE_RUNNING:
+        scheduler.pause()
+
+
+def start_heartbeat(app):
+    """
+    Heartbeat the lease from a daemon thread until the process exits, and
+    release it on a clean exit. Returns the thread.
+    """
+    import atexit
+
+    interval = max(1, app.config['SCHEDULER_LEASE_SECONDS'] // 3)
+    stopped = threading.Event()
+
+    def beat():
+        while True:
+            with app.app_context():
+                try:
+                    _sync_scheduler(heartbeat())
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f'Scheduler lease heartbeat failed: {e}', exc_info=True)
+            if stopped.wait(interval):
+                return
+
+    def stop():
+        stopped.set()
+        try:
+            with app.app_context():
+                release()
+        except Exception:
+            pass  # the lease expires on its own
+
+    thread = threading.Thread(target=beat, name='scheduler-lease', daemon=True)
+    thread.start()
+    atexit.register(stop)
+    return thread
+
+
+def leader_only(func):
+    """Make a scheduled job a no-op in processes that don't hold the lease."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not is_leader():
+            return None
+        return func(*args, **kwargs)
+    return wrapper
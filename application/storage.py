@@ -0,0 +1,188 @@
+"""
+Attachment storage backends.
+
+Attachment bytes are addressed by a storage key: ``ab/cd/<sha256>`` for
+content-addressed blobs, or the bare file name for attachments saved before
+blobs existed. A backend stores, streams and deletes the bytes behind a key:
+
+- ``LocalStorage`` keeps them below UPLOAD_ATTACHMENT (the default).
+- ``S3Storage`` keeps them in an S3-compatible bucket (AWS S3, MinIO, ...)
+  so several app servers can share attachments without NFS. It needs
+  ``boto3`` (``pip install assistitk12[s3]``).
+
+ATTACHMENT_STORAGE picks the backend; ``get_storage()`` returns the one
+configured for the current app.
+"""
+import os
+import tempfile
+from datetime import datetime, timezone
+
+from flask import current_app
+
+CHUNK_SIZE = 64 * 1024
+
+
+class StorageBackend:
+    """Interface shared by the storage drivers."""
+
+    def staging_dir(self):
+        """Local directory for uploads in progress; ``save`` moves them out of it."""
+        raise NotImplementedError
+
+    def save(self, key, tmp_path):
+        """Store the finished staging file ``tmp_path`` under ``key``, consuming it."""
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def open(self, key):
+        """Binary file object for reading ``key``. Raises FileNotFoundError."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Delete ``key``. A key that is already gone is not an error."""
+        raise NotImplementedError
+
+    def local_path(self, key):
+        """Filesystem path of ``key`` if the backend has one, else None."""
+        return None
+
+    def iter_files(self):
+        """Yield (key, size, modified) for every stored file; modified is naive UTC."""
+        raise NotImplementedError
+
+
+class LocalStorage(StorageBackend):
+    """Files below a local (or NFS-mounted) directory."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def staging_dir(self):
+        # Same filesystem as the final location, so save() is a rename
+        return self.root
+
+    def save(self, key, tmp_path):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def open(self, key):
+        return open(self._path(key), 'rb')
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def local_path(self, key):
+        return self._path(key)
+
+    def iter_files(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # deleted while walking
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc).replace(tzinfo=None)
+                yield key, stat.st_size, modified
+
+
+class S3Storage(StorageBackend):
+    """Objects in an S3-compatible bucket, uploaded and read in chunks."""
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, staging_dir=None):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            raise RuntimeError(
+                "ATTACHMENT_STORAGE='s3' needs boto3. Install it with: pip install assistitk12[s3]"
+            )
+        self.bucket = bucket
+        self.prefix = prefix
+        self._staging_dir = staging_dir or tempfile.gettempdir()
+        # Credentials come from the usual AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        # Large files go up as a multipart upload, CHUNK_SIZE-sized reads at a time
+        self.transfer_config = TransferConfig(io_chunksize=CHUNK_SIZE)
+
+    def _key(self, key):
+        return f"{self.prefix}{key}"
+
+    def staging_dir(self):
+        return self._staging_dir
+
+    def save(self, key, tmp_path):
+        try:
+            self.client.upload_file(tmp_path, self.bucket, self._key(key), Config=self.transfer_config)
+        finally:
+            os.remove(tmp_path)
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def open(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            # The body is streamed from the bucket as it is read
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key))['Body']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                raise FileNotFoundError(key)
+            raise
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def iter_files(self):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                modified = obj['LastModified'].astimezone(timezone.utc).replace(tzinfo=None)
+                yield obj['Key'][len(self.prefix):], obj['Size'], modified
+
+
+def get_storage():
+    """The attachment storage backend configured for the current app."""
+    config = current_app.config
+    driver = config.get('ATTACHMENT_STORAGE', 'local')
+    if driver == 'local':
+        # Cheap to build; reading UPLOAD_ATTACHMENT each time keeps it overridable
+        return LocalStorage(config['UPLOAD_ATTACHMENT'])
+    if driver != 's3':
+        raise RuntimeError(f"Unknown ATTACHMENT_STORAGE {driver!r}; use 'local' or 's3'.")
+
+    settings = (
+        config.get('ATTACHMENT_S3_BUCKET'),
+        config.get('ATTACHMENT_S3_PREFIX', ''),
+        config.get('ATTACHMENT_S3_ENDPOINT_URL'),
+        config.get('ATTACHMENT_S3_REGION'),
+        config.get('ATTACHMENT_STAGING_DIR'),
+    )
+    if not settings[0]:
+        raise RuntimeError("ATTACHMENT_STORAGE='s3' needs ATTACHMENT_S3_BUCKET to be set.")
+    # One client per app (boto3 clients are thread-safe and pool connections)
+    cached = current_app.extensions.get('attachment_storage')
+    if cached is None or cached[0] != settings:
+        cached = (settings, S3Storage(*settings))
+        current_app.extensions['attachment_storage'] = cached
+    return cached[1]
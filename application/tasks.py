@@ -0,0 +1,343 @@
+"""
+Background tasks for heavy admin operations.
+
+A page queues a task with ``enqueue(kind, params)`` and redirects to the
+Background Tasks page, which polls ``/tasks/<id>`` for its status. The
+``task_runner`` scheduled job (every TASK_POLL_INTERVAL seconds, in the
+scheduler lease holder only) claims queued tasks and runs them in a thread
+pool of TASK_MAX_CONCURRENCY workers.
+
+A task is a function registered with ``@background_task(kind, label)``. It is
+called as ``func(ctx, **params)`` inside an app context and returns a
+JSON-serialisable result. Through ``ctx`` it reports progress, checks for
+cancellation and attaches a file to download, e.g. an export. Status
+updates go through their own connection, so they are visible while the
+task's own transaction is still open.
+
+Finished tasks, with their results, are kept for TASK_RETENTION_HOURS.
+While a process runs tasks, a heartbeat thread of its own marks them alive;
+it keeps going if the lease moves elsewhere, so a task started before a
+handover finishes where it started. A running task whose heartbeat stops
+for TASK_STALE_SECONDS (the process died) is marked failed.
+"""
+import csv
+import io
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import update
+
+from main import db
+from application.models import Task, _utcnow
+from application.scheduler_lock import holder_id
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}  # kind -> (function, label)
+FINISHED = ('succeeded', 'failed', 'cancelled')
+PROGRESS_INTERVAL = 1.0  # seconds between progress writes
+
+# Tasks this process is running, the pool running them and their heartbeat's
+# stop event
+_running = set()
+_running_lock = threading.Lock()
+_pool = {'executor': None, 'heartbeat': None}
+
+
+class TaskCancelled(Exception):
+    """Raised inside a task when cancellation was requested."""
+
+
+def background_task(kind, label):
+    """Register the decorated function as the task ``kind``."""
+    def register(func):
+        TASKS[kind] = (func, label)
+        return func
+    return register
+
+
+def _set(task_id, only_if_status=None, **values):
+    """
+    Update a task row in its own transaction, outside the task's session.
+    With ``only_if_status`` the row must still have that status; returns
+    whether it was updated.
+    """
+    stmt = update(Task).where(Task.id == task_id)
+    if only_if_status:
+        stmt = stmt.where(Task.status == only_if_status)
+    with db.engine.begin() as conn:
+        return conn.execute(stmt.values(**values)).rowcount == 1
+
+
+class TaskContext:
+    """Handed to a running task for progress, cancellation and its result file."""
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.filename = None
+        self.file_data = None
+        self._last_write = 0.0
+
+    def progress(self, done, total=None, message=None):
+        """
+        Record progress (``done`` of ``total``) and raise TaskCancelled if the
+        task was cancelled. Writes at most once a second.
+        """
+        now = time.monotonic()
+        if now - self._last_write < PROGRESS_INTERVAL and (total is None or done < total):
+            return
+        self._last_write = now
+        values = {'progress_done': done}
+        if total is not None:
+            values['progress_total'] = total
+        if message is not None:
+            values['progress_message'] = message[:255]
+        _set(self.task_id, **values)
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        with db.engine.connect() as conn:
+            cancelled = conn.execute(
+                db.select(Task.cancel_requested).where(Task.id == self.task_id)
+            ).scalar()
+        if cancelled:
+            raise TaskCancelled()
+
+    def save_file(self, filename, data):
+        """Attach ``data`` (bytes) as the task's downloadable result."""
+        self.filename = filename
+        self.file_data = data
+
+
+def enqueue(kind, params=None, user_id=None):
+    """Queue a task of a registered ``kind``; returns the committed Task row."""
+    if kind not in TASKS:
+        raise ValueError(f"Unknown task {kind!r}")
+    task = Task(kind=kind, params=json.dumps(params or {}), created_by_id=user_id, status='queued')
+    db.session.add(task)
+    db.session.commit()
+    return task
+
+
+def cancel(task):
+    """Cancel a queued task now, or ask a running one to stop at its next progress report."""
+    if not _set(task.id, only_if_status='queued', status='cancelled', cancel_requested=True,
+                finished_at=_utcnow()):
+        # Already claimed by the runner; the task sees this at its next check
+        _set(task.id, only_if_status='running', cancel_requested=True)
+    db.session.refresh(task)
+
+
+def task_label(task):
+    return TASKS.get(task.kind, (None, task.kind))[1]
+
+
+def task_status(task):
+    """Status of ``task`` for the polling API."""
+    percent = None
+    if task.progress_total:
+        percent = min(100, round(100 * task.progress_done / task.progress_total))
+    return {
+        'id': task.id,
+        'kind': task.kind,
+        'label': task_label(task),
+        'status': task.status,
+        'finished': task.status in FINISHED,
+        'cancel_requested': task.cancel_requested,
+        'progress': {
+            'done': task.progress_done,
+            'total': task.progress_total,
+            'percent': percent,
+            'message': task.progress_message,
+        },
+        'result': json.loads(task.result) if task.result else None,
+        'result_filename': task.result_filename,
+        'error': task.error_message,
+        'created_at': task.created_at.isoformat() if task.created_at else None,
+        'started_at': task.started_at.isoformat() if task.started_at else None,
+        'finished_at': task.finished_at.isoformat() if task.finished_at else None,
+    }
+
+
+def _executor():
+    if _pool['executor'] is None:
+        _pool['executor'] = ThreadPoolExecutor(
+            max_workers=current_app.config['TASK_MAX_CONCURRENCY'], thread_name_prefix='task'
+        )
+    return _pool['executor']
+
+
+def _heartbeat(app, stop):
+    """
+    Mark this process's running tasks alive every TASK_STALE_SECONDS / 4
+    until ``stop`` is set. Not part of task_runner: that only runs in the
+    lease holder, and these tasks run here to the end either way.
+    """
+    interval = app.config['TASK_STALE_SECONDS'] / 4
+    while not stop.wait(interval):
+        with _running_lock:
+            mine = set(_running)
+        if not mine:
+            continue
+        try:
+            with app.app_context(), db.engine.begin() as conn:
+                conn.execute(update(Task).where(Task.id.in_(mine)).values(heartbeat_at=_utcnow()))
+        except Exception as e:
+            logger.error(f'Could not heartbeat background tasks {sorted(mine)}: {e}', exc_info=True)
+
+
+def _start_heartbeat(app):
+    """Start the heartbeat thread if it isn't running. Call with _running_lock held."""
+    if _pool['heartbeat'] is None:
+        _pool['heartbeat'] = threading.Event()
+        threading.Thread(target=_heartbeat, args=(app, _pool['heartbeat']), name='task-heartbeat',
+                         daemon=True).start()
+
+
+def execute_task(app, task_id):
+    """Run one claimed task to completion and record how it ended."""
+    with app.app_context():
+        try:
+            task = db.session.get(Task, task_id)
+            func = TASKS[task.kind][0]
+            params = json.loads(task.params or '{}')
+            ctx = TaskContext(task_id)
+            try:
+                result = func(ctx, **params)
+                final = {'status': 'succeeded', 'result': json.dumps(result) if result is not None else None}
+            except TaskCancelled:
+                db.session.rollback()
+                final = {'status': 'cancelled'}
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f'Background task {task_id} ({task.kind}) failed: {e}', exc_info=True)
+                final = {'status': 'failed', 'error_message': str(e)}
+            if ctx.file_data is not None and final['status'] == 'succeeded':
+                final.update(result_filename=ctx.filename, result_file=ctx.file_data)
+            # Only if it is still ours: a stale task may have been failed meanwhile
+            with db.engine.begin() as conn:
+                conn.execute(update(Task).where(
+                    Task.id == task_id, Task.status == 'running', Task.worker == holder_id()
+                ).values(finished_at=_utcnow(), **final))
+        finally:
+            db.session.remove()
+            with _running_lock:
+                _running.discard(task_id)
+                if not _running and _pool['heartbeat'] is not None:
+                    _pool['heartbeat'].set()  # stop it
+                    _pool['heartbeat'] = None
+
+
+def purge_finished_tasks():
+    """Delete finished tasks older than TASK_RETENTION_HOURS."""
+    cutoff = _utcnow() - timedelta(hours=current_app.config['TASK_RETENTION_HOURS'])
+    deleted = Task.query.filter(Task.status.in_(FINISHED), Task.finished_at < cutoff).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+    return deleted
+
+
+def run_queued_tasks(wait=False):
+    """
+    One pass of the task runner: fail running tasks whose runner died, purge
+    old results and start queued tasks while fewer than TASK_MAX_CONCURRENCY
+    are running. Returns the number started. ``wait`` blocks until they
+    finish (for tests and the CLI).
+    """
+    now = _utcnow()
+    me = holder_id()
+    with _running_lock:
+        mine = set(_running)
+
+    stale_before = now - timedelta(seconds=current_app.config['TASK_STALE_SECONDS'])
+    Task.query.filter(
+        Task.status == 'running', Task.heartbeat_at < stale_before, Task.id.notin_(mine or {0})
+    ).update({
+        'status': 'failed', 'finished_at': now,
+        'error_message': 'The process running this task stopped before it finished.',
+    }, synchronize_session=False)
+    db.session.commit()
+    purge_finished_tasks()
+
+    free = current_app.config['TASK_MAX_CONCURRENCY'] - Task.query.filter_by(status='running').count()
+    if free <= 0:
+        return 0
+    queued = [task_id for task_id, in db.session.query(Task.id).filter(
+        Task.status == 'queued', Task.kind.in_(list(TASKS))
+    ).order_by(Task.id).limit(free)]
+    db.session.rollback()  # end the read transaction
+
+    app = current_app._get_current_object()
+    started = []
+    for task_id in queued:
+        # Claim it; another runner (during a lease handover) may get there first
+        if not _set(task_id, only_if_status='queued', status='running', worker=me,
+                    started_at=now, heartbeat_at=now):
+            continue
+        with _running_lock:
+            _running.add(task_id)
+            _start_heartbeat(app)
+        started.append(_executor().submit(execute_task, app, task_id))
+    if wait:
+        for future in started:
+            future.result()
+    return len(started)
+
+
+# ****************** Tasks *******************************
+
+EXPORT_BATCH_SIZE = 500
+
+
+@background_task('export_tickets', 'Ticket export')
+def export_tickets(ctx, status=None, site_id=None):
+    """Every ticket (optionally one status/site) as a CSV file."""
+    from sqlalchemy.orm import joinedload
+    from application.models import Ticket
+
+    query = Ticket.query
+    if status:
+        query = query.filter(Ticket.tck_status == status)
+    if site_id:
+        query = query.filter(Ticket.site_id == site_id)
+    total = query.count()
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['Ticket #', 'Title', 'Status', 'Site', 'Created By', 'Assigned To',
+                     'Created', 'Updated', 'Escalated'])
+    done, last_id = 0, 0
+    ctx.progress(0, total, 'Exporting tickets')
+    while True:
+        # Keyset pagination: constant cost per batch however far in
+        batch = query.options(
+            joinedload(Ticket.title), joinedload(Ticket.site),
+            joinedload(Ticket.user), joinedload(Ticket.assigned_to),
+        ).filter(Ticket.id > last_id).order_by(Ticket.id).limit(EXPORT_BATCH_SIZE).all()
+        if not batch:
+            break
+        for ticket in batch:
+            writer.writerow([
+                ticket.id,
+                ticket.title.title_name if ticket.title else '',
+                ticket.tck_status,
+                ticket.site.site_name if ticket.site else '',
+                ticket.user.get_full_name() if ticket.user else '',
+                ticket.assigned_to.get_full_name() if ticket.assigned_to else '',
+                ticket.created_at.strftime('%Y-%m-%d %H:%M') if ticket.created_at else '',
+                ticket.updated_at.strftime('%Y-%m-%d %H:%M') if ticket.updated_at else '',
+                'Yes' if ticket.escalated else 'No',
+            ])
+        done += len(batch)
+        last_id = batch[-1].id
+        db.session.expunge_all()  # keep memory flat on big exports
+        ctx.progress(done, total, f'{done} of {total} tickets')
+
+    ctx.save_file(f"tickets-{_utcnow():%Y%m%d-%H%M}.csv", out.getvalue().encode('utf-8'))
+    return {'tickets': done}
@@ -0,0 +1,308 @@
+"""
+Image processing for attachments: thumbnails and ingest downscaling.
+
+New JPEG/PNG blobs are marked ``thumbnail_status='pending'`` when they are
+attached. The thumbnail job picks them up in the background, scales each
+image down to fit THUMBNAIL_SIZE pixels and stores it as WebP (JPEG when
+Pillow has no WebP support) next to the blob under ``thumbs/``. Ticket
+pages show the thumbnail inline instead of making technicians download a
+multi-megabyte photo to see it.
+
+Before an uploaded JPEG/PNG is stored, ``strip_image_metadata`` removes
+its EXIF (GPS position included) and other metadata without re-encoding
+it (ATTACHMENT_STRIP_METADATA). With ATTACHMENT_MAX_DIMENSION set,
+``downscale_image`` re-encodes photos larger than that to fit instead.
+
+Needs Pillow (``pip install assistitk12[images]``); without it neither
+runs: uploads are stored as sent and pages keep showing download links.
+"""
+import hashlib
+import io
+import os
+import struct
+import tempfile
+import zlib
+
+from flask import current_app
+
+from main import db
+from application.attachments import blob_key, thumbnail_key
+from application.models import AttachmentBlob
+from application.storage import CHUNK_SIZE, get_storage
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # optional dependency
+    Image = None
+
+EXIF_ORIENTATION = 0x0112
+
+
+def thumbnails_available():
+    """True if Pillow is installed, so thumbnails can be generated."""
+    return Image is not None
+
+
+def _render(source, size):
+    """Scale the image in ``source`` (path or file) to fit ``size``; returns (bytes, format)."""
+    fmt = 'webp' if features.check('webp') else 'jpeg'
+    with Image.open(source) as image:
+        # Let the JPEG decoder scale down while decoding a large photo
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        # WebP keeps PNG transparency; JPEG can't
+        keep_alpha = fmt == 'webp' and image.has_transparency_data
+        image = image.convert('RGBA' if keep_alpha else 'RGB')
+        out = io.BytesIO()
+        image.save(out, format=fmt.upper(), quality=80)
+    return out.getvalue(), fmt
+
+
+def _open_blob(storage, sha256):
+    """Path of a local blob, or its bytes in memory (Pillow needs to seek)."""
+    key = blob_key(sha256)
+    path = storage.local_path(key)
+    if path is not None:
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return path
+    fileobj = storage.open(key)
+    try:
+        return io.BytesIO(fileobj.read())
+    finally:
+        fileobj.close()
+
+
+def generate_thumbnails(limit=None):
+    """
+    Create thumbnails for up to ``limit`` pending image blobs, committing
+    after each. An image that can't be decoded is marked 'failed'. Returns
+    (created, failed).
+    """
+    if not thumbnails_available():
+        return 0, 0
+    storage = get_storage()
+    size = current_app.config['THUMBNAIL_SIZE']
+    limit = limit or current_app.config['THUMBNAIL_BATCH_SIZE']
+    created = failed = 0
+    blobs = AttachmentBlob.query.filter_by(thumbnail_status='pending').order_by(
+        AttachmentBlob.created_at
+    ).limit(limit).all()
+    for blob in blobs:
+        try:
+            data, fmt = _render(_open_blob(storage, blob.sha256), size)
+            staging = storage.staging_dir()
+            os.makedirs(staging, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=staging, prefix='.upload-')
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            storage.save(thumbnail_key(blob.sha256, fmt), tmp_path)
+            blob.thumbnail_status = 'ready'
+            blob.thumbnail_format = fmt
+            created += 1
+        except FileNotFoundError:
+            # Blob deleted since it was queued; the sweeper removes the row
+            blob.thumbnail_status = 'failed'
+            failed += 1
+        except Exception as e:
+            current_app.logger.warning(f"Thumbnail failed for blob {blob.sha256}: {e}")
+            blob.thumbnail_status = 'failed'
+            failed += 1
+        db.session.commit()
+    return created, failed
+
+
+def _staged(path):
+    """(sha256, size, path) of a staging file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest(), os.path.getsize(path), path
+
+
+def _new_staging_path(path):
+    fd, new_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.upload-')
+    os.close(fd)
+    return new_path
+
+
+def downscale_image(path, max_dimension, quality):
+    """
+    Scale the JPEG/PNG at ``path`` down to fit within ``max_dimension``
+    pixels. It is re-encoded in the same format (JPEGs at ``quality``),
+    keeping its ICC colour profile and dropping EXIF and other metadata;
+    the EXIF orientation is applied to the pixels first. The result goes to
+    a new staging file next to ``path``.
+
+    Returns (sha256, size, new_path), or None to keep the original: an
+    image that already fits, a PNG that re-encoding didn't make smaller, a
+    file that isn't a JPEG/PNG Pillow can read, or Pillow is missing.
+    """
+    if not thumbnails_available() or not max_dimension:
+        return None
+    new_path = _new_staging_path(path)
+    try:
+        with Image.open(path) as image:
+            fmt = image.format
+            if fmt not in ('JPEG', 'PNG') or max(image.size) <= max_dimension:
+                os.remove(new_path)
+                return None
+            icc_profile = image.info.get('icc_profile')
+            image.draft('RGB', (max_dimension, max_dimension))
+            # Bake the EXIF orientation into the pixels before the EXIF goes
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+            if fmt == 'JPEG':
+                image.convert('RGB').save(new_path, format='JPEG', quality=quality, optimize=True,
+                                          progressive=True, icc_profile=icc_profile)
+            else:
+                image.save(new_path, format='PNG', optimize=True, icc_profile=icc_profile)
+    except Exception as e:
+        current_app.logger.warning(f"Could not downscale uploaded image, storing it as sent: {e}")
+        os.remove(new_path)
+        return None
+
+    if fmt == 'PNG' and os.path.getsize(new_path) >= os.path.getsize(path):
+        os.remove(new_path)
+        return None
+    return _staged(new_path)
+
+
+# ****************** Lossless metadata removal *******************************
+
+# JPEG segments that are kept: APP0 (JFIF), APP2 ICC profiles and APP14
+# (Adobe colour transform). Every other APPn (EXIF, XMP, IPTC, maker data)
+# and comments go.
+_JPEG_SOS, _JPEG_EOI = 0xDA, 0xD9
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_PNG_METADATA = {b'eXIf', b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+
+
+def _orientation_tiff(orientation):
+    """A TIFF/EXIF block holding nothing but ``orientation``."""
+    return (b'MM\x00\x2a' + struct.pack('>IH', 8, 1)
+            + struct.pack('>HHIHH', EXIF_ORIENTATION, 3, 1, orientation, 0) + struct.pack('>I', 0))
+
+
+def _keep_jpeg_segment(marker, payload):
+    if marker == 0xE0 or marker == 0xEE:
+        return True
+    if marker == 0xE2:
+        return payload.startswith(b'ICC_PROFILE\x00')
+    return not (0xE1 <= marker <= 0xEF or marker == 0xFE)
+
+
+def _strip_jpeg(data, orientation):
+    """
+    ``data`` with its metadata segments removed, and anything after the
+    end of the image (e.g. a phone's embedded depth map, which has EXIF of
+    its own). The compressed image data is copied as is.
+    """
+    if data[:2] != b'\xff\xd8':
+        raise ValueError('not a JPEG')
+    out = [data[:2]]
+    exif = None
+    if orientation != 1:
+        exif = b'Exif\x00\x00' + _orientation_tiff(orientation)
+        exif = b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif
+    pos = 2
+    while True:
+        if data[pos] != 0xFF:
+            raise ValueError(f'no JPEG marker at byte {pos}')
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker == _JPEG_EOI:
+            out.append(data[pos:pos + 2])
+            return b''.join(out)
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:  # no length
+            out.append(data[pos:pos + 2])
+            pos += 2
+            continue
+        end = pos + 2 + struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        if end > len(data):
+            raise ValueError('truncated JPEG')
+        if exif and marker != 0xE0:  # after a JFIF header, before anything else
+            out.append(exif)
+            exif = None
+        if _keep_jpeg_segment(marker, data[pos + 4:end]):
+            out.append(data[pos:end])
+        pos = end
+        if marker == _JPEG_SOS:
+            # Entropy-coded data runs to the next marker that isn't a
+            # stuffed 0xFF00 or a restart marker
+            scan = pos
+            while True:
+                scan = data.index(b'\xff', scan)
+                following = data[scan + 1]
+                if following == 0x00 or 0xD0 <= following <= 0xD7 or following == 0xFF:
+                    scan += 1
+                    continue
+                break
+            out.append(data[pos:scan])
+            pos = scan
+
+
+def _png_chunk(chunk_type, payload):
+    return (struct.pack('>I', len(payload)) + chunk_type + payload
+            + struct.pack('>I', zlib.crc32(chunk_type + payload)))
+
+
+def _strip_png(data, orientation):
+    """``data`` without its text, time and EXIF chunks; image data is copied as is."""
+    if not data.startswith(_PNG_SIGNATURE):
+        raise ValueError('not a PNG')
+    out = [_PNG_SIGNATURE]
+    pos = len(_PNG_SIGNATURE)
+    while pos < len(data):
+        length = struct.unpack('>I', data[pos:pos + 4])[0]
+        chunk_type = data[pos + 4:pos + 8]
+        end = pos + 12 + length
+        if end > len(data):
+            raise ValueError('truncated PNG')
+        if chunk_type == b'eXIf' and orientation != 1:
+            out.append(_png_chunk(b'eXIf', _orientation_tiff(orientation)))
+        elif chunk_type not in _PNG_METADATA:
+            out.append(data[pos:end])
+        pos = end
+        if chunk_type == b'IEND':
+            break
+    return b''.join(out)
+
+
+def strip_image_metadata(path):
+    """
+    Remove EXIF (GPS position included), XMP, IPTC, comments and text
+    chunks from the JPEG/PNG at ``path`` without re-encoding it, so the
+    pixels are untouched. The ICC colour profile is kept, and so is the
+    EXIF orientation, in an EXIF block of its own, so photos still display
+    the right way up. The result goes to a new staging file next to
+    ``path``.
+
+    Returns (sha256, size, new_path), or None to keep the original: there
+    was no metadata to remove, the file isn't a JPEG/PNG Pillow can read,
+    or Pillow is missing.
+    """
+    if not thumbnails_available():
+        return None
+    try:
+        with Image.open(path) as image:
+            fmt = image.format
+            orientation = image.getexif().get(EXIF_ORIENTATION, 1) if fmt in ('JPEG', 'PNG') else 1
+        if fmt not in ('JPEG', 'PNG'):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        stripped = (_strip_jpeg if fmt == 'JPEG' else _strip_png)(data, orientation)
+    except Exception as e:
+        current_app.logger.warning(f"Could not remove metadata from uploaded image, storing it as sent: {e}")
+        return None
+    if stripped == data:
+        return None
+    new_path = _new_staging_path(path)
+    with open(new_path, 'wb') as f:
+        f.write(stripped)
+    return _staged(new_path)
@@ -121,6 +121,44 @@ def validate_password(password: str, min_length: int = 12) -> Tuple[bool, Option
     return True, None
 
 
+# Magic bytes (file signatures) for allowed upload types
+UPLOAD_MAGIC_BYTES = {
+    b'\xff\xd8\xff': '.jpg',         # JPEG
+    b'\x89PNG\r\n\x1a\n': '.png',   # PNG
+    b'%PDF': '.pdf',                 # PDF
+}
+ALLOWED_UPLOAD_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.pdf'}
+
+
+def file_signature_error(header, file_ext):
+    """
+    Check the first bytes of an upload against its file extension.
+
+    Args:
+        header (bytes): At least the first 8 bytes of the file
+        file_ext (str): Lower-case extension including the dot
+
+    Returns:
+        Optional[str]: Error message, or None if the content matches
+    """
+    matched_type = None
+    for magic, ext in UPLOAD_MAGIC_BYTES.items():
+        if header.startswith(magic):
+            matched_type = ext
+            break
+
+    if matched_type is None:
+        return "File content does not match an allowed file type (JPG, PNG, PDF)"
+
+    # .jpg and .jpeg both map to the JPEG magic bytes
+    if matched_type == '.jpg' and file_ext not in {'.jpg', '.jpeg'}:
+        return "File extension does not match file content"
+    elif matched_type != '.jpg' and file_ext != matched_type:
+        return "File extension does not match file content"
+
+    return None
+
+
 def validate_file_upload(file, allowed_extensions=None, max_size_mb=12):
     """
     Validate uploaded files for security using both extension and magic byte checks.
@@ -138,17 +176,8 @@ def validate_file_upload(file, allowed_extensions=None, max_size_mb=12):
     Returns:
         Tuple[bool, Optional[str]]: (is_valid, error_message)
     """
-    import os
-
-    # Magic bytes (file signatures) for allowed types
-    MAGIC_BYTES = {
-        b'\xff\xd8\xff': '.jpg',         # JPEG
-        b'\x89PNG\r\n\x1a\n': '.png',   # PNG
-        b'%PDF': '.pdf',                 # PDF
-    }
-
     if allowed_extensions is None:
-        allowed_extensions = {'.jpg', '.jpeg', '.png', '.pdf'}
+        allowed_extensions = ALLOWED_UPLOAD_EXTENSIONS
 
     if not file or not file.filename:
         return False, "No file selected"
@@ -171,24 +200,13 @@ def validate_file_upload(file, allowed_extensions=None, max_size_mb=12):
     if file_length > max_bytes:
         return False, f"File size exceeds {max_size_mb}MB limit"
 
-    # 3. Validate actual file content using magic bytes
+    # 3. Validate actual file content using magic bytes, and ensure the
+    # extension matches it
     header = file.read(8)
     file.seek(0)  # Reset file pointer after reading
 
-    matched_type = None
-    for magic, ext in MAGIC_BYTES.items():
-        if header.startswith(magic):
-            matched_type = ext
-            break
-
-    if matched_type is None:
-        return False, "File content does not match an allowed file type (JPG, PNG, PDF)"
-
-    # 4. Ensure extension matches the actual file content
-    # .jpg and .jpeg both map to the JPEG magic bytes
-    if matched_type == '.jpg' and file_ext not in {'.jpg', '.jpeg'}:
-        return False, "File extension does not match file content"
-    elif matched_type != '.jpg' and file_ext != matched_type:
-        return False, "File extension does not match file content"
+    error = file_signature_error(header, file_ext)
+    if error:
+        return False, error
 
     return True, None
@@ -19,6 +19,67 @@ class Config:
     # Flask-Limiter storage: set RATELIMIT_STORAGE_URI=redis://... in production
     RATELIMIT_STORAGE_URI = os.environ.get('RATELIMIT_STORAGE_URI', 'memory://')
 
+    # Flask-Caching backend. SimpleCache is per-process; set CACHE_TYPE=RedisCache
+    # and CACHE_REDIS_URL=redis://... when running several gunicorn workers so
+    # cached import previews are visible to every worker.
+    CACHE_TYPE = os.environ.get('CACHE_TYPE', 'SimpleCache')
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+
+    # Roster imports: commit every N users.csv rows and record a resumable
+    # checkpoint in bulk_upload_log. 0 imports each file in one transaction.
+    # A running import that hasn't committed a chunk for IMPORT_STALE_SECONDS
+    # is presumed dead, and uploading the same file again resumes it.
+    IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 0))
+    IMPORT_STALE_SECONDS = 900
+
+    # Attachment storage: 'local' keeps files under UPLOAD_ATTACHMENT; 's3'
+    # keeps them in an S3-compatible bucket (AWS S3, MinIO, ...) so several app
+    # servers can share them. The S3 driver needs boto3 and reads credentials
+    # from AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY. Uploads are staged in
+    # ATTACHMENT_STAGING_DIR (default: the system temp dir) before upload.
+    ATTACHMENT_STORAGE = os.environ.get('ATTACHMENT_STORAGE', 'local')
+    ATTACHMENT_S3_BUCKET = os.environ.get('ATTACHMENT_S3_BUCKET')
+    ATTACHMENT_S3_PREFIX = os.environ.get('ATTACHMENT_S3_PREFIX', 'attachments/')
+    ATTACHMENT_S3_ENDPOINT_URL = os.environ.get('ATTACHMENT_S3_ENDPOINT_URL')  # e.g. http://minio:9000
+    ATTACHMENT_S3_REGION = os.environ.get('ATTACHMENT_S3_REGION')
+    ATTACHMENT_STAGING_DIR = os.environ.get('ATTACHMENT_STAGING_DIR')
+    # Largest ticket attachment accepted. Uploads are checked while they are
+    # received, so a bigger file is refused as soon as it crosses the limit.
+    ATTACHMENT_MAX_SIZE_MB = int(os.environ.get('ATTACHMENT_MAX_SIZE_MB', 12))
+    # Optionally downscale uploaded JPEG/PNG photos whose longer side exceeds
+    # ATTACHMENT_MAX_DIMENSION px (0 keeps their size), re-encoding JPEGs at
+    # ATTACHMENT_IMAGE_QUALITY. Other JPEG/PNG uploads are not re-encoded;
+    # with ATTACHMENT_STRIP_METADATA their EXIF (including GPS position) and
+    # other metadata are cut out, keeping the colour profile and orientation.
+    # Needs Pillow.
+    ATTACHMENT_MAX_DIMENSION = int(os.environ.get('ATTACHMENT_MAX_DIMENSION', 0))
+    ATTACHMENT_STRIP_METADATA = os.environ.get('ATTACHMENT_STRIP_METADATA', 'true').lower() == 'true'
+    ATTACHMENT_IMAGE_QUALITY = int(os.environ.get('ATTACHMENT_IMAGE_QUALITY', 85))
+    # Deleted attachments are removed from storage by a background sweeper
+    # every ATTACHMENT_SWEEP_INTERVAL seconds (0 turns it off), at most
+    # ATTACHMENT_SWEEP_BATCH_SIZE files per run. Every ATTACHMENT_ORPHAN_SCAN_HOURS
+    # (0 turns it off) the store is checked for files no attachment refers
+    # to; files younger than ATTACHMENT_ORPHAN_GRACE_SECONDS are left alone.
+    ATTACHMENT_SWEEP_INTERVAL = int(os.environ.get('ATTACHMENT_SWEEP_INTERVAL', 60))
+    ATTACHMENT_SWEEP_BATCH_SIZE = 200
+    ATTACHMENT_ORPHAN_SCAN_HOURS = int(os.environ.get('ATTACHMENT_ORPHAN_SCAN_HOURS', 24))
+    ATTACHMENT_ORPHAN_GRACE_SECONDS = 3600
+    # Image attachments get a THUMBNAIL_SIZE px preview (WebP, or JPEG) from a
+    # background job every THUMBNAIL_INTERVAL seconds (0 turns it off), at
+    # most THUMBNAIL_BATCH_SIZE per run. Needs Pillow.
+    THUMBNAIL_INTERVAL = int(os.environ.get('THUMBNAIL_INTERVAL', 30))
+    THUMBNAIL_SIZE = 320
+    THUMBNAIL_BATCH_SIZE = 20
+    # Let the front-end web server send attachment bytes once the app has
+    # checked access. 'x-accel' (nginx) returns X-Accel-Redirect pointing at
+    # ATTACHMENT_ACCEL_PREFIX + storage key, which must be an `internal;`
+    # location aliasing UPLOAD_ATTACHMENT (or proxying to the bucket), e.g.
+    #   location /protected-attachments/ { internal; alias /app/application/static/uploads/attachments/; }
+    # 'x-sendfile' (Apache mod_xsendfile) returns the file's path and only
+    # applies to local storage. Empty streams the file from Python.
+    ATTACHMENT_SENDFILE = os.environ.get('ATTACHMENT_SENDFILE', '')
+    ATTACHMENT_ACCEL_PREFIX = os.environ.get('ATTACHMENT_ACCEL_PREFIX', '/protected-attachments/')
+
     # Cap upload size at 16 MB to prevent DoS via large file uploads
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
 
@@ -33,6 +94,61 @@ class Config:
 
     # APScheduler — disable the built-in REST API endpoint
     SCHEDULER_API_ENABLED = False
+    # Scheduled jobs run in one process only: the one holding the lease in the
+    # scheduler_lock table. Every process renews or competes for it every
+    # SCHEDULER_LEASE_SECONDS / 3; if the leader dies another one takes over
+    # within SCHEDULER_LEASE_SECONDS. 0 runs every job in every process.
+    SCHEDULER_LEASE_SECONDS = int(os.environ.get('SCHEDULER_LEASE_SECONDS', 60))
+    # Where scheduled jobs are kept: 'database' (the apscheduler_jobs table,
+    # shared by every process, so a schedule saved in one worker is run by the
+    # leader) or 'memory' (rebuilt at startup in each process). Use 'memory'
+    # if SCHEDULER_LEASE_SECONDS is 0 and more than one process runs jobs.
+    SCHEDULER_JOB_STORE = os.environ.get('SCHEDULER_JOB_STORE', 'database')
+    # When this process starts its scheduler: 'first-request' (a web worker,
+    # once it serves its first request), 'startup' (as soon as the app is
+    # created) or 'off' (never; web-only nodes). CLI commands such as
+    # `flask db upgrade` never start it unless it is 'startup'. A designated
+    # process can also run `flask run-scheduler`.
+    SCHEDULER_AUTOSTART = os.environ.get('SCHEDULER_AUTOSTART', 'first-request')
+
+    # Background tasks (application/tasks.py): queued tasks are started every
+    # TASK_POLL_INTERVAL seconds (0 turns the runner off), at most
+    # TASK_MAX_CONCURRENCY at a time. Finished tasks and their results are
+    # kept for TASK_RETENTION_HOURS; a running task whose runner has been
+    # silent for TASK_STALE_SECONDS is marked failed.
+    TASK_POLL_INTERVAL = int(os.environ.get('TASK_POLL_INTERVAL', 5))
+    TASK_MAX_CONCURRENCY = int(os.environ.get('TASK_MAX_CONCURRENCY', 2))
+    TASK_RETENTION_HOURS = int(os.environ.get('TASK_RETENTION_HOURS', 72))
+    TASK_STALE_SECONDS = 120
+
+    # Every run of a scheduled job is recorded in job_run (Job History page).
+    # JOB_RUN_TRACK_MEMORY measures the Python memory allocated by the long
+    # jobs (FTP import, orphan scan) with tracemalloc, which slows the whole
+    # process while they run; other runs record peak RSS growth.
+    JOB_RUN_RETENTION_DAYS = int(os.environ.get('JOB_RUN_RETENTION_DAYS', 90))
+    JOB_RUN_TRACK_MEMORY = os.environ.get('JOB_RUN_TRACK_MEMORY', 'false').lower() == 'true'
+
+    # Prometheus metrics at /metrics (application/metrics.py; needs the
+    # 'metrics' extra). Scrapers send "Authorization: Bearer METRICS_TOKEN";
+    # with no token only localhost may scrape. Under gunicorn, also set
+    # PROMETHEUS_MULTIPROC_DIR so the counts cover every worker.
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # Per-request SQL budget (application/request_timing.py): with
+    # REQUEST_TIMING_ENABLED every response carries a Server-Timing header
+    # (db, render, total), and requests running more than SQL_QUERY_BUDGET
+    # statements or spending more than SQL_TIME_BUDGET_MS in them are logged
+    # with their most repeated statements. 0 turns a budget off.
+    REQUEST_TIMING_ENABLED = os.environ.get('REQUEST_TIMING_ENABLED', 'false').lower() == 'true'
+    SQL_QUERY_BUDGET = int(os.environ.get('SQL_QUERY_BUDGET', 30))
+    SQL_TIME_BUDGET_MS = int(os.environ.get('SQL_TIME_BUDGET_MS', 250))
+    # On-demand profiling (application/profiler.py): with PROFILER_ENABLED an
+    # admin can run a request under cProfile by adding ?_profile=1 (or the
+    # X-Profile: 1 header), at most PROFILER_RATE_LIMIT times per admin. The
+    # newest PROFILER_KEEP profiles are kept for download.
+    PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', 'false').lower() == 'true'
+    PROFILER_RATE_LIMIT = os.environ.get('PROFILER_RATE_LIMIT', '10 per hour')
+    PROFILER_KEEP = int(os.environ.get('PROFILER_KEEP', 50))
 
     # Flask-Mail configuration
     MAIL_SERVER = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
@@ -43,6 +159,24 @@ class Config:
     MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER')
 
 
+    # Email outbox: ticket notifications are queued in the email_outbox table
+    # and sent by a background job every EMAIL_OUTBOX_INTERVAL seconds (0 turns
+    # the job off). Failed sends are retried after RETRY_BASE * 2^n seconds;
+    # after MAX_ATTEMPTS the row is marked dead for an admin to look at.
+    EMAIL_OUTBOX_INTERVAL = int(os.environ.get('EMAIL_OUTBOX_INTERVAL', 30))
+    EMAIL_OUTBOX_BATCH_SIZE = 50
+    EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS', 6))
+    EMAIL_OUTBOX_RETRY_BASE = 60
+    EMAIL_OUTBOX_CLAIM_SECONDS = 300
+    EMAIL_OUTBOX_RETENTION_DAYS = 7
+    # Seconds an idle SMTP connection is kept open for the next outbox batch.
+    # Keep it below the server's own idle timeout (often 60-300 s).
+    SMTP_IDLE_TIMEOUT = int(os.environ.get('SMTP_IDLE_TIMEOUT', 55))
+    # Welcome emails for imported users are sent by a background job once a
+    # minute, at most this many per run (0 turns the job off). Keep it under
+    # the mail provider's per-minute quota.
+    ONBOARDING_EMAILS_PER_MINUTE = int(os.environ.get('ONBOARDING_EMAILS_PER_MINUTE', 30))
+
 class DevelopmentConfig(Config):
     DEBUG = True                   # Enable debug mode for development
     SESSION_COOKIE_SECURE = False   # Allow HTTP cookies in local development only
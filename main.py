@@ -1,4 +1,8 @@
 import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
 from flask import Flask, g
 from flask_wtf.csrf import CSRFProtect
 from flask_migrate import Migrate
@@ -8,6 +12,7 @@ from flask_mail import Mail
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_apscheduler import APScheduler
+from flask_caching import Cache
 from werkzeug.middleware.proxy_fix import ProxyFix
 from config import config, ProductionConfig
 
@@ -21,6 +26,7 @@ limiter = Limiter(
     default_limits=["200 per hour", "50 per minute"],
 )
 scheduler = APScheduler()
+cache = Cache()
 
 
 @login_manager.user_loader
@@ -35,16 +41,17 @@ def create_app(config_name=None):
     # `gunicorn "main:create_app()"` — i.e. no explicit config argument —
     # from silently running in debug mode.
     config_name = config_name or os.environ.get('FLASK_CONFIG', 'default')
+    started = time.perf_counter()
     app = Flask(
         __name__,
         template_folder='application/templates',
         static_folder='application/static'
     )
+    app.extensions['startup_timings'] = []
 
+    # Created on the first request (see _finish_startup), not by CLI commands
     app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'application/static/uploads')
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     app.config['UPLOAD_ATTACHMENT'] = os.path.join(app.root_path, 'application/static/uploads/attachments')
-    os.makedirs(app.config['UPLOAD_ATTACHMENT'], exist_ok=True)
 
     # Use environment-specific configuration
     app.config.from_object(config[config_name])
@@ -69,15 +76,24 @@ def create_app(config_name=None):
     # so rate limiting sees the real client IP instead of the proxy's IP.
     app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
     
+    _record_timing(app, 'config', time.perf_counter() - started)
+
     # Initialize extensions
-    db.init_app(app)
-    login_manager.init_app(app)
-    csrf.init_app(app)
-    mail.init_app(app)
-    limiter.init_app(app)
-    scheduler.init_app(app)
+    with _timed(app, 'extensions'):
+        _init_extensions(app)
     login_manager.login_view = "routes.login"
 
+    # SQL/render timing per request (REQUEST_TIMING_ENABLED), and request,
+    # SQL, cache and job metrics at /metrics (METRICS_ENABLED)
+    from application.request_timing import init_request_timing
+    from application.metrics import init_metrics
+    init_request_timing(app)
+    init_metrics(app)
+
+    # Admins can profile a request with ?_profile=1 (PROFILER_ENABLED)
+    from application.profiler import init_profiler
+    init_profiler(app)
+
     # Static assets (CSS/JS/images) shouldn't count against the default
     # per-IP rate limit — a single page view can request a dozen of them.
     @limiter.request_filter
@@ -117,9 +133,14 @@ def create_app(config_name=None):
         return dt.astimezone().strftime(fmt)
     app.jinja_env.filters['localtime'] = localtime
 
-    # Register blueprint
-    from application.routes import routes_blueprint
-    app.register_blueprint(routes_blueprint)
+    with _timed(app, 'blueprints'):
+        # Ticket attachments are streamed into storage while the request body is parsed
+        from application.attachments import AttachmentRequest
+        app.request_class = AttachmentRequest
+
+        # Register blueprint
+        from application.routes import routes_blueprint
+        app.register_blueprint(routes_blueprint)
 
     # Per-request CSP nonce for inline <script> blocks — lets templates opt
     # in individually (nonce="{{ g.csp_nonce }}") instead of the CSP allowing
@@ -153,9 +174,83 @@ def create_app(config_name=None):
             )
         return response
 
-    # Override Flask-Mail config with any settings stored in the database.
-    # This ensures notifications use the admin-configured SMTP settings
-    # on every startup, not just after the settings form is saved.
+    # Work that needs the database or the filesystem waits for the first
+    # request, so `flask db upgrade` and other CLI commands don't do it
+    @app.before_request
+    def _finish_startup():
+        if not app.extensions.get('startup_finished'):
+            _deferred_startup(app)
+
+    _register_cli(app)
+
+    # Scheduled jobs are only queued here; they are stored and run once the
+    # scheduler starts (see start_scheduler)
+    _add_scheduled_jobs(app)
+    _record_timing(app, 'total', time.perf_counter() - started)
+
+    if app.config.get('SCHEDULER_AUTOSTART') == 'startup':
+        start_scheduler(app)
+
+    return app
+
+
+def _record_timing(app, phase, seconds, deferred=False):
+    app.extensions['startup_timings'].append((phase, seconds, deferred))
+
+
+@contextmanager
+def _timed(app, phase, deferred=False):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_timing(app, phase, time.perf_counter() - started, deferred)
+
+
+def _init_extensions(app):
+    db.init_app(app)
+    login_manager.init_app(app)
+    csrf.init_app(app)
+    mail.init_app(app)
+    limiter.init_app(app)
+    if app.config.get('SCHEDULER_JOB_STORE') == 'database':
+        # Jobs live in the apscheduler_jobs table on the app's own engine
+        from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+        with app.app_context():
+            app.config['SCHEDULER_JOBSTORES'] = {'default': SQLAlchemyJobStore(engine=db.engine)}
+    scheduler.init_app(app)
+    cache.init_app(app)
+
+
+_startup_lock = threading.Lock()
+_scheduler_start_lock = threading.Lock()
+
+
+def _deferred_startup(app, with_scheduler=True):
+    """
+    The part of startup that touches the database and filesystem. Runs once,
+    before the first request (and before the scheduler starts).
+    """
+    with _startup_lock:
+        if app.extensions.get('startup_finished'):
+            return
+        with _timed(app, 'upload folders', deferred=True):
+            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+            os.makedirs(app.config['UPLOAD_ATTACHMENT'], exist_ok=True)
+        with _timed(app, 'organization settings', deferred=True):
+            _load_org_mail_settings(app)
+        app.extensions['startup_finished'] = True
+    if with_scheduler and app.config.get('SCHEDULER_AUTOSTART') == 'first-request':
+        with _timed(app, 'scheduler', deferred=True):
+            start_scheduler(app)
+
+
+def _load_org_mail_settings(app):
+    """
+    Override Flask-Mail config with any settings stored in the database.
+    This ensures notifications use the admin-configured SMTP settings
+    on every startup, not just after the settings form is saved.
+    """
     with app.app_context():
         try:
             from application.models import Organization
@@ -176,32 +271,176 @@ def create_app(config_name=None):
         except Exception:
             pass  # DB not ready on first run — env var defaults remain active
 
-    # Register FTP schedule from Organization if enabled
-    with app.app_context():
-        _register_org_ftp_schedule()
 
-    if not scheduler.running:
-        scheduler.start()
+def start_scheduler(app):
+    """
+    Start this process's scheduler. With the scheduler lease on it starts
+    paused and only the lease holder resumes it (see
+    application/scheduler_lock.py).
+    """
+    with _scheduler_start_lock:
+        if scheduler.running:
+            return
+        # The jobs send mail and read the FTP schedule from the database
+        _deferred_startup(app, with_scheduler=False)
+        with app.app_context():
+            _register_org_ftp_schedule()
+
+        lease = app.config.get('SCHEDULER_LEASE_SECONDS')
+        scheduler.start(paused=bool(lease))
+        if lease and scheduler.running:
+            from application.scheduler_lock import start_heartbeat
+            start_heartbeat(app)
+
+
+def _register_cli(app):
+    import click
+
+    @app.cli.command('run-scheduler')
+    def run_scheduler_command():
+        """Run scheduled jobs in this process until interrupted."""
+        start_scheduler(app)
+        click.echo('Scheduler running. Press Ctrl+C to stop.')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            scheduler.shutdown()
+
+    @app.cli.command('startup-report')
+    def startup_report_command():
+        """Show how long app startup takes, and what is deferred to the first request."""
+        from application.routes import _dummy_password_hash
+        _deferred_startup(app, with_scheduler=False)
+        with _timed(app, 'login timing-safe hash', deferred=True):
+            _dummy_password_hash()
+
+        timings = app.extensions['startup_timings']
+        click.echo('At startup (create_app):')
+        for phase, seconds, deferred in timings:
+            if not deferred:
+                click.echo(f'  {phase:<28}{seconds * 1000:9.1f} ms')
+        click.echo('Deferred to first use:')
+        for phase, seconds, deferred in timings:
+            if deferred:
+                click.echo(f'  {phase:<28}{seconds * 1000:9.1f} ms')
+        saved = sum(seconds for _, seconds, deferred in timings if deferred)
+        click.echo(f'Kept off startup: {saved * 1000:.1f} ms, plus starting the scheduler '
+                   f"(SCHEDULER_AUTOSTART={app.config.get('SCHEDULER_AUTOSTART')}).")
+
+
+def _add_scheduled_jobs(app):
+    """Queue the interval jobs that are turned on in the config."""
+    # Background sender for queued notification emails
+    if app.config.get('EMAIL_OUTBOX_INTERVAL'):
+        from application.scheduled_jobs import run_email_outbox
+        scheduler.add_job(
+            id='email_outbox',
+            func=run_email_outbox,
+            trigger='interval',
+            seconds=app.config['EMAIL_OUTBOX_INTERVAL'],
+            max_instances=1,
+            coalesce=True,
+            replace_existing=True
+        )
+
+    # Rate-limited sender for welcome emails queued from the upload log
+    if app.config.get('ONBOARDING_EMAILS_PER_MINUTE'):
+        from application.scheduled_jobs import run_onboarding_emails
+        scheduler.add_job(
+            id='onboarding_emails',
+            func=run_onboarding_emails,
+            trigger='interval',
+            seconds=60,
+            max_instances=1,
+            coalesce=True,
+            replace_existing=True
+        )
+
+    # Background removal of deleted attachment files, and a periodic sweep
+    # for files left behind without a database row
+    if app.config.get('ATTACHMENT_SWEEP_INTERVAL'):
+        from application.scheduled_jobs import run_attachment_sweeper
+        scheduler.add_job(
+            id='attachment_sweeper',
+            func=run_attachment_sweeper,
+            trigger='interval',
+            seconds=app.config['ATTACHMENT_SWEEP_INTERVAL'],
+            max_instances=1,
+            coalesce=True,
+            replace_existing=True
+        )
+    if app.config.get('ATTACHMENT_ORPHAN_SCAN_HOURS'):
+        from application.scheduled_jobs import run_attachment_orphan_scan
+        scheduler.add_job(
+            id='attachment_orphan_scan',
+            func=run_attachment_orphan_scan,
+            trigger='interval',
+            hours=app.config['ATTACHMENT_ORPHAN_SCAN_HOURS'],
+            max_instances=1,
+            coalesce=True,
+            replace_existing=True
+        )
+
+    # Previews for image attachments
+    if app.config.get('THUMBNAIL_INTERVAL'):
+        from application.scheduled_jobs import run_thumbnails
+        scheduler.add_job(
+            id='thumbnails',
+            func=run_thumbnails,
+            trigger='interval',
+            seconds=app.config['THUMBNAIL_INTERVAL'],
+            max_instances=1,
+            coalesce=True,
+            replace_existing=True
+        )
+
+    # Background tasks queued from admin pages
+    if app.config.get('TASK_POLL_INTERVAL'):
+        from application.scheduled_jobs import run_task_runner
+        scheduler.add_job(
+            id='task_runner',
+            func=run_task_runner,
+            trigger='interval',
+            seconds=app.config['TASK_POLL_INTERVAL'],
+            max_instances=1,
+            coalesce=True,
+            replace_existing=True
+        )
 
-    return app
 
 
 def _register_org_ftp_schedule():
-    """Register (or remove) the single org-level FTP cron job based on Organization settings."""
+    """
+    Register (or remove) the single org-level FTP cron job based on Organization
+    settings. With the database job store every process sees the change, even
+    one whose scheduler is not running (e.g. SCHEDULER_AUTOSTART=off).
+    """
     try:
+        from apscheduler.triggers.cron import CronTrigger
         from application.models import Organization
         from application.scheduled_jobs import run_org_ftp_schedule
         org = db.session.get(Organization, 1)
         if org and org.ftp_schedule_enabled and org.ftp_schedule_hour is not None:
-            scheduler.add_job(
-                id='org_ftp_schedule',
-                func=run_org_ftp_schedule,
-                trigger='cron',
+            trigger = CronTrigger(
                 day_of_week=org.ftp_schedule_days or '*',
                 hour=org.ftp_schedule_hour,
                 minute=org.ftp_schedule_minute or 0,
-                replace_existing=True
+                timezone=scheduler.scheduler.timezone
             )
+            if _stored_without_scheduler():
+                _save_job_to_store('org_ftp_schedule', run_org_ftp_schedule, trigger, misfire_grace_time=3600)
+            else:
+                scheduler.add_job(
+                    id='org_ftp_schedule',
+                    func=run_org_ftp_schedule,
+                    trigger=trigger,
+                    # Still run if it came due while the leader was failing over
+                    misfire_grace_time=3600,
+                    replace_existing=True
+                )
+        elif _stored_without_scheduler():
+            _save_job_to_store('org_ftp_schedule')
         else:
             try:
                 scheduler.remove_job('org_ftp_schedule')
@@ -210,6 +449,39 @@ def _register_org_ftp_schedule():
     except Exception:
         pass  # DB not ready on first run
 
+
+def _stored_without_scheduler():
+    """
+    True if jobs are kept in the database but this process's scheduler is
+    not running. Its add_job/remove_job would only queue the change in
+    memory, for a start that may never come.
+    """
+    return not scheduler.running and scheduler.app.config.get('SCHEDULER_JOB_STORE') == 'database'
+
+
+def _save_job_to_store(job_id, func=None, trigger=None, **options):
+    """
+    Write a job straight to the database job store, replacing any job with
+    the same id; with no func, remove it. A running scheduler sees the
+    change the next time it wakes (the leader wakes on every heartbeat).
+    """
+    from apscheduler.job import Job
+    from apscheduler.jobstores.base import ConflictingIdError, JobLookupError
+    store = scheduler.app.config['SCHEDULER_JOBSTORES']['default']
+    if func is None:
+        try:
+            store.remove_job(job_id)
+        except JobLookupError:
+            pass
+        return
+    job = Job(scheduler.scheduler, id=job_id, func=func, trigger=trigger, executor='default',
+              args=(), kwargs={}, name=func.__name__, coalesce=True, max_instances=1,
+              next_run_time=trigger.get_next_fire_time(None, datetime.now(trigger.timezone)), **options)
+    try:
+        store.add_job(job)
+    except ConflictingIdError:
+        store.update_job(job)
+
 if __name__ == "__main__":
     # Get environment from environment variable or use default
     env = os.environ.get('FLASK_ENV', 'development')
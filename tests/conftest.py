@@ -4,6 +4,8 @@ Pytest fixtures for the AssistITK12 test suite.
 Uses a SQLite in-memory database so tests never touch the real database.
 CSRF and rate-limiting are disabled for test simplicity.
 """
+import importlib.util
+
 import pytest
 from werkzeug.security import generate_password_hash
 
@@ -33,6 +35,19 @@ def app():
         # Disable APScheduler from actually starting background threads
         SCHEDULER_EXECUTORS = {'default': {'type': 'threadpool', 'max_workers': 1}}
         MAIL_SUPPRESS_SEND = True
+        EMAIL_OUTBOX_INTERVAL = 0  # tests call dispatch_email_outbox() directly
+        ONBOARDING_EMAILS_PER_MINUTE = 0  # tests call send_onboarding_emails() directly
+        ATTACHMENT_SWEEP_INTERVAL = 0  # tests call sweep_tombstones() directly
+        ATTACHMENT_ORPHAN_SCAN_HOURS = 0
+        THUMBNAIL_INTERVAL = 0  # tests call generate_thumbnails() directly
+        SCHEDULER_LEASE_SECONDS = 0  # tests call heartbeat() directly
+        SCHEDULER_JOB_STORE = 'memory'
+        SCHEDULER_AUTOSTART = 'off'  # tests call the jobs directly
+        TASK_POLL_INTERVAL = 0  # tests call run_queued_tasks() directly
+        # /metrics is tested when the optional 'metrics' extra is installed
+        METRICS_ENABLED = importlib.util.find_spec('prometheus_client') is not None
+        REQUEST_TIMING_ENABLED = True
+        PROFILER_ENABLED = True
 
     from config import config as config_map
     config_map['testing'] = TestingConfig
@@ -0,0 +1,637 @@
+"""
+Attachment tests: content-addressed storage, deduplication, streaming upload
+checks, deferred reference-counted deletes, orphan reclaim, thumbnails, ZIP
+downloads and storage backends.
+"""
+import hashlib
+import io
+import os
+import time
+import zipfile
+
+import pytest
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'screenshot' * 100
+
+
+@pytest.fixture()
+def attachment_dir(app, tmp_path, monkeypatch):
+    """Point UPLOAD_ATTACHMENT at a temp dir for the test."""
+    monkeypatch.setitem(app.config, 'UPLOAD_ATTACHMENT', str(tmp_path))
+    return tmp_path
+
+
+def _ticket(app):
+    """A ticket created by the seeded regular user; returns (ticket_id, title_id)."""
+    with app.app_context():
+        from main import db
+        from application.models import Ticket, Title, User
+        from application.utils import hash_email
+        title = Title.query.first() or Title(title_name='Attachment Title')
+        db.session.add(title)
+        creator = User.query.filter_by(email_hash=hash_email('user@test.com', app.config['SECRET_KEY'])).first()
+        ticket = Ticket(title=title, tck_status='1-pending', user_id=creator.id, site_id=1)
+        db.session.add(ticket)
+        db.session.commit()
+        return ticket.id, title.id
+
+
+def _attach(client, app, data=PNG, filename='photo.png'):
+    """Upload ``data`` to a new ticket through edit_ticket; returns (ticket_id, attachment_id)."""
+    ticket_id, title_id = _ticket(app)
+    client.post(f'/edit_ticket/{ticket_id}', data={
+        'title_id': str(title_id),
+        'tck_status': '1-pending',
+        'attachment': (io.BytesIO(data), filename),
+    }, content_type='multipart/form-data')
+    with app.app_context():
+        from application.models import Ticket_attachment
+        attachment = Ticket_attachment.query.filter_by(ticket_id=ticket_id).one()
+        return ticket_id, attachment.id
+
+
+def _sweep(app):
+    with app.app_context():
+        from application.attachments import sweep_tombstones
+        return sweep_tombstones()
+
+
+def _blob(app, sha256):
+    with app.app_context():
+        from main import db
+        from application.models import AttachmentBlob
+        blob = db.session.get(AttachmentBlob, sha256)
+        return blob and blob.ref_count
+
+
+class TestContentAddressedStorage:
+    def test_identical_uploads_share_one_sharded_file(self, app, admin_client, attachment_dir):
+        sha256 = hashlib.sha256(PNG).hexdigest()
+        _, first = _attach(admin_client, app)
+        _, second = _attach(admin_client, app)
+
+        blob_file = attachment_dir / sha256[:2] / sha256[2:4] / sha256
+        assert blob_file.read_bytes() == PNG
+        assert [p for p in attachment_dir.rglob('*') if p.is_file()] == [blob_file]
+        assert _blob(app, sha256) == 2
+
+        r = admin_client.get(f'/download_attachment/{second}')
+        assert r.status_code == 200
+        assert r.data == PNG
+        assert 'attachment; filename=ticket_' in r.headers['Content-Disposition']
+
+    def test_same_file_twice_on_one_ticket_is_not_duplicated(self, app, admin_client, attachment_dir):
+        ticket_id, _ = _attach(admin_client, app)
+        with app.app_context():
+            from main import db
+            from application.models import Ticket
+            title_id = db.session.get(Ticket, ticket_id).title_id
+        admin_client.post(f'/edit_ticket/{ticket_id}', data={
+            'title_id': str(title_id),
+            'tck_status': '1-pending',
+            'attachment': (io.BytesIO(PNG), 'again.png'),
+        }, content_type='multipart/form-data')
+        with app.app_context():
+            from application.models import Ticket_attachment
+            assert Ticket_attachment.query.filter_by(ticket_id=ticket_id).count() == 1
+
+
+class TestReferenceCountedDelete:
+    def test_blob_is_removed_with_its_last_reference(self, app, admin_client, attachment_dir):
+        data = PNG + b'refcount'
+        sha256 = hashlib.sha256(data).hexdigest()
+        _, first = _attach(admin_client, app, data)
+        second_ticket, _ = _attach(admin_client, app, data)
+        blob_file = attachment_dir / sha256[:2] / sha256[2:4] / sha256
+
+        admin_client.post(f'/delete_attachment/{first}')
+        assert _sweep(app) == (0, 0)
+        assert blob_file.exists()
+        assert _blob(app, sha256) == 1
+
+        admin_client.post(f'/delete_ticket/{second_ticket}')
+        assert blob_file.exists()  # removed by the sweeper, not the request
+        assert _blob(app, sha256) == 0
+        assert _sweep(app) == (1, 0)
+        assert not blob_file.exists()
+        assert _blob(app, sha256) is None
+
+    def test_legacy_flat_attachment_still_downloads_and_deletes(self, app, admin_client, attachment_dir):
+        ticket_id, _ = _ticket(app)
+        (attachment_dir / 'ticket_legacy.pdf').write_bytes(b'%PDF-1.4 legacy')
+        with app.app_context():
+            from main import db
+            from application.models import Ticket_attachment
+            attachment = Ticket_attachment(ticket_id=ticket_id, attach_image='ticket_legacy.pdf', user_id=1)
+            db.session.add(attachment)
+            db.session.commit()
+            attachment_id = attachment.id
+
+        assert admin_client.get(f'/download_attachment/{attachment_id}').data == b'%PDF-1.4 legacy'
+        admin_client.post(f'/delete_attachment/{attachment_id}')
+        _sweep(app)
+        assert not os.path.exists(attachment_dir / 'ticket_legacy.pdf')
+
+
+
+class CountingStream(io.BytesIO):
+    """Request body that records how much of it the server read."""
+
+    bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buffer):
+        n = super().readinto(buffer)
+        self.bytes_read += n
+        return n
+
+
+def _multipart_post(client, url, fields, filename, data):
+    """POST a multipart body through a CountingStream; returns (response, stream)."""
+    boundary = 'attachment-test-boundary'
+    parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+             for name, value in fields.items()]
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="attachment"; filename="{filename}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    body = b''.join(parts) + f'--{boundary}--\r\n'.encode()
+    stream = CountingStream(body)
+    response = client.post(url, input_stream=stream, content_length=len(body),
+                           content_type=f'multipart/form-data; boundary={boundary}')
+    return response, stream
+
+
+class TestStreamingUpload:
+    def test_spoofed_file_is_refused_after_the_first_chunk(self, app, admin_client, attachment_dir):
+        ticket_id, title_id = _ticket(app)
+        payload = b'MZ\x90\x00' + b'\x00' * (4 * 1024 * 1024)  # an .exe named .png
+        r, stream = _multipart_post(admin_client, f'/edit_ticket/{ticket_id}',
+                                    {'title_id': title_id, 'tck_status': '1-pending'}, 'photo.png', payload)
+
+        assert r.status_code == 302
+        assert stream.bytes_read < 256 * 1024
+        with admin_client.session_transaction() as sess:
+            assert ('error', 'File content does not match an allowed file type (JPG, PNG, PDF)') in sess['_flashes']
+        assert not [p for p in attachment_dir.rglob('*') if p.is_file()]
+
+    def test_oversized_file_is_refused_at_the_limit(self, app, admin_client, attachment_dir, monkeypatch):
+        monkeypatch.setitem(app.config, 'ATTACHMENT_MAX_SIZE_MB', 1)
+        ticket_id, title_id = _ticket(app)
+        r, stream = _multipart_post(admin_client, f'/edit_ticket/{ticket_id}',
+                                    {'title_id': title_id, 'tck_status': '1-pending'},
+                                    'big.png', PNG + b'\x00' * (4 * 1024 * 1024))
+
+        assert r.status_code == 302
+        assert stream.bytes_read < 2 * 1024 * 1024
+        with admin_client.session_transaction() as sess:
+            assert ('error', 'File size exceeds 1MB limit') in sess['_flashes']
+        assert not [p for p in attachment_dir.rglob('*') if p.is_file()]
+        with app.app_context():
+            from application.models import Ticket_attachment
+            assert Ticket_attachment.query.filter_by(ticket_id=ticket_id).count() == 0
+
+    def test_accepted_upload_is_renamed_into_place_without_a_copy(self, app, admin_client, attachment_dir):
+        data = PNG + b'streamed upload'
+        sha256 = hashlib.sha256(data).hexdigest()
+        ticket_id, title_id = _ticket(app)
+        r, _ = _multipart_post(admin_client, f'/edit_ticket/{ticket_id}',
+                               {'title_id': title_id, 'tck_status': '1-pending'}, 'photo.png', data)
+
+        assert r.status_code == 302
+        assert [p.name for p in attachment_dir.rglob('*') if p.is_file()] == [sha256]
+        assert _blob(app, sha256) == 1
+
+
+class TestDeferredDeletion:
+    def test_failed_file_delete_does_not_block_the_ticket_delete(self, app, admin_client, attachment_dir, monkeypatch):
+        from application.storage import LocalStorage
+        data = PNG + b'stuck'
+        sha256 = hashlib.sha256(data).hexdigest()
+        ticket_id, _ = _attach(admin_client, app, data)
+
+        admin_client.post(f'/delete_ticket/{ticket_id}')
+        with app.app_context():
+            from main import db
+            from application.models import AttachmentTombstone, Ticket
+            assert db.session.get(Ticket, ticket_id) is None
+            assert AttachmentTombstone.query.filter_by(blob_sha256=sha256).count() == 1
+
+        def refuse(self, key):
+            raise PermissionError('read-only volume')
+        monkeypatch.setattr(LocalStorage, 'delete', refuse)
+        assert _sweep(app) == (0, 1)
+        with app.app_context():
+            from application.models import AttachmentTombstone
+            tombstone = AttachmentTombstone.query.filter_by(blob_sha256=sha256).one()
+            assert tombstone.attempts == 1
+            assert 'read-only volume' in tombstone.last_error
+        assert _blob(app, sha256) == 0  # kept until the file is really gone
+
+        monkeypatch.undo()
+        monkeypatch.setitem(app.config, 'UPLOAD_ATTACHMENT', str(attachment_dir))
+        assert _sweep(app) == (1, 0)
+        assert _blob(app, sha256) is None
+
+    def test_reattached_content_survives_its_tombstone(self, app, admin_client, attachment_dir):
+        data = PNG + b'again'
+        sha256 = hashlib.sha256(data).hexdigest()
+        _, attachment_id = _attach(admin_client, app, data)
+        admin_client.post(f'/delete_attachment/{attachment_id}')
+        _attach(admin_client, app, data)
+
+        assert _sweep(app) == (0, 0)
+        assert (attachment_dir / sha256[:2] / sha256[2:4] / sha256).exists()
+        assert _blob(app, sha256) == 1
+
+    def test_reference_is_taken_before_the_stored_file_is_reused(self, app, admin_client, attachment_dir,
+                                                                 monkeypatch):
+        from application.storage import LocalStorage
+        data = PNG + b'race'
+        sha256 = hashlib.sha256(data).hexdigest()
+        _attach(admin_client, app, data)
+        refs_when_checked = []
+        exists = LocalStorage.exists
+
+        def checking_exists(self, key):
+            from main import db
+            from application.models import AttachmentBlob
+            refs_when_checked.append(db.session.get(AttachmentBlob, sha256, populate_existing=True).ref_count)
+            return exists(self, key)
+        monkeypatch.setattr(LocalStorage, 'exists', checking_exists)
+        _attach(admin_client, app, data)
+        # The sweeper can no longer delete the file that store_blob found
+        assert refs_when_checked == [2]
+
+    def test_tombstone_of_a_swept_blob_leaves_a_new_upload_alone(self, app, attachment_dir):
+        data = PNG + b'in flight'
+        sha256 = hashlib.sha256(data).hexdigest()
+        blob_file = attachment_dir / sha256[:2] / sha256[2:4] / sha256
+        blob_file.parent.mkdir(parents=True)
+        blob_file.write_bytes(data)  # saved by an upload whose row isn't committed yet
+        with app.app_context():
+            from main import db
+            from application.attachments import blob_key
+            from application.models import AttachmentTombstone
+            db.session.add(AttachmentTombstone(storage_key=blob_key(sha256), blob_sha256=sha256))
+            db.session.commit()
+
+        assert _sweep(app) == (0, 0)
+        assert blob_file.exists()
+
+
+class TestOrphanReclaim:
+    def test_unreferenced_files_are_reclaimed_after_the_grace_period(self, app, admin_client, attachment_dir):
+        _attach(admin_client, app, PNG + b'kept')
+        orphan_sha = hashlib.sha256(b'orphan').hexdigest()
+        orphan = attachment_dir / orphan_sha[:2] / orphan_sha[2:4] / orphan_sha
+        orphan.parent.mkdir(parents=True)
+        orphan.write_bytes(b'orphan')
+        crashed_upload = attachment_dir / '.upload-crashed'
+        crashed_upload.write_bytes(b'half an upload')
+        fresh = attachment_dir / '.upload-in-flight'
+        fresh.write_bytes(b'still uploading')
+        hour_ago = time.time() - 7200
+        for path in attachment_dir.rglob('*'):
+            if path.is_file() and path != fresh:
+                os.utime(path, (hour_ago, hour_ago))
+
+        with app.app_context():
+            from application.attachments import reclaim_orphaned_files
+            assert reclaim_orphaned_files(batch_size=1) == (2, len(b'orphan') + len(b'half an upload'))
+
+        remaining = sorted(p.name for p in attachment_dir.rglob('*') if p.is_file())
+        assert remaining == sorted([hashlib.sha256(PNG + b'kept').hexdigest(), '.upload-in-flight'])
+
+
+
+def _ready_thumbnail(app, attachment_dir, sha256, data=b'RIFF-thumbnail'):
+    """Store a thumbnail for a blob as the thumbnail job would."""
+    thumb = attachment_dir / 'thumbs' / sha256[:2] / sha256[2:4] / f'{sha256}.webp'
+    thumb.parent.mkdir(parents=True, exist_ok=True)
+    thumb.write_bytes(data)
+    with app.app_context():
+        from main import db
+        from application.models import AttachmentBlob
+        blob = db.session.get(AttachmentBlob, sha256)
+        blob.thumbnail_status, blob.thumbnail_format = 'ready', 'webp'
+        db.session.commit()
+    return thumb
+
+
+class TestThumbnails:
+    def test_images_are_queued_and_pdfs_are_not(self, app, admin_client, attachment_dir):
+        png = PNG + b'queued'
+        pdf = b'%PDF-1.4 manual'
+        _, attachment_id = _attach(admin_client, app, png)
+        _attach(admin_client, app, pdf, 'manual.pdf')
+        assert admin_client.get(f'/attachment_thumbnail/{attachment_id}').status_code == 404
+        with app.app_context():
+            from main import db
+            from application.models import AttachmentBlob
+            assert db.session.get(AttachmentBlob, hashlib.sha256(png).hexdigest()).thumbnail_status == 'pending'
+            assert db.session.get(AttachmentBlob, hashlib.sha256(pdf).hexdigest()).thumbnail_status is None
+
+    def test_ready_thumbnail_is_cached_and_shown_inline(self, app, admin_client, attachment_dir):
+        data = PNG + b'thumbnail'
+        sha256 = hashlib.sha256(data).hexdigest()
+        ticket_id, attachment_id = _attach(admin_client, app, data)
+        _ready_thumbnail(app, attachment_dir, sha256)
+        r = admin_client.get(f'/attachment_thumbnail/{attachment_id}')
+        assert r.status_code == 200
+        assert r.data == b'RIFF-thumbnail'
+        assert r.headers['Content-Type'] == 'image/webp'
+        assert r.headers['Content-Disposition'].startswith('inline')
+        assert r.cache_control.private and r.cache_control.immutable
+        assert r.cache_control.max_age == 365 * 24 * 3600
+
+        page = admin_client.get(f'/edit_ticket/{ticket_id}').data.decode()
+        assert f'src="/attachment_thumbnail/{attachment_id}"' in page
+
+    def test_thumbnail_is_removed_with_its_blob(self, app, admin_client, attachment_dir):
+        data = PNG + b'thumbnail gone'
+        sha256 = hashlib.sha256(data).hexdigest()
+        ticket_id, _ = _attach(admin_client, app, data)
+        thumb = _ready_thumbnail(app, attachment_dir, sha256)
+
+        admin_client.post(f'/delete_ticket/{ticket_id}')
+        assert _sweep(app) == (1, 0)
+        assert not thumb.exists()
+
+    def test_generate_thumbnails(self, app, admin_client, attachment_dir):
+        Image = pytest.importorskip('PIL.Image')
+        photo = io.BytesIO()
+        Image.new('RGB', (2000, 1000), 'navy').save(photo, format='JPEG')
+        _, attachment_id = _attach(admin_client, app, photo.getvalue(), 'photo.jpg')
+
+        with app.app_context():
+            from main import db
+            from application.models import AttachmentBlob, Ticket_attachment
+            from application.thumbnails import generate_thumbnails
+            # Stored re-encoded, without metadata, so under a new hash
+            sha256 = db.session.get(Ticket_attachment, attachment_id).blob_sha256
+            created, failed = generate_thumbnails()
+            assert created >= 1
+            blob = db.session.get(AttachmentBlob, sha256)
+            assert blob.thumbnail_status == 'ready'
+            fmt = blob.thumbnail_format
+
+        thumb = attachment_dir / 'thumbs' / sha256[:2] / sha256[2:4] / f'{sha256}.{fmt}'
+        with Image.open(thumb) as image:
+            assert max(image.size) == 320
+        assert admin_client.get(f'/attachment_thumbnail/{attachment_id}').data == thumb.read_bytes()
+
+
+
+class TestIngestDownscale:
+    def test_sizes_are_recorded_and_images_kept_as_sent_by_default(self, app, admin_client, attachment_dir):
+        data = PNG + b'as sent'
+        sha256 = hashlib.sha256(data).hexdigest()
+        _, attachment_id = _attach(admin_client, app, data)
+        with app.app_context():
+            from main import db
+            from application.models import Ticket_attachment
+            attachment = db.session.get(Ticket_attachment, attachment_id)
+            assert attachment.original_size == attachment.blob.size == len(data)
+            assert attachment.blob_sha256 == sha256
+
+    def test_large_photo_is_downscaled_without_exif(self, app, admin_client, attachment_dir, monkeypatch):
+        Image = pytest.importorskip('PIL.Image')
+        monkeypatch.setitem(app.config, 'ATTACHMENT_MAX_DIMENSION', 1024)
+        photo = io.BytesIO()
+        exif = Image.Exif()
+        exif[0x010F] = 'PhoneMaker'  # Make
+        ImageCms = pytest.importorskip('PIL.ImageCms')
+        icc_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        Image.effect_noise((3000, 2000), 64).convert('RGB').save(photo, format='JPEG', quality=95, exif=exif,
+                                                                    icc_profile=icc_profile)
+        data = photo.getvalue()
+        _, attachment_id = _attach(admin_client, app, data, 'photo.jpg')
+
+        with app.app_context():
+            from main import db
+            from application.attachments import attachment_key
+            from application.models import Ticket_attachment
+            attachment = db.session.get(Ticket_attachment, attachment_id)
+            assert attachment.original_size == len(data)
+            assert attachment.blob.size < len(data)
+            stored = attachment_dir / attachment_key(attachment)
+        with Image.open(stored) as image:
+            assert image.format == 'JPEG'
+            assert max(image.size) == 1024
+            assert not image.getexif()
+            assert image.info['icc_profile'] == icc_profile
+
+    def _stored(self, app, attachment_dir, attachment_id):
+        from main import db
+        from application.attachments import attachment_key
+        from application.models import Ticket_attachment
+        with app.app_context():
+            return (attachment_dir / attachment_key(db.session.get(Ticket_attachment, attachment_id))).read_bytes()
+
+    def test_small_photo_is_stored_without_gps(self, app, admin_client, attachment_dir):
+        Image = pytest.importorskip('PIL.Image')
+        ImageCms = pytest.importorskip('PIL.ImageCms')
+        assert not app.config['ATTACHMENT_MAX_DIMENSION']
+        photo = io.BytesIO()
+        exif = Image.Exif()
+        exif[0x010F] = 'PhoneMaker'  # Make
+        exif[0x0112] = 6  # Orientation: rotate 90 degrees to display
+        exif[0x8825] = {1: 'N', 3: 'W'}  # GPSInfo: GPSLatitudeRef, GPSLongitudeRef
+        icc_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        Image.effect_noise((400, 300), 64).convert('RGB').save(photo, format='JPEG', exif=exif,
+                                                                  icc_profile=icc_profile)
+        data = photo.getvalue()
+        with Image.open(io.BytesIO(data)) as sent:
+            assert sent.getexif().get_ifd(0x8825)
+            pixels = sent.tobytes()
+        _, attachment_id = _attach(admin_client, app, data, 'photo.jpg')
+
+        stored = self._stored(app, attachment_dir, attachment_id)
+        assert len(stored) < len(data)
+        with Image.open(io.BytesIO(stored)) as image:
+            assert dict(image.getexif()) == {0x0112: 6}
+            assert image.info['icc_profile'] == icc_profile
+            assert image.tobytes() == pixels  # not re-encoded
+
+    def test_png_text_chunks_are_removed(self, app, admin_client, attachment_dir):
+        Image = pytest.importorskip('PIL.Image')
+        PngImagePlugin = pytest.importorskip('PIL.PngImagePlugin')
+        info = PngImagePlugin.PngInfo()
+        info.add_text('Comment', 'taken at 12 Main St')
+        photo = io.BytesIO()
+        Image.effect_noise((40, 30), 64).convert('RGB').save(photo, format='PNG', pnginfo=info)
+        data = photo.getvalue()
+        _, attachment_id = _attach(admin_client, app, data, 'screen.png')
+
+        stored = self._stored(app, attachment_dir, attachment_id)
+        assert b'12 Main St' not in stored
+        with Image.open(io.BytesIO(stored)) as image, Image.open(io.BytesIO(data)) as sent:
+            assert image.tobytes() == sent.tobytes()
+
+    def test_metadata_is_kept_when_stripping_is_off(self, app, admin_client, attachment_dir, monkeypatch):
+        Image = pytest.importorskip('PIL.Image')
+        monkeypatch.setitem(app.config, 'ATTACHMENT_STRIP_METADATA', False)
+        photo = io.BytesIO()
+        exif = Image.Exif()
+        exif[0x010F] = 'PhoneMaker'  # Make
+        Image.effect_noise((40, 30), 64).convert('RGB').save(photo, format='JPEG', exif=exif)
+        data = photo.getvalue()
+        _, attachment_id = _attach(admin_client, app, data, 'photo.jpg')
+        assert self._stored(app, attachment_dir, attachment_id) == data
+
+
+
+class TestDownloadAll:
+    def test_zip_contains_every_attachment(self, app, admin_client, attachment_dir):
+        ticket_id, title_id = _ticket(app)
+        files = {'one.png': PNG + b'one', 'two.pdf': b'%PDF-1.4 two'}
+        for filename, data in files.items():
+            admin_client.post(f'/edit_ticket/{ticket_id}', data={
+                'title_id': str(title_id),
+                'tck_status': '1-pending',
+                'attachment': (io.BytesIO(data), filename),
+            }, content_type='multipart/form-data')
+
+        r = admin_client.get(f'/download_attachments/{ticket_id}')
+        assert r.status_code == 200
+        assert r.is_streamed
+        assert r.mimetype == 'application/zip'
+        assert f'filename=ticket_{ticket_id}_attachments.zip' in r.headers['Content-Disposition']
+        with zipfile.ZipFile(io.BytesIO(r.data)) as archive:
+            assert archive.testzip() is None
+            contents = sorted(archive.read(name) for name in archive.namelist())
+            assert len(set(archive.namelist())) == 2
+        assert contents == sorted(files.values())
+
+    def test_zip_is_streamed_in_bounded_pieces(self, app, attachment_dir):
+        from application.storage import CHUNK_SIZE
+        (attachment_dir / 'big.pdf').write_bytes(b'%PDF' + os.urandom(1024 * 1024))
+        (attachment_dir / 'same-name.pdf').write_bytes(b'%PDF second')
+        with app.app_context():
+            from application.attachments import iter_attachments_zip
+            entries = [('big.pdf', 'report.pdf', None), ('same-name.pdf', 'report.pdf', None),
+                       ('missing.pdf', 'missing.pdf', None)]
+            pieces = list(iter_attachments_zip(entries))
+        assert max(len(piece) for piece in pieces) <= CHUNK_SIZE + 1024
+        with zipfile.ZipFile(io.BytesIO(b''.join(pieces))) as archive:
+            assert archive.namelist() == ['report.pdf', 'report_2.pdf']
+
+    def test_zip_requires_ticket_access(self, app, user_client, attachment_dir):
+        ticket_id, _ = _ticket(app)
+        with app.app_context():
+            from main import db
+            from application.models import Ticket
+            db.session.get(Ticket, ticket_id).user_id = 1  # someone else's ticket
+            db.session.commit()
+        assert user_client.get(f'/download_attachments/{ticket_id}').status_code == 403
+
+
+class TestStorageBackends:
+    def test_local_storage_round_trip(self, tmp_path):
+        from application.storage import LocalStorage
+        storage = LocalStorage(str(tmp_path))
+        staged = tmp_path / '.upload-test'
+        staged.write_bytes(b'bytes')
+
+        storage.save('ab/cd/abcd', str(staged))
+        assert not staged.exists()
+        assert storage.exists('ab/cd/abcd')
+        with storage.open('ab/cd/abcd') as f:
+            assert f.read() == b'bytes'
+        storage.delete('ab/cd/abcd')
+        storage.delete('ab/cd/abcd')  # already gone is fine
+        assert not storage.exists('ab/cd/abcd')
+
+    def test_download_streams_from_a_backend_without_local_paths(self, app, admin_client, attachment_dir, monkeypatch):
+        from application import attachments
+        from application.storage import LocalStorage
+
+        class RemoteLike(LocalStorage):
+            def local_path(self, key):
+                return None
+
+        monkeypatch.setattr(attachments, 'get_storage', lambda: RemoteLike(str(attachment_dir)))
+        data = PNG + b'streamed'
+        _, attachment_id = _attach(admin_client, app, data)
+
+        r = admin_client.get(f'/download_attachment/{attachment_id}')
+        assert r.status_code == 200
+        assert r.is_streamed
+        assert r.data == data
+
+    def test_s3_driver_against_a_local_stand_in(self, app, admin_client, monkeypatch):
+        pytest.importorskip('boto3')
+        moto_server = pytest.importorskip('moto.server')
+        server = moto_server.ThreadedMotoServer(port=0)
+        server.start()
+        try:
+            host, port = server.get_host_and_port()
+            for var, value in (('AWS_ACCESS_KEY_ID', 'test'), ('AWS_SECRET_ACCESS_KEY', 'test')):
+                monkeypatch.setenv(var, value)
+            for key, value in (('ATTACHMENT_STORAGE', 's3'), ('ATTACHMENT_S3_BUCKET', 'attachments'),
+                               ('ATTACHMENT_S3_ENDPOINT_URL', f'http://{host}:{port}'),
+                               ('ATTACHMENT_S3_REGION', 'us-east-1')):
+                monkeypatch.setitem(app.config, key, value)
+            with app.app_context():
+                from application.storage import get_storage
+                storage = get_storage()
+                storage.client.create_bucket(Bucket='attachments')
+
+            data = PNG + b's3'
+            sha256 = hashlib.sha256(data).hexdigest()
+            ticket_id, attachment_id = _attach(admin_client, app, data)
+            assert storage.exists(f'{sha256[:2]}/{sha256[2:4]}/{sha256}')
+            assert admin_client.get(f'/download_attachment/{attachment_id}').data == data
+
+            admin_client.post(f'/delete_ticket/{ticket_id}')
+            _sweep(app)
+            assert not storage.exists(f'{sha256[:2]}/{sha256[2:4]}/{sha256}')
+        finally:
+            app.extensions.pop('attachment_storage', None)
+            server.stop()
+
+
+class TestSendfileOffload:
+    def test_x_accel_redirect_names_the_internal_location(self, app, admin_client, attachment_dir, monkeypatch):
+        monkeypatch.setitem(app.config, 'ATTACHMENT_SENDFILE', 'x-accel')
+        data = PNG + b'accel'
+        sha256 = hashlib.sha256(data).hexdigest()
+        _, attachment_id = _attach(admin_client, app, data)
+
+        r = admin_client.get(f'/download_attachment/{attachment_id}')
+        assert r.status_code == 200
+        assert r.headers['X-Accel-Redirect'] == f'/protected-attachments/{sha256[:2]}/{sha256[2:4]}/{sha256}'
+        assert r.headers['Content-Type'] == 'image/png'
+        assert 'attachment; filename=ticket_' in r.headers['Content-Disposition']
+        assert r.data == b''
+
+    def test_x_sendfile_names_the_file_path(self, app, admin_client, attachment_dir, monkeypatch):
+        monkeypatch.setitem(app.config, 'ATTACHMENT_SENDFILE', 'x-sendfile')
+        data = PNG + b'sendfile'
+        sha256 = hashlib.sha256(data).hexdigest()
+        _, attachment_id = _attach(admin_client, app, data)
+
+        r = admin_client.get(f'/download_attachment/{attachment_id}')
+        assert r.headers['X-Sendfile'] == str(attachment_dir / sha256[:2] / sha256[2:4] / sha256)
+        assert r.data == b''
+
+    def test_offload_still_checks_ticket_access(self, app, user_client, attachment_dir, monkeypatch):
+        monkeypatch.setitem(app.config, 'ATTACHMENT_SENDFILE', 'x-accel')
+        ticket_id, _ = _ticket(app)
+        with app.app_context():
+            from werkzeug.datastructures import FileStorage
+            from main import db
+            from application.attachments import add_attachment
+            from application.models import Ticket
+            ticket = db.session.get(Ticket, ticket_id)
+            ticket.user_id = 1  # someone else's ticket
+            attachment = add_attachment(ticket, FileStorage(io.BytesIO(PNG + b'private'), 'private.png'), 1)
+            db.session.commit()
+            attachment_id = attachment.id
+
+        r = user_client.get(f'/download_attachment/{attachment_id}')
+        assert r.status_code == 403
+        assert 'X-Accel-Redirect' not in r.headers
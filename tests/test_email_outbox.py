@@ -0,0 +1,434 @@
+"""
+Email outbox tests: notifications are queued with the ticket change and sent,
+retried or dead-lettered by the dispatcher; welcome emails for imported users
+are sent by the rate-limited onboarding worker.
+"""
+from datetime import timedelta
+
+import pytest
+
+
+@pytest.fixture()
+def mail_org(app):
+    """Organization with SMTP settings saved, so notifications are queued."""
+    with app.app_context():
+        from main import db
+        from application.models import Organization, EmailOutbox
+        org = db.session.get(Organization, 1)
+        org.mail_server = 'smtp.test'
+        org.mail_username = 'helpdesk@test.com'
+        EmailOutbox.query.delete()
+        db.session.commit()
+    yield
+    with app.app_context():
+        from main import db
+        from application.models import Organization
+        org = db.session.get(Organization, 1)
+        org.mail_server = org.mail_username = None
+        db.session.commit()
+
+
+@pytest.fixture()
+def sent_mail(monkeypatch):
+    """Record messages sent through a Flask-Mail connection instead of sending them."""
+    import flask_mail
+    from application.email_utils import smtp_connection
+    sent = []
+    monkeypatch.setattr(flask_mail.Connection, 'send', lambda self, msg: sent.append(msg))
+    smtp_connection.close()
+    yield sent
+    smtp_connection.close()
+
+
+def _user_ticket(app):
+    """A ticket created by the seeded regular user."""
+    with app.app_context():
+        from main import db
+        from application.models import Ticket, Title, User
+        from application.utils import hash_email
+        title = Title.query.first() or Title(title_name='Outbox Title')
+        db.session.add(title)
+        creator = User.query.filter_by(email_hash=hash_email('user@test.com', app.config['SECRET_KEY'])).first()
+        ticket = Ticket(title=title, tck_status='1-pending', user_id=creator.id, site_id=1)
+        db.session.add(ticket)
+        db.session.commit()
+        return ticket.id
+
+
+def _queue(app, ticket_id, **overrides):
+    with app.app_context():
+        from main import db
+        from application.models import EmailOutbox
+        row = EmailOutbox(event='comment', ticket_id=ticket_id, subject='Subject', body='Body', **overrides)
+        row.recipient_email = 'user@test.com'
+        db.session.add(row)
+        db.session.commit()
+        return row.id
+
+
+class TestQueueing:
+    def test_comment_is_queued_not_sent(self, app, admin_client, mail_org, sent_mail):
+        ticket_id = _user_ticket(app)
+        r = admin_client.post(f'/add_comment/{ticket_id}', data={'content': 'Looking into it.'})
+        assert r.get_json()['success'] is True
+        assert sent_mail == []
+
+        with app.app_context():
+            from application.models import EmailOutbox
+            row = EmailOutbox.query.filter_by(ticket_id=ticket_id).one()
+            assert row.status == 'pending'
+            assert row.recipient_email == 'user@test.com'
+            assert 'Looking into it.' in row.body
+
+    def test_edit_ticket_queues_with_the_change(self, app, admin_client, mail_org, sent_mail):
+        ticket_id = _user_ticket(app)
+        with app.app_context():
+            from main import db
+            from application.models import Ticket
+            title_id = db.session.get(Ticket, ticket_id).title_id
+        admin_client.post(f'/edit_ticket/{ticket_id}', data={
+            'title_id': str(title_id),
+            'tck_status': '2-progress',
+            'contents-0-content': 'On my way.',
+        })
+        with app.app_context():
+            from application.models import EmailOutbox
+            # The status change and the comment reach the creator as one email
+            row = EmailOutbox.query.filter_by(ticket_id=ticket_id).one()
+            assert row.event == 'update'
+            assert row.subject == f'Ticket #{ticket_id} Updated'
+            assert 'Pending → In Progress' in row.body
+            assert 'On my way.' in row.body
+            assert row.body.count('Ticket: #') == row.body_html.count('Ticket:</strong> #') == 1
+            assert '<strong>In Progress</strong>' in row.body_html
+            assert 'On my way.</blockquote>' in row.body_html
+        assert sent_mail == []
+
+    def test_nothing_queued_without_smtp_settings(self, app, admin_client):
+        ticket_id = _user_ticket(app)
+        admin_client.post(f'/add_comment/{ticket_id}', data={'content': 'No mail server.'})
+        with app.app_context():
+            from application.models import EmailOutbox
+            assert EmailOutbox.query.filter_by(ticket_id=ticket_id).count() == 0
+
+
+@pytest.fixture()
+def digest_user(app):
+    """The seeded regular user, with a 15 minute digest window."""
+    with app.app_context():
+        from main import db
+        from application.models import User
+        from application.utils import hash_email
+        user = User.query.filter_by(email_hash=hash_email('user@test.com', app.config['SECRET_KEY'])).first()
+        user.email_digest_minutes = 15
+        db.session.commit()
+        user_id = user.id
+    yield user_id
+    with app.app_context():
+        from main import db
+        from application.models import User
+        db.session.get(User, user_id).email_digest_minutes = 0
+        db.session.commit()
+
+
+class TestDigest:
+    def _comment(self, app, ticket_id, text):
+        with app.app_context():
+            from main import db
+            from application.email_utils import queue_ticket_notification
+            from application.models import Ticket, User
+            from application.utils import hash_email
+            admin = User.query.filter_by(email_hash=hash_email('admin@test.com', app.config['SECRET_KEY'])).first()
+            queue_ticket_notification('comment', db.session.get(Ticket, ticket_id), commenter=admin, comment_text=text)
+            db.session.commit()
+
+    def test_updates_across_tickets_are_sent_as_one_summary(self, app, mail_org, sent_mail, digest_user):
+        self._comment(app, _user_ticket(app), 'First ticket update.')
+        self._comment(app, _user_ticket(app), 'Second ticket update.')
+        with app.app_context():
+            from main import db
+            from application.email_utils import dispatch_email_outbox
+            from application.models import EmailOutbox, _utcnow
+            rows = EmailOutbox.query.filter_by(recipient_id=digest_user).all()
+            assert len(rows) == 2 and all(row.digest for row in rows)
+            assert rows[0].next_attempt_at == rows[1].next_attempt_at > _utcnow() + timedelta(minutes=14)
+
+            # Held until the window closes
+            assert dispatch_email_outbox() == (0, 0)
+            for row in rows:
+                row.next_attempt_at = _utcnow() - timedelta(seconds=1)
+            db.session.commit()
+            assert dispatch_email_outbox() == (1, 0)
+            assert {row.status for row in EmailOutbox.query.filter_by(recipient_id=digest_user)} == {'sent'}
+
+        assert len(sent_mail) == 1
+        assert '2 Updates' in sent_mail[0].subject
+        assert 'First ticket update.' in sent_mail[0].body
+        assert 'Second ticket update.' in sent_mail[0].body
+
+    def test_profile_sets_digest_window(self, app, user_client):
+        from application.models import User
+        from application.utils import hash_email
+
+        def digest_minutes():
+            with app.app_context():
+                user = User.query.filter_by(email_hash=hash_email('user@test.com', app.config['SECRET_KEY'])).first()
+                return user.email_digest_minutes
+
+        user_client.post('/profile/notifications', data={'email_digest_minutes': '7'})
+        assert digest_minutes() == 0
+        user_client.post('/profile/notifications', data={'email_digest_minutes': '60'})
+        assert digest_minutes() == 60
+        user_client.post('/profile/notifications', data={'email_digest_minutes': '0'})
+        assert digest_minutes() == 0
+        assert b'Email Notifications' in user_client.get('/profile').data
+
+
+class TestTemplates:
+    def test_event_is_rendered_once_for_all_recipients(self, app, mail_org, monkeypatch):
+        from application import email_utils
+        ticket_id = _user_ticket(app)
+        renders = []
+        real_render = email_utils._render_event
+        monkeypatch.setattr(email_utils, '_render_event', lambda *a, **kw: renders.append(a[0]) or real_render(*a, **kw))
+        with app.app_context():
+            from main import db
+            from application.models import EmailOutbox, Ticket, User
+            from application.utils import hash_email
+            ticket = db.session.get(Ticket, ticket_id)
+            ticket.assigned_to_id = User.query.filter_by(
+                email_hash=hash_email('admin@test.com', app.config['SECRET_KEY'])).first().id
+            email_utils.queue_ticket_notification('escalated', ticket, escalated=True)
+            db.session.commit()
+            rows = EmailOutbox.query.filter_by(ticket_id=ticket_id).all()
+            assert len(rows) == 2 and renders == ['escalated']
+            assert {row.recipient_email for row in rows} == {'admin@test.com', 'user@test.com'}
+
+    def test_message_has_text_and_escaped_html_parts(self, app, admin_client, mail_org, sent_mail):
+        ticket_id = _user_ticket(app)
+        admin_client.post(f'/add_comment/{ticket_id}', data={'content': 'Replace <b>toner</b> & retry.'})
+        with app.app_context():
+            from application.email_utils import dispatch_email_outbox
+            assert dispatch_email_outbox() == (1, 0)
+
+        msg = sent_mail[0]
+        assert msg.subject == f'New Comment on Ticket #{ticket_id}'
+        assert msg.body.startswith('Hi Regular,\n\nTicket: #')
+        assert 'added a comment:\nReplace <b>toner</b> & retry.' in msg.body
+        assert msg.body.endswith('— AssistITK12 System')
+        assert 'Replace &lt;b&gt;toner&lt;/b&gt; &amp; retry.' in msg.html
+        assert '<p style="margin:0 0 12px;">Hi Regular,</p>' in msg.html
+
+
+class TestDispatcher:
+    def test_sends_due_rows(self, app, mail_org, sent_mail):
+        row_id = _queue(app, _user_ticket(app))
+        with app.app_context():
+            from main import db
+            from application.email_utils import dispatch_email_outbox
+            from application.models import EmailOutbox
+            assert dispatch_email_outbox() == (1, 0)
+            row = db.session.get(EmailOutbox, row_id)
+            assert row.status == 'sent'
+            assert row.claim_token is None
+        assert sent_mail[0].recipients == ['user@test.com']
+
+    def test_failure_backs_off_then_dead_letters(self, app, mail_org, monkeypatch):
+        import flask_mail
+
+        def fail(self, msg):
+            raise ConnectionRefusedError('smtp down')
+        monkeypatch.setattr(flask_mail.Connection, 'send', fail)
+        monkeypatch.setitem(app.config, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 3)
+        row_id = _queue(app, _user_ticket(app))
+
+        with app.app_context():
+            from main import db
+            from application.email_utils import dispatch_email_outbox
+            from application.models import EmailOutbox, _utcnow
+            delays = []
+            for _ in range(3):
+                assert dispatch_email_outbox() == (0, 1)
+                row = db.session.get(EmailOutbox, row_id)
+                delays.append(row.next_attempt_at - _utcnow())
+                row.next_attempt_at = _utcnow() - timedelta(seconds=1)  # make it due again
+                db.session.commit()
+
+            assert row.status == 'dead'
+            assert row.attempts == 3
+            assert 'smtp down' in row.last_error
+            # 60s, then 120s backoff before giving up
+            assert timedelta(seconds=50) < delays[0] <= timedelta(seconds=60)
+            assert timedelta(seconds=110) < delays[1] <= timedelta(seconds=120)
+            assert dispatch_email_outbox() == (0, 0)
+
+    def test_claimed_rows_are_skipped(self, app, mail_org, sent_mail):
+        with app.app_context():
+            from application.models import _utcnow
+            claimed_until = _utcnow() + timedelta(minutes=5)
+        _queue(app, _user_ticket(app), claim_token='other-worker', next_attempt_at=claimed_until)
+        with app.app_context():
+            from application.email_utils import dispatch_email_outbox
+            assert dispatch_email_outbox() == (0, 0)
+        assert sent_mail == []
+
+
+class TestConnectionReuse:
+    def _dispatch(self, app):
+        from application.email_utils import dispatch_email_outbox, smtp_connection
+        with app.app_context():
+            before = smtp_connection.handshakes, smtp_connection.messages
+            dispatch_email_outbox()
+            return smtp_connection.handshakes - before[0], smtp_connection.messages - before[1]
+
+    def test_one_handshake_per_batch(self, app, mail_org, sent_mail):
+        ticket_id = _user_ticket(app)
+        for _ in range(5):
+            _queue(app, ticket_id)
+        assert self._dispatch(app) == (1, 5)
+
+        # The next batch reuses the warm connection
+        _queue(app, ticket_id)
+        assert self._dispatch(app) == (0, 1)
+
+    def test_idle_connection_is_reopened(self, app, mail_org, sent_mail, monkeypatch):
+        ticket_id = _user_ticket(app)
+        _queue(app, ticket_id)
+        assert self._dispatch(app) == (1, 1)
+
+        monkeypatch.setitem(app.config, 'SMTP_IDLE_TIMEOUT', -1)
+        _queue(app, ticket_id)
+        assert self._dispatch(app) == (1, 1)
+
+    def test_dropped_connection_is_retried_once(self, app, mail_org, sent_mail, monkeypatch):
+        import smtplib
+        import flask_mail
+        record = flask_mail.Connection.send
+        calls = []
+
+        def drop_first(self, msg):
+            calls.append(msg)
+            if len(calls) == 1:
+                raise smtplib.SMTPServerDisconnected('idle timeout')
+            record(self, msg)
+        monkeypatch.setattr(flask_mail.Connection, 'send', drop_first)
+
+        _queue(app, _user_ticket(app))
+        assert self._dispatch(app) == (2, 1)
+        assert len(sent_mail) == 1
+
+
+@pytest.fixture()
+def imported_users(app):
+    """Three users created by one import run (without deactivating anyone else). Yields the log id."""
+    with app.app_context():
+        from main import db
+        from application.import_engine import plan_users, apply_user_plan, parse_csv
+        from application.models import BulkUploadLog, OnboardingEmail
+        OnboardingEmail.query.delete()
+        suffix = BulkUploadLog.query.count()
+        rows = parse_csv((
+            'first_name,middle_name,last_name,email,role_id,site_name,rm_num,status\n' + ''.join(
+                f'New,,Staff{n},onboard{suffix}-{n}@test.com,4,Main School,{n},Active\n' for n in range(3)
+            )
+        ).encode('utf-8'))
+        log = BulkUploadLog(filename='onboarding.csv', total_records=3, status='success')
+        db.session.add(log)
+        db.session.flush()
+        apply_user_plan(plan_users(rows, app.config['SECRET_KEY'], deactivate=False), log)
+        db.session.commit()
+        return log.id
+
+
+class TestOnboarding:
+    def _send(self, app, limit):
+        with app.app_context():
+            from application.email_utils import send_onboarding_emails
+            return send_onboarding_emails(limit)
+
+    def test_welcome_emails_are_queued_and_sent_at_the_configured_rate(
+            self, app, admin_client, mail_org, sent_mail, imported_users, monkeypatch):
+        from werkzeug.security import check_password_hash
+        monkeypatch.setitem(app.config, 'ONBOARDING_EMAILS_PER_MINUTE', 2)
+        admin_client.post(f'/bulk-upload-log/{imported_users}/welcome-emails')
+        admin_client.post(f'/bulk-upload-log/{imported_users}/welcome-emails')  # nothing new to queue
+        with app.app_context():
+            from application.models import OnboardingEmail
+            assert OnboardingEmail.query.filter_by(import_log_id=imported_users).count() == 3
+
+        with app.app_context():
+            from application.email_utils import send_onboarding_emails
+            assert send_onboarding_emails() == (2, 0)
+            assert send_onboarding_emails() == (1, 0)
+            assert send_onboarding_emails() == (0, 0)
+
+            from application.models import OnboardingEmail
+            row = OnboardingEmail.query.filter_by(import_log_id=imported_users).first()
+            assert row.status == 'sent'
+            body = next(msg.body for msg in sent_mail if msg.recipients == [row.user.email])
+            temp_password = body.split('Temporary Password: ')[1].split()[0]
+            assert check_password_hash(row.user.password, temp_password)
+        assert b'3 / 3 welcomed' in admin_client.get('/bulk-data-upload').data
+
+    def test_interrupted_run_resumes_with_the_next_user(self, app, mail_org, sent_mail, imported_users, monkeypatch):
+        import flask_mail
+        with app.app_context():
+            from main import db
+            from application.email_utils import queue_onboarding_emails
+            from application.models import BulkUploadLog
+            queue_onboarding_emails(db.session.get(BulkUploadLog, imported_users))
+            db.session.commit()
+
+        record = flask_mail.Connection.send
+
+        def crash_on_second(self, msg):
+            if len(sent_mail) == 1:
+                raise KeyboardInterrupt  # the worker process is killed mid-run
+            record(self, msg)
+        monkeypatch.setattr(flask_mail.Connection, 'send', crash_on_second)
+        with pytest.raises(KeyboardInterrupt):
+            self._send(app, 10)
+        monkeypatch.setattr(flask_mail.Connection, 'send', record)
+
+        with app.app_context():
+            from main import db
+            from application.models import OnboardingEmail, _utcnow
+            # The crashed worker's claim lapses...
+            OnboardingEmail.query.filter_by(status='pending').update(
+                {'next_attempt_at': _utcnow() - timedelta(seconds=1)}, synchronize_session=False)
+            db.session.commit()
+        # ...and the next run sends only the two emails that had not gone out
+        assert self._send(app, 10) == (2, 0)
+        assert len({tuple(msg.recipients) for msg in sent_mail}) == len(sent_mail) == 3
+
+    def test_users_who_already_signed_in_are_skipped(self, app, mail_org, sent_mail, imported_users):
+        with app.app_context():
+            from main import db
+            from application.email_utils import queue_onboarding_emails
+            from application.models import BulkUploadLog, OnboardingEmail, User
+            user = User.query.filter_by(import_log_id=imported_users).first()
+            queue_onboarding_emails(db.session.get(BulkUploadLog, imported_users))
+            user.must_change_password = False
+            db.session.commit()
+            user_id = user.id
+        assert self._send(app, 10) == (2, 0)
+        with app.app_context():
+            assert OnboardingEmail.query.filter_by(user_id=user_id).one().status == 'skipped'
+
+
+class TestOutboxAdmin:
+    def test_admin_sees_failures_and_can_retry(self, app, admin_client, mail_org):
+        row_id = _queue(app, _user_ticket(app), status='dead', attempts=6, last_error='SMTPAuthenticationError: 535')
+        r = admin_client.get('/email-outbox')
+        assert r.status_code == 200
+        assert b'SMTPAuthenticationError' in r.data
+
+        admin_client.post(f'/email-outbox/{row_id}/retry')
+        with app.app_context():
+            from main import db
+            from application.models import EmailOutbox
+            row = db.session.get(EmailOutbox, row_id)
+            assert (row.status, row.attempts) == ('pending', 0)
+
+    def test_regular_user_forbidden(self, user_client):
+        assert user_client.get('/email-outbox').status_code == 403
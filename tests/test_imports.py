@@ -0,0 +1,560 @@
+"""
+Bulk roster import tests: CSV upload, dry-run preview and applying a preview.
+"""
+import io
+
+import pytest
+
+USERS_HEADER = 'first_name,middle_name,last_name,email,role_id,site_name,rm_num,status\n'
+# The seeded regular user is always included so the deactivation pass leaves
+# it Active for the rest of the suite.
+REGULAR_ROW = 'Regular,,User,user@test.com,4,Main School,100,Active\n'
+
+
+def _users_csv(*rows):
+    return (USERS_HEADER + REGULAR_ROW + ''.join(rows)).encode('utf-8')
+
+
+def _find_user(app, email):
+    from application.models import User
+    from application.utils import hash_email
+    return User.query.filter_by(email_hash=hash_email(email, app.config['SECRET_KEY'])).first()
+
+
+def _upload(client, url, data, filename='users.csv'):
+    return client.post(url, data={
+        'csvFile': (io.BytesIO(data), filename),
+    }, content_type='multipart/form-data', follow_redirects=False)
+
+
+class TestBulkUpload:
+    def test_upload_adds_users(self, app, admin_client):
+        data = _users_csv('Ada,,Lovelace,ada@test.com,4,Main School,201,Active\n')
+        r = _upload(admin_client, '/bulk-upload-users', data)
+        assert r.status_code == 302
+
+        with app.app_context():
+            from application.models import BulkUploadLog
+            user = _find_user(app, 'ada@test.com')
+            assert user is not None
+            assert user.must_change_password is True
+            assert user.rm_num == '201'
+            # Linked to its import run for the onboarding mailer
+            assert user.import_log_id == BulkUploadLog.query.order_by(BulkUploadLog.id.desc()).first().id
+
+    def test_upload_rejects_unknown_site(self, app, admin_client):
+        data = _users_csv('Bad,,Site,badsite@test.com,4,Nowhere High,1,Active\n')
+        _upload(admin_client, '/bulk-upload-users', data)
+
+        with app.app_context():
+            from application.models import BulkUploadLog
+            assert _find_user(app, 'badsite@test.com') is None
+            log = BulkUploadLog.query.order_by(BulkUploadLog.id.desc()).first()
+            assert log.status == 'error'
+            assert 'Nowhere High' in log.error_message
+
+
+class TestRowDelta:
+    def _last_log(self):
+        from application.models import BulkUploadLog
+        return BulkUploadLog.query.order_by(BulkUploadLog.id.desc()).first()
+
+    def test_reimport_counts_only_changed_rows(self, app, admin_client):
+        rows = ('Edsger,,Dijkstra,edsger@test.com,4,Main School,501,Active\n',
+                'Barbara,,Liskov,barbara@test.com,4,Main School,502,Active\n')
+        _upload(admin_client, '/bulk-upload-users', _users_csv(*rows))
+
+        _upload(admin_client, '/bulk-upload-users', _users_csv(*rows))
+        with app.app_context():
+            log = self._last_log()
+            assert (log.users_added, log.users_updated) == (0, 0)
+
+        _upload(admin_client, '/bulk-upload-users', _users_csv(
+            rows[0], 'Barbara,,Liskov,barbara@test.com,4,Main School,999,Active\n'))
+        with app.app_context():
+            log = self._last_log()
+            assert (log.users_added, log.users_updated) == (0, 1)
+            assert _find_user(app, 'barbara@test.com').rm_num == '999'
+            assert _find_user(app, 'edsger@test.com').rm_num == '501'
+
+    def test_blank_middle_name_matches_null(self, app):
+        with app.app_context():
+            from application.import_engine import plan_users, parse_csv
+            rows = parse_csv(_users_csv('Edsger,,Dijkstra,edsger@test.com,4,Main School,501,Active\n'))
+            plan = plan_users(rows, app.config['SECRET_KEY'])
+            # Stored middle_name is NULL; the CSV's empty column must not count as a change
+            assert _find_user(app, 'edsger@test.com').middle_name is None
+            assert plan.updated == []
+            assert plan.unchanged == 2
+
+    def test_site_reimport_skips_identical_rows(self, app):
+        with app.app_context():
+            from main import db
+            from application.import_engine import plan_sites, apply_site_plan, parse_csv
+            data = (b'site_name,site_acronyms,site_cds,site_code,site_address,site_type\n'
+                    b'Delta Campus,DC,1,003,3 Delta Rd,High\n')
+            apply_site_plan(plan_sites(parse_csv(data)))
+            db.session.commit()
+
+            plan = plan_sites(parse_csv(data))
+            assert (plan.added, plan.updated, plan.unchanged) == ([], [], 1)
+
+            plan = plan_sites(parse_csv(data.replace(b'3 Delta Rd', b'4 Delta Rd')))
+            assert apply_site_plan(plan) == (0, 1)
+            db.session.commit()
+            from application.models import Site
+            assert Site.query.filter_by(site_name='Delta Campus').one().site_address == '4 Delta Rd'
+
+
+class TestUpsert:
+    def _statements(self, app, func):
+        from sqlalchemy import event
+        from main import db
+        statements = []
+
+        def capture(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+        return statements
+
+    def test_batch_is_one_statement(self, app):
+        with app.app_context():
+            from main import db
+            from application.import_engine import plan_users, apply_user_plan, parse_csv
+            rows = parse_csv(_users_csv(
+                'Upsert,,One,upsert1@test.com,4,Main School,701,Active\n',
+                'Upsert,,Two,upsert2@test.com,4,Main School,702,Active\n',
+            ).replace(b'Main School,100', b'Main School,101'))
+            plan = plan_users(rows, app.config['SECRET_KEY'], deactivate=False)
+            statements = self._statements(app, lambda: apply_user_plan(plan))
+            db.session.commit()
+
+            writes = [s for s in statements if not s.lstrip().upper().startswith('SELECT')]
+            assert len(writes) == 1
+            assert 'ON CONFLICT' in writes[0].upper()
+            assert (len(plan.added), len(plan.updated)) == (2, 1)
+            assert _find_user(app, 'user@test.com').rm_num == '101'
+            assert _find_user(app, 'upsert2@test.com').must_change_password is True
+
+    def test_user_created_after_planning_is_updated(self, app):
+        with app.app_context():
+            from main import db
+            from application.import_engine import plan_users, apply_user_plan, parse_csv
+            from application.models import User
+            rows = parse_csv(_users_csv('Late,,Comer,latecomer@test.com,4,Main School,801,Active\n'))
+            plan = plan_users(rows, app.config['SECRET_KEY'], deactivate=False)
+
+            late = User(first_name='Late', last_name='Comer', status='Active', password='keep-me',
+                        role_id=4, site_id=1, rm_num='1')
+            late.email = 'latecomer@test.com'
+            db.session.add(late)
+            db.session.commit()
+
+            apply_user_plan(plan)
+            db.session.commit()
+            user = _find_user(app, 'latecomer@test.com')
+            assert user.rm_num == '801'
+            assert user.password == 'keep-me'
+            assert User.query.filter_by(email_hash=user.email_hash).count() == 1
+
+    def test_other_databases_look_keys_up_first(self, app, monkeypatch):
+        from application import import_engine
+        monkeypatch.setattr(import_engine, '_UPSERT_INSERTS', {})
+        placeholders = []
+        monkeypatch.setattr(import_engine, '_unused_password_hash', lambda: placeholders.append(1) or 'unused')
+        key = app.config['SECRET_KEY']
+        with app.app_context():
+            from main import db
+            from application.models import User
+            rows = import_engine.parse_csv(_users_csv(
+                'Portable,,One,portable1@test.com,4,Main School,901,Active\n'
+            ).replace(b'Main School,100', b'Main School,102'))
+            plan = import_engine.plan_users(rows, key, deactivate=False)
+            statements = self._statements(app, lambda: import_engine.apply_user_plan(plan))
+            db.session.commit()
+
+            assert not any('ON CONFLICT' in s.upper() for s in statements)
+            assert (len(plan.added), len(plan.updated)) == (1, 1)
+            assert _find_user(app, 'user@test.com').rm_num == '102'
+            assert _find_user(app, 'portable1@test.com').password != 'unused'
+            assert placeholders == []  # no changed user had to be inserted
+
+            # A changed user deleted since planning is inserted after all
+            rows = import_engine.parse_csv(_users_csv('Portable,,One,portable1@test.com,4,Main School,902,Active\n'))
+            plan = import_engine.plan_users(rows, key, deactivate=False)
+            User.query.filter_by(email_hash=_find_user(app, 'portable1@test.com').email_hash).delete()
+            db.session.commit()
+            import_engine.apply_user_plan(plan)
+            db.session.commit()
+            user = _find_user(app, 'portable1@test.com')
+            assert (user.rm_num, user.password, user.must_change_password) == ('902', 'unused', True)
+            assert placeholders == [1]
+
+
+class TestChunkedImport:
+    ROWS = tuple(f'Chunk,,User{n},chunk{n}@test.com,4,Main School,6{n:02d},Active\n' for n in range(5))
+
+    def test_upload_commits_in_chunks(self, app, admin_client, monkeypatch):
+        monkeypatch.setitem(app.config, 'IMPORT_CHUNK_SIZE', 2)
+        _upload(admin_client, '/bulk-upload-users', _users_csv(*self.ROWS))
+        with app.app_context():
+            from application.models import BulkUploadLog
+            log = BulkUploadLog.query.order_by(BulkUploadLog.id.desc()).first()
+            assert log.status == 'success'
+            assert log.checkpoint_row == log.total_records == 6
+            assert _find_user(app, 'chunk4@test.com') is not None
+
+    def test_interrupted_import_resumes_from_checkpoint(self, app, monkeypatch):
+        from application import import_engine
+        with app.app_context():
+            from main import db
+            from application.models import User, BulkUploadLog
+            key = app.config['SECRET_KEY']
+            absent = User(first_name='Not', last_name='InFile', status='Active', password='x',
+                          role_id=4, site_id=1)
+            absent.email = 'notinfile@test.com'
+            db.session.add(absent)
+            db.session.commit()
+
+            rows = import_engine.parse_csv(_users_csv(*(r.replace('chunk', 'resume') for r in self.ROWS)))
+            real_apply = import_engine.apply_user_plan
+            calls = []
+
+            def failing_apply(plan, log=None):
+                calls.append(plan.total)
+                if len(calls) == 2:
+                    raise RuntimeError('worker timeout')
+                return real_apply(plan, log)
+
+            monkeypatch.setattr(import_engine, 'apply_user_plan', failing_apply)
+            with pytest.raises(RuntimeError):
+                import_engine.import_users_chunked(rows, key, 'resume.csv', 'f' * 64, 2)
+
+            log = BulkUploadLog.query.filter_by(filename='resume.csv').one()
+            assert (log.status, log.checkpoint_row) == ('interrupted', 2)
+            assert _find_user(app, 'resume0@test.com') is not None
+            assert _find_user(app, 'resume1@test.com') is None
+            # Deactivation only runs once every chunk has committed
+            assert _find_user(app, 'notinfile@test.com').status == 'Active'
+
+            monkeypatch.setattr(import_engine, 'apply_user_plan', real_apply)
+            added, updated, deactivated = import_engine.import_users_chunked(rows, key, 'resume.csv', 'f' * 64, 2)
+            db.session.refresh(log)
+            assert BulkUploadLog.query.filter_by(filename='resume.csv').count() == 1
+            assert (log.status, log.checkpoint_row) == ('success', 6)
+            assert added == log.users_added == 5
+            assert deactivated >= 1
+            assert _find_user(app, 'notinfile@test.com').status == 'Inactive'
+
+    def test_running_import_is_not_taken_over(self, app):
+        from datetime import timedelta
+        from application import import_engine
+        with app.app_context():
+            from main import db
+            from application.models import BulkUploadLog, _utcnow
+            rows = import_engine.parse_csv(_users_csv(*(r.replace('chunk', 'live') for r in self.ROWS)))
+            live = BulkUploadLog(filename='live.csv', file_fingerprint='d' * 64, status='in_progress',
+                                 checkpoint_row=2, checkpoint_at=_utcnow(), users_added=2, users_updated=0)
+            db.session.add(live)
+            db.session.commit()
+
+            with pytest.raises(ValueError, match='already being imported'):
+                import_engine.import_users_chunked(rows, app.config['SECRET_KEY'], 'live.csv', 'd' * 64, 2)
+            db.session.refresh(live)
+            assert (live.status, live.checkpoint_row, live.users_added) == ('in_progress', 2, 2)
+            assert _find_user(app, 'live4@test.com') is None
+
+            # A run that stopped committing long ago is presumed dead and resumed
+            live.checkpoint_at = _utcnow() - timedelta(seconds=app.config['IMPORT_STALE_SECONDS'] + 1)
+            db.session.commit()
+            import_engine.import_users_chunked(rows, app.config['SECRET_KEY'], 'live.csv', 'd' * 64, 2)
+            db.session.refresh(live)
+            assert (live.status, live.checkpoint_row) == ('success', 6)
+            assert _find_user(app, 'live4@test.com') is not None
+
+    def test_invalid_file_commits_nothing(self, app):
+        with app.app_context():
+            from application.import_engine import import_users_chunked, parse_csv
+            from application.models import BulkUploadLog
+            rows = parse_csv(_users_csv('Bad,,Row,badchunk@test.com,4,Nowhere,1,Active\n'))
+            with pytest.raises(ValueError):
+                import_users_chunked(rows, app.config['SECRET_KEY'], 'bad.csv', 'e' * 64, 2)
+            log = BulkUploadLog.query.filter_by(filename='bad.csv').one()
+            assert (log.status, log.users_added, log.checkpoint_row) == ('error', 0, None)
+            assert 'Nowhere' in log.error_message
+            assert _find_user(app, 'badchunk@test.com') is None
+
+    def test_invalid_upload_leaves_error_log(self, app, admin_client, monkeypatch):
+        monkeypatch.setitem(app.config, 'IMPORT_CHUNK_SIZE', 2)
+        data = _users_csv('Bad,,Row,badupload@test.com,4,Nowhere,1,Active\n')
+        r = _upload(admin_client, '/bulk-upload-users', data)
+        assert b'interrupted' not in admin_client.get(r.headers['Location']).data
+        with app.app_context():
+            from application.models import BulkUploadLog
+            log = BulkUploadLog.query.order_by(BulkUploadLog.id.desc()).first()
+            assert log.status == 'error'
+            assert _find_user(app, 'badupload@test.com') is None
+
+
+class TestImportPreview:
+    def test_preview_does_not_write(self, app, admin_client):
+        data = _users_csv('Grace,,Hopper,grace@test.com,4,Main School,301,Active\n')
+        r = _upload(admin_client, '/bulk-upload-users/preview', data)
+        assert r.status_code == 302
+        assert 'preview=' in r.headers['Location']
+
+        with app.app_context():
+            assert _find_user(app, 'grace@test.com') is None
+
+        page = admin_client.get(r.headers['Location'])
+        assert b'Import Preview' in page.data
+
+    def test_preview_counts(self, app):
+        with app.app_context():
+            from application.import_engine import build_preview, parse_csv
+            rows = parse_csv(_users_csv(
+                'Alan,,Turing,alan@test.com,4,Main School,1,Active\n',
+                'No,,Site,nosite@test.com,4,Missing School,1,Active\n',
+            ))
+            preview = build_preview('x', 'upload', user_rows=rows, key=app.config['SECRET_KEY'])
+            assert len(preview.users.added) == 1
+            assert len(preview.users.updated) + preview.users.unchanged == 1  # the regular user
+            assert len(preview.users.invalid) == 1
+            assert 'Missing School' in preview.users.invalid[0]
+            assert not preview.is_valid
+
+    def test_preview_accepts_sites_from_same_upload(self, app):
+        with app.app_context():
+            from application.import_engine import build_preview, parse_csv
+            sites = parse_csv(
+                b'site_name,site_acronyms,site_cds,site_code,site_address,site_type\n'
+                b'North Campus,NC,1.23457E+13,002,1 North Rd,High\n'
+            )
+            users = parse_csv(_users_csv('Nora,,North,nora@test.com,4,North Campus,5,Active\n'))
+            preview = build_preview('y', 'upload', site_rows=sites, user_rows=users,
+                                    key=app.config['SECRET_KEY'])
+            assert preview.sites.added[0]['site_cds'] == '12345700000000'
+            assert preview.users.invalid == []
+
+    def test_apply_preview_writes_change_set(self, app, admin_client):
+        data = _users_csv('Katherine,,Johnson,katherine@test.com,4,Main School,401,Active\n')
+        r = _upload(admin_client, '/bulk-upload-users/preview', data)
+        preview_id = r.headers['Location'].split('preview=')[1].split('&')[0]
+
+        r = admin_client.post(f'/bulk-upload-users/apply/{preview_id}')
+        assert r.status_code == 302
+
+        with app.app_context():
+            assert _find_user(app, 'katherine@test.com') is not None
+
+        # A preview can only be applied once
+        admin_client.post(f'/bulk-upload-users/apply/{preview_id}')
+        with app.app_context():
+            from application.models import BulkUploadLog
+            assert BulkUploadLog.query.filter_by(filename='users.csv', status='success').count() >= 1
+
+    def test_concurrent_applies_write_once(self, app, admin_client, monkeypatch):
+        from application import import_engine, routes
+        from application.models import BulkUploadLog
+        data = _users_csv('Annie,,Easley,annie@test.com,4,Main School,402,Active\n')
+        r = _upload(admin_client, '/bulk-upload-users/preview', data, 'easley.csv')
+        preview_id = r.headers['Location'].split('preview=')[1].split('&')[0]
+        # Both submits loaded the preview before either discarded it
+        with app.app_context():
+            preview = import_engine.load_preview(preview_id)
+        monkeypatch.setattr(routes, 'load_preview', lambda digest: preview)
+
+        admin_client.post(f'/bulk-upload-users/apply/{preview_id}')
+        r = admin_client.post(f'/bulk-upload-users/apply/{preview_id}')
+        assert b'already being applied' in admin_client.get(r.headers['Location']).data
+        with app.app_context():
+            assert BulkUploadLog.query.filter_by(filename='easley.csv').count() == 1
+
+        # Previewing the same file again makes it applicable again
+        monkeypatch.undo()
+        r = _upload(admin_client, '/bulk-upload-users/preview', data, 'easley.csv')
+        admin_client.post(f'/bulk-upload-users/apply/{preview_id}')
+        with app.app_context():
+            assert BulkUploadLog.query.filter_by(filename='easley.csv').count() == 2
+
+    def test_read_only_transaction_blocks_writes(self, app):
+        with app.app_context():
+            from sqlalchemy.exc import OperationalError
+            from main import db
+            from application.import_engine import read_only_transaction
+            from application.models import Title
+            with pytest.raises(OperationalError):
+                with read_only_transaction():
+                    db.session.add(Title(title_name='Read Only Title'))
+                    db.session.flush()
+            assert Title.query.filter_by(title_name='Read Only Title').first() is None
+
+    def test_regular_user_cannot_preview(self, user_client):
+        r = _upload(user_client, '/bulk-upload-users/preview', _users_csv())
+        assert r.status_code == 403
+
+
+class FakeFTP:
+    """Minimal in-memory stand-in for ftplib.FTP serving a fixed set of files."""
+    files = {}    # path -> (bytes, mdtm)
+    retrieved = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def connect(self, host, port, timeout=None):
+        pass
+
+    def login(self, username, password):
+        pass
+
+    def voidcmd(self, cmd):
+        return '200 OK'
+
+    def size(self, path):
+        import ftplib
+        if path not in self.files:
+            raise ftplib.error_perm('550 No such file')
+        return len(self.files[path][0])
+
+    def sendcmd(self, cmd):
+        import ftplib
+        path = cmd.split(' ', 1)[1]
+        if path not in self.files:
+            raise ftplib.error_perm('550 No such file')
+        return f'213 {self.files[path][1]}'
+
+    def retrbinary(self, cmd, callback, blocksize=8192):
+        import ftplib
+        path = cmd.split(' ', 1)[1]
+        if path not in self.files:
+            raise ftplib.error_perm('550 No such file')
+        FakeFTP.retrieved.append(path)
+        data = self.files[path][0]
+        for start in range(0, len(data), blocksize):
+            callback(data[start:start + blocksize])
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TestScheduledFtpImport:
+    @pytest.fixture()
+    def ftp_org(self, app, monkeypatch):
+        import ftplib
+        monkeypatch.setattr(ftplib, 'FTP', FakeFTP)
+        FakeFTP.retrieved = []
+        with app.app_context():
+            from main import db
+            from application.models import Organization
+            from application.utils import encrypt_mail_password
+            key = app.config['SECRET_KEY']
+            org = db.session.get(Organization, 1)
+            org.ftp_host_enc = encrypt_mail_password('ftp.test', key)
+            org.ftp_username_enc = encrypt_mail_password('sis', key)
+            org.ftp_path = '/export'
+            org.ftp_schedule_enabled = True
+            org.ftp_users_fingerprint = org.ftp_sites_fingerprint = None
+            db.session.commit()
+        yield
+        with app.app_context():
+            from main import db
+            from application.models import Organization
+            org = db.session.get(Organization, 1)
+            org.ftp_host_enc = org.ftp_username_enc = org.ftp_path = None
+            org.ftp_schedule_enabled = False
+            db.session.commit()
+
+    def _last_log(self, app):
+        from application.models import BulkUploadLog
+        return BulkUploadLog.query.order_by(BulkUploadLog.id.desc()).first()
+
+    def test_unchanged_file_is_skipped(self, app, ftp_org):
+        from application.scheduled_jobs import run_org_ftp_schedule
+        FakeFTP.files = {
+            '/export/users.csv': (_users_csv('Mary,,Jackson,mary@test.com,4,Main School,7,Active\n'),
+                                  '20261001120000'),
+        }
+        run_org_ftp_schedule()
+        with app.app_context():
+            assert self._last_log(app).status == 'success'
+            assert _find_user(app, 'mary@test.com') is not None
+        assert FakeFTP.retrieved == ['/export/users.csv']
+
+        # Same SIZE/MDTM: no download at all
+        run_org_ftp_schedule()
+        with app.app_context():
+            assert self._last_log(app).status == 'unchanged'
+        assert FakeFTP.retrieved == ['/export/users.csv']
+
+    def test_same_content_new_timestamp_is_skipped(self, app, ftp_org):
+        from application.scheduled_jobs import run_org_ftp_schedule
+        data = _users_csv('Dorothy,,Vaughan,dorothy@test.com,4,Main School,8,Active\n')
+        FakeFTP.files = {'/export/users.csv': (data, '20261001120000')}
+        run_org_ftp_schedule()
+
+        FakeFTP.files = {'/export/users.csv': (data, '20261002120000')}
+        run_org_ftp_schedule()
+        with app.app_context():
+            from main import db
+            from application.models import Organization
+            assert self._last_log(app).status == 'unchanged'
+            assert '20261002120000' in db.session.get(Organization, 1).ftp_users_fingerprint
+        assert len(FakeFTP.retrieved) == 2
+
+    def test_manual_import_from_saved_server_is_remembered(self, app, admin_client, ftp_org):
+        from application.scheduled_jobs import run_org_ftp_schedule
+        FakeFTP.files = {'/export/users.csv': (_users_csv(), '20261001120000')}
+        admin_client.post('/ftp-upload-users', data={'ftp_path': '/export/'})
+        run_org_ftp_schedule()
+        with app.app_context():
+            assert self._last_log(app).status == 'unchanged'
+        assert FakeFTP.retrieved == ['/export/users.csv']
+
+    def test_manual_import_from_another_server_is_not_remembered(self, app, admin_client, ftp_org):
+        from application.scheduled_jobs import run_org_ftp_schedule
+        FakeFTP.files = {'/export/users.csv': (_users_csv(), '20261001120000')}
+        run_org_ftp_schedule()
+
+        # Same path and file on another host: the saved server's file must still be fetched next time
+        admin_client.post('/ftp-upload-users', data={'ftp_host': 'other.test', 'ftp_username': 'sis',
+                                                     'ftp_path': '/export'})
+        run_org_ftp_schedule()
+        with app.app_context():
+            assert self._last_log(app).status == 'success'
+        assert len(FakeFTP.retrieved) == 3
+
+    def test_moving_the_saved_folder_forgets_fingerprints(self, app, admin_client, ftp_org):
+        from main import db
+        from application.models import Organization
+        from application.scheduled_jobs import run_org_ftp_schedule
+        FakeFTP.files = {'/export/users.csv': (_users_csv(), '20261001120000')}
+        run_org_ftp_schedule()
+
+        admin_client.post('/ftp-settings/save', data={'ftp_path': '/export'})
+        with app.app_context():
+            db.session.expire_all()
+            assert db.session.get(Organization, 1).ftp_users_fingerprint is not None
+        admin_client.post('/ftp-settings/save', data={'ftp_path': '/nightly'})
+        with app.app_context():
+            db.session.expire_all()
+            assert db.session.get(Organization, 1).ftp_users_fingerprint is None
+
+    def test_changed_file_is_imported(self, app, ftp_org):
+        from application.scheduled_jobs import run_org_ftp_schedule
+        FakeFTP.files = {'/export/users.csv': (_users_csv(), '20261001120000')}
+        run_org_ftp_schedule()
+
+        FakeFTP.files = {'/export/users.csv': (
+            _users_csv('Mae,,Jemison,mae@test.com,4,Main School,9,Active\n'), '20261003120000')}
+        run_org_ftp_schedule()
+        with app.app_context():
+            assert self._last_log(app).status == 'success'
+            assert _find_user(app, 'mae@test.com') is not None
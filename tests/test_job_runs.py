@@ -0,0 +1,229 @@
+"""
+Scheduled job run history and the database job store.
+"""
+import pytest
+
+
+@pytest.fixture()
+def no_runs(app):
+    with app.app_context():
+        from main import db
+        from application.models import JobRun
+        JobRun.query.delete()
+        db.session.commit()
+    yield
+    with app.app_context():
+        from main import db
+        from application.models import JobRun
+        JobRun.query.delete()
+        db.session.commit()
+
+
+def _runs(app, job_id):
+    with app.app_context():
+        from application.models import JobRun
+        return [
+            (r.outcome, r.rows_processed, r.error_message, r.duration_seconds, r.peak_memory_kb, r.finished_at)
+            for r in JobRun.query.filter_by(job_id=job_id).order_by(JobRun.id).all()
+        ]
+
+
+class TestTrackRun:
+    def test_successful_run_is_recorded(self, app, no_runs):
+        from application.job_runs import track_run
+        with app.app_context():
+            with track_run('test_job') as run:
+                run.rows_processed = 42
+        [(outcome, rows, error, duration, peak_kb, finished_at)] = _runs(app, 'test_job')
+        assert (outcome, rows, error) == ('success', 42, None)
+        assert duration is not None and finished_at is not None
+        assert peak_kb is not None and peak_kb >= 0  # peak RSS growth
+
+    def test_long_jobs_trace_memory_when_enabled(self, app, no_runs, monkeypatch):
+        import tracemalloc
+        from application.job_runs import track_run
+        monkeypatch.setitem(app.config, 'JOB_RUN_TRACK_MEMORY', True)
+        with app.app_context():
+            with track_run('test_job'):
+                assert not tracemalloc.is_tracing()  # cheap jobs never trace
+            with track_run('test_job', trace_memory=True):
+                buffer = bytearray(256 * 1024)  # noqa: F841 - shows up in the peak
+        assert _runs(app, 'test_job')[1][4] >= 256
+        assert not tracemalloc.is_tracing()
+
+    def test_memory_tracing_is_off_by_default(self, app, no_runs):
+        import tracemalloc
+        from application.job_runs import track_run
+        assert not app.config['JOB_RUN_TRACK_MEMORY']
+        with app.app_context():
+            with track_run('test_job', trace_memory=True):
+                assert not tracemalloc.is_tracing()
+
+    def test_run_is_visible_while_in_progress(self, app, no_runs):
+        from application.job_runs import track_run
+        with app.app_context():
+            with track_run('test_job'):
+                assert _runs(app, 'test_job')[0][0] == 'running'
+
+    def test_exception_is_recorded_and_reraised(self, app, no_runs):
+        from application.job_runs import track_run
+        with app.app_context():
+            with pytest.raises(RuntimeError):
+                with track_run('test_job'):
+                    raise RuntimeError('FTP server unreachable')
+        [(outcome, _, error, *_)] = _runs(app, 'test_job')
+        assert (outcome, error) == ('error', 'FTP server unreachable')
+
+    def test_idle_runs_of_frequent_jobs_are_not_recorded(self, app, no_runs):
+        from application.job_runs import track_run
+        with app.app_context():
+            with track_run('frequent_job', record_idle=False) as run:
+                run.rows_processed = 0
+            with track_run('frequent_job', record_idle=False) as run:
+                run.rows_processed = 3
+        assert [r[:2] for r in _runs(app, 'frequent_job')] == [('success', 3)]
+
+    def test_old_runs_are_purged(self, app, no_runs):
+        from datetime import timedelta
+        from application.job_runs import purge_job_runs
+        with app.app_context():
+            from main import db
+            from application.models import JobRun, _utcnow
+            db.session.add(JobRun(job_id='old_job', outcome='success', started_at=_utcnow() - timedelta(days=365)))
+            db.session.add(JobRun(job_id='old_job', outcome='success', started_at=_utcnow()))
+            db.session.commit()
+            assert purge_job_runs() == 1
+        assert len(_runs(app, 'old_job')) == 1
+
+    def test_scheduled_job_records_its_run(self, app, no_runs, monkeypatch):
+        import application.attachments
+        from application.scheduled_jobs import run_attachment_orphan_scan
+        monkeypatch.setattr(application.attachments, 'reclaim_orphaned_files', lambda: (2, 2048))
+        run_attachment_orphan_scan()
+        assert [r[:2] for r in _runs(app, 'attachment_orphan_scan')] == [('success', 2)]
+
+    def test_handled_job_failure_is_recorded_as_error(self, app, no_runs, monkeypatch):
+        import application.attachments
+        from application.scheduled_jobs import run_attachment_orphan_scan
+
+        def boom():
+            raise OSError('disk gone')
+        monkeypatch.setattr(application.attachments, 'reclaim_orphaned_files', boom)
+        run_attachment_orphan_scan()
+        [(outcome, _, error, *_)] = _runs(app, 'attachment_orphan_scan')
+        assert (outcome, error) == ('error', 'disk gone')
+
+
+class TestDatabaseJobStore:
+    def test_job_round_trips_through_the_database(self, app):
+        """A job saved by one process is loaded, with its function, by another."""
+        from datetime import datetime, timezone
+        from apscheduler.job import Job
+        from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+        from apscheduler.schedulers.background import BackgroundScheduler
+        from apscheduler.triggers.cron import CronTrigger
+        from application.scheduled_jobs import run_org_ftp_schedule
+
+        with app.app_context():
+            from main import db
+            saving, loading = BackgroundScheduler(), BackgroundScheduler()
+            saver = SQLAlchemyJobStore(engine=db.engine)
+            saver.start(saving, 'default')  # creates apscheduler_jobs if missing
+            trigger = CronTrigger(hour=2)
+            saver.add_job(Job(saving, id='org_ftp_schedule', func=run_org_ftp_schedule, trigger=trigger,
+                              executor='default', args=(), kwargs={}, name='org_ftp_schedule',
+                              misfire_grace_time=3600, coalesce=True, max_instances=1,
+                              next_run_time=trigger.get_next_fire_time(None, datetime.now(timezone.utc))))
+
+            loader = SQLAlchemyJobStore(engine=db.engine)
+            loader.start(loading, 'default')
+            try:
+                job = loader.lookup_job('org_ftp_schedule')
+                assert job.func is run_org_ftp_schedule
+                assert job.misfire_grace_time == 3600
+            finally:
+                loader.remove_all_jobs()
+
+    def test_schedule_saved_without_running_scheduler_reaches_store(self, app, admin_client, monkeypatch):
+        """A worker that never starts its scheduler (autostart off) still updates the shared store."""
+        from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+        from apscheduler.schedulers.background import BackgroundScheduler
+        from main import db, scheduler
+
+        assert app.config['SCHEDULER_AUTOSTART'] == 'off' and not scheduler.running
+        with app.app_context():
+            store = SQLAlchemyJobStore(engine=db.engine)
+            store.start(BackgroundScheduler(), 'default')
+        monkeypatch.setitem(app.config, 'SCHEDULER_JOB_STORE', 'database')
+        monkeypatch.setitem(app.config, 'SCHEDULER_JOBSTORES', {'default': store})
+        form = {'ftp_schedule_enabled': 'on', 'ftp_schedule_time': '02:30', 'ftp_schedule_days': ['mon', 'wed']}
+        try:
+            admin_client.post('/ftp-settings/save', data=form)
+            with app.app_context():
+                job = store.lookup_job('org_ftp_schedule')
+                assert job is not None and job.next_run_time is not None
+                fields = {f.name: str(f) for f in job.trigger.fields}
+                assert (fields['hour'], fields['minute'], fields['day_of_week']) == ('2', '30', 'mon,wed')
+                assert scheduler.get_job('org_ftp_schedule') is None  # nothing left pending in memory
+
+            admin_client.post('/ftp-settings/save', data={})
+            with app.app_context():
+                assert store.lookup_job('org_ftp_schedule') is None
+        finally:
+            with app.app_context():
+                store.remove_all_jobs()
+
+
+class TestLeaderScheduler:
+    def test_scheduler_runs_only_while_leading(self, monkeypatch):
+        from apscheduler.schedulers.base import STATE_PAUSED, STATE_RUNNING
+        from application import scheduler_lock
+
+        class FakeScheduler:
+            state = STATE_PAUSED
+            woken = 0
+
+            def resume(self):
+                self.state = STATE_RUNNING
+
+            def pause(self):
+                self.state = STATE_PAUSED
+
+            @property
+            def scheduler(self):
+                return self
+
+            def wakeup(self):
+                self.woken += 1
+
+        fake = FakeScheduler()
+        monkeypatch.setattr(scheduler_lock, 'scheduler', fake)
+        scheduler_lock._sync_scheduler(False)
+        assert fake.state == STATE_PAUSED
+        scheduler_lock._sync_scheduler(True)
+        assert fake.state == STATE_RUNNING
+        scheduler_lock._sync_scheduler(True)
+        assert fake.woken == 1
+        scheduler_lock._sync_scheduler(False)
+        assert fake.state == STATE_PAUSED
+
+
+class TestJobHistoryPage:
+    def test_admin_sees_runs(self, app, admin_client, no_runs):
+        with app.app_context():
+            from main import db
+            from application.models import JobRun
+            db.session.add(JobRun(job_id='org_ftp_schedule', outcome='error', error_message='timed out',
+                                  duration_seconds=12.5, rows_processed=4000))
+            db.session.commit()
+        r = admin_client.get('/job-runs')
+        assert r.status_code == 200
+        assert b'org_ftp_schedule' in r.data
+        assert b'12.50 s' in r.data
+
+        r = admin_client.get('/job-runs?job=email_outbox')
+        assert r.status_code == 200
+        assert b'No runs recorded.' in r.data
+
+    def test_non_admin_is_refused(self, user_client):
+        assert user_client.get('/job-runs').status_code == 403
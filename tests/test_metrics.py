@@ -0,0 +1,74 @@
+"""
+/metrics: request, SQL, cache and job metrics, queue depth and access.
+Needs the optional 'metrics' extra (prometheus_client).
+"""
+import pytest
+
+pytest.importorskip('prometheus_client')
+
+
+def _value(name, **labels):
+    from application.metrics import _metrics
+    return _metrics['registry'].get_sample_value(name, labels) or 0
+
+
+class TestMetrics:
+    def test_request_latency_and_sql_per_request(self, app, admin_client):
+        count = _value('assistitk12_request_duration_seconds_count',
+                       endpoint='routes.tickets', method='GET', status='200')
+        queries = _value('assistitk12_request_sql_queries_sum', endpoint='routes.tickets')
+        assert admin_client.get('/tickets').status_code == 200
+        assert _value('assistitk12_request_duration_seconds_count',
+                      endpoint='routes.tickets', method='GET', status='200') == count + 1
+        assert _value('assistitk12_request_sql_queries_sum', endpoint='routes.tickets') > queries
+        assert _value('assistitk12_request_sql_duration_seconds_count', endpoint='routes.tickets') >= 1
+
+    def test_unknown_urls_share_one_label(self, client):
+        before = _value('assistitk12_request_duration_seconds_count',
+                        endpoint='unmatched', method='GET', status='404')
+        client.get('/no-such-page/1')
+        client.get('/no-such-page/2')
+        assert _value('assistitk12_request_duration_seconds_count',
+                      endpoint='unmatched', method='GET', status='404') == before + 2
+
+    def test_cache_hits_and_misses(self, app):
+        from main import cache
+        hits = _value('assistitk12_cache_requests_total', cache='import_preview', result='hit')
+        misses = _value('assistitk12_cache_requests_total', cache='import_preview', result='miss')
+        with app.app_context():
+            assert cache.get('import_preview:metrics-test') is None
+            cache.set('import_preview:metrics-test', 'plan')
+            assert cache.get('import_preview:metrics-test') == 'plan'
+            cache.delete('import_preview:metrics-test')
+        assert _value('assistitk12_cache_requests_total', cache='import_preview', result='hit') == hits + 1
+        assert _value('assistitk12_cache_requests_total', cache='import_preview', result='miss') == misses + 1
+
+    def test_job_durations(self, app):
+        from application.job_runs import track_run
+        before = _value('assistitk12_job_duration_seconds_count', job='metrics_job', outcome='success')
+        with app.app_context():
+            with track_run('metrics_job', record_idle=False):
+                pass
+        assert _value('assistitk12_job_duration_seconds_count', job='metrics_job', outcome='success') == before + 1
+
+    def test_scrape_includes_queue_depth(self, client):
+        r = client.get('/metrics')
+        assert r.status_code == 200
+        assert r.mimetype == 'text/plain'
+        body = r.get_data(as_text=True)
+        assert 'assistitk12_email_outbox_messages{status="pending"}' in body
+        assert 'assistitk12_background_tasks{status="queued"}' in body
+        assert 'assistitk12_request_duration_seconds_bucket' in body
+
+
+class TestMetricsAccess:
+    def test_remote_scrape_without_token_is_refused(self, client):
+        assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.9'}).status_code == 404
+
+    def test_token(self, app, client, monkeypatch):
+        monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'scrape-secret')
+        assert client.get('/metrics').status_code == 404
+        assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 404
+        r = client.get('/metrics', headers={'Authorization': 'Bearer scrape-secret'},
+                       environ_base={'REMOTE_ADDR': '203.0.113.9'})
+        assert r.status_code == 200
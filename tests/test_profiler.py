@@ -0,0 +1,100 @@
+"""
+On-demand request profiling: admin-only, rate limited, stored for download.
+"""
+import pstats
+
+import pytest
+
+
+@pytest.fixture()
+def no_profiles(app):
+    with app.app_context():
+        from main import db
+        from application.models import RequestProfile
+        RequestProfile.query.delete()
+        db.session.commit()
+    yield
+    with app.app_context():
+        from main import db
+        from application.models import RequestProfile
+        RequestProfile.query.delete()
+        db.session.commit()
+
+
+def _profiles(app):
+    with app.app_context():
+        from application.models import RequestProfile
+        return RequestProfile.query.order_by(RequestProfile.id).all()
+
+
+class TestProfiler:
+    def test_admin_profiles_a_request(self, app, admin_client, no_profiles, tmp_path):
+        r = admin_client.get('/tickets?status_filter=1-pending&_profile=1')
+        assert r.status_code == 200
+        profile_id = int(r.headers['X-Profile-Id'])
+
+        with app.app_context():
+            from application.models import RequestProfile
+            profile = RequestProfile.query.get(profile_id)
+            assert (profile.method, profile.endpoint, profile.status_code) == ('GET', 'routes.tickets', 200)
+            assert profile.path == '/tickets?status_filter=1-pending&_profile=1'
+            assert profile.sql_queries > 0
+            assert 'tickets' in profile.summary
+
+        r = admin_client.get(f'/profiles/{profile_id}/download')
+        assert r.status_code == 200
+        assert 'attachment' in r.headers['Content-Disposition']
+        path = tmp_path / 'tickets.prof'
+        path.write_bytes(r.data)
+        stats = pstats.Stats(str(path))
+        assert any(func[2] == 'tickets' for func in stats.stats)
+
+    def test_header_also_triggers(self, app, admin_client, no_profiles):
+        r = admin_client.get('/dashboard', headers={'X-Profile': '1'})
+        assert 'X-Profile-Id' in r.headers
+
+    def test_unflagged_requests_are_not_profiled(self, app, admin_client, no_profiles):
+        r = admin_client.get('/tickets')
+        assert 'X-Profile-Id' not in r.headers
+        assert _profiles(app) == []
+
+    def test_rate_limit(self, app, admin_client, no_profiles, monkeypatch):
+        from limits import parse
+        monkeypatch.setitem(app.extensions, 'profiler_rate_limit', parse('2 per day'))
+        assert 'X-Profile-Id' in admin_client.get('/tickets?_profile=1').headers
+        assert 'X-Profile-Id' in admin_client.get('/tickets?_profile=1').headers
+        r = admin_client.get('/tickets?_profile=1')
+        assert r.status_code == 200
+        assert 'X-Profile-Id' not in r.headers
+        assert r.headers['X-Profile'] == 'refused'
+
+    def test_malformed_rate_limit_fails_at_startup(self):
+        from flask import Flask
+        from application.profiler import init_profiler
+        app = Flask(__name__)
+        app.config.update(PROFILER_ENABLED=True, PROFILER_RATE_LIMIT='ten an hour')
+        with pytest.raises(ValueError):
+            init_profiler(app)
+
+    def test_only_the_newest_are_kept(self, app, admin_client, no_profiles, monkeypatch):
+        monkeypatch.setitem(app.config, 'PROFILER_KEEP', 2)
+        ids = [int(admin_client.get('/tickets?_profile=1').headers['X-Profile-Id']) for _ in range(3)]
+        assert [p.id for p in _profiles(app)] == ids[1:]
+
+    def test_admin_sees_profiles(self, app, admin_client, no_profiles):
+        admin_client.get('/tickets?_profile=1')
+        r = admin_client.get('/profiles')
+        assert r.status_code == 200
+        assert b'/tickets?_profile=1' in r.data
+
+
+class TestProfilerForNonAdmins:
+    def test_flag_is_ignored(self, app, user_client, no_profiles):
+        r = user_client.get('/tickets?_profile=1', headers={'X-Profile': '1'})
+        assert r.status_code == 200
+        assert 'X-Profile-Id' not in r.headers and 'X-Profile' not in r.headers
+        assert _profiles(app) == []
+
+    def test_pages_are_refused(self, user_client):
+        assert user_client.get('/profiles').status_code == 403
+        assert user_client.get('/profiles/1/download').status_code == 403
@@ -0,0 +1,60 @@
+"""
+Per-request SQL timing: the Server-Timing header, statement fingerprints
+and the SQL budget log.
+"""
+import logging
+from collections import Counter
+
+
+class TestServerTiming:
+    def test_header_reports_db_render_and_total(self, client):
+        r = client.get('/login')
+        timing = r.headers['Server-Timing']
+        assert timing.startswith('db;dur=')
+        assert 'queries"' in timing
+        assert ', render;dur=' in timing
+        assert ', total;dur=' in timing
+
+    def test_header_is_off_unless_enabled(self, app, client, monkeypatch):
+        monkeypatch.setitem(app.config, 'REQUEST_TIMING_ENABLED', False)
+        assert 'Server-Timing' not in client.get('/login').headers
+
+
+class TestFingerprint:
+    def test_in_lists_and_whitespace_are_folded(self):
+        from application.request_timing import fingerprint
+        assert fingerprint('SELECT * FROM ticket WHERE id IN (?, ?, ?)') == \
+            fingerprint('SELECT *\n  FROM ticket WHERE id IN (?)')
+        assert fingerprint('SELECT * FROM ticket WHERE id = ?')[0] != \
+            fingerprint('SELECT * FROM site WHERE id = ?')[0]
+
+    def test_repeated_statements_most_repeated_first(self):
+        from application.request_timing import repeated_statements
+        statements = Counter({
+            'SELECT * FROM user WHERE user.id = ?': 12,
+            'SELECT * FROM site WHERE site.id IN (?, ?)': 2,
+            'SELECT * FROM site WHERE site.id IN (?, ?, ?)': 1,
+            'SELECT count(*) FROM ticket': 1,
+        })
+        repeated = repeated_statements(statements)
+        assert [(count, statement) for _, count, statement in repeated] == [
+            (12, 'SELECT * FROM user WHERE user.id = ?'),
+            (3, 'SELECT * FROM site WHERE site.id IN (?)'),
+        ]
+
+
+class TestSqlBudget:
+    def test_request_over_budget_is_logged(self, app, admin_client, monkeypatch, caplog):
+        monkeypatch.setitem(app.config, 'SQL_QUERY_BUDGET', 1)
+        with caplog.at_level(logging.WARNING, logger='application.request_timing'):
+            admin_client.get('/tickets')
+        [record] = [r for r in caplog.records if r.name == 'application.request_timing']
+        assert 'SQL budget exceeded: GET /tickets (routes.tickets)' in record.getMessage()
+        assert 'budget 1 statements' in record.getMessage()
+
+    def test_request_within_budget_is_not_logged(self, app, admin_client, monkeypatch, caplog):
+        monkeypatch.setitem(app.config, 'SQL_QUERY_BUDGET', 1000)
+        monkeypatch.setitem(app.config, 'SQL_TIME_BUDGET_MS', 0)
+        with caplog.at_level(logging.WARNING, logger='application.request_timing'):
+            admin_client.get('/tickets')
+        assert not [r for r in caplog.records if r.name == 'application.request_timing']
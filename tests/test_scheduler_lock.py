@@ -0,0 +1,98 @@
+"""
+Scheduler lease tests: one process at a time holds the scheduler_lock row
+and runs the scheduled jobs; the others take over once it expires.
+"""
+from datetime import timedelta
+
+import pytest
+
+
+@pytest.fixture()
+def lease(app):
+    """Locking turned on with a 60 s lease, and no lease row to start from."""
+    from application import scheduler_lock
+    app.config['SCHEDULER_LEASE_SECONDS'] = 60
+    with app.app_context():
+        from main import db
+        from application.models import SchedulerLock
+        SchedulerLock.query.delete()
+        db.session.commit()
+        yield scheduler_lock
+        SchedulerLock.query.delete()
+        db.session.commit()
+    app.config['SCHEDULER_LEASE_SECONDS'] = 0
+    scheduler_lock._lease['expires_at'] = None
+
+
+def _held_by_other(expires_in):
+    from main import db
+    from application.models import SchedulerLock, _utcnow
+    now = _utcnow()
+    db.session.add(SchedulerLock(name='scheduler', holder='other-host:1:abcd', acquired_at=now,
+                                 heartbeat_at=now, expires_at=now + timedelta(seconds=expires_in)))
+    db.session.commit()
+
+
+class TestSchedulerLease:
+    def test_first_heartbeat_takes_the_lease(self, lease):
+        assert lease.heartbeat() is True
+        assert lease.is_leader()
+        row = lease.current_lease()
+        assert row.holder == lease.holder_id()
+        assert row.expires_at > row.heartbeat_at
+
+    def test_heartbeat_renews_without_resetting_acquired_at(self, lease):
+        from main import db
+        lease.heartbeat()
+        first = lease.current_lease()
+        acquired_at, expires_at = first.acquired_at, first.expires_at
+        db.session.expire_all()
+
+        assert lease.heartbeat() is True
+        row = lease.current_lease()
+        assert row.acquired_at == acquired_at
+        assert row.expires_at >= expires_at
+
+    def test_live_lease_of_another_process_is_respected(self, lease):
+        _held_by_other(expires_in=60)
+        assert lease.heartbeat() is False
+        assert not lease.is_leader()
+        assert lease.current_lease().holder == 'other-host:1:abcd'
+
+    def test_expired_lease_fails_over(self, lease):
+        _held_by_other(expires_in=-1)
+        assert lease.heartbeat() is True
+        assert lease.is_leader()
+        assert lease.current_lease().holder == lease.holder_id()
+
+    def test_release_lets_another_process_take_over(self, lease):
+        from main import db
+        from application.models import _utcnow
+        lease.heartbeat()
+        lease.release()
+        assert not lease.is_leader()
+        db.session.expire_all()
+        assert lease.current_lease().expires_at <= _utcnow()
+
+    def test_leader_only_skips_jobs_without_the_lease(self, lease):
+        calls = []
+        job = lease.leader_only(lambda: calls.append(1) or 'ran')
+
+        _held_by_other(expires_in=60)
+        lease.heartbeat()
+        assert job() is None
+        assert calls == []
+
+    def test_leader_only_runs_jobs_for_the_holder(self, lease):
+        calls = []
+        job = lease.leader_only(lambda: calls.append(1) or 'ran')
+
+        lease.heartbeat()
+        assert job() == 'ran'
+        assert calls == [1]
+
+    def test_disabled_lock_runs_everywhere(self, app, lease):
+        app.config['SCHEDULER_LEASE_SECONDS'] = 0
+        _held_by_other(expires_in=60)
+        assert lease.heartbeat() is True
+        assert lease.is_leader()
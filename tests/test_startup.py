@@ -0,0 +1,29 @@
+"""
+App factory tests: database and filesystem work waits for the first request,
+and the scheduler only starts where SCHEDULER_AUTOSTART says so.
+"""
+
+
+class TestLazyStartup:
+    def test_scheduler_is_not_started_when_autostart_is_off(self, app):
+        from main import scheduler
+        assert app.config['SCHEDULER_AUTOSTART'] == 'off'
+        assert not scheduler.running
+
+    def test_first_request_finishes_startup(self, app, client):
+        client.get('/login')
+        assert app.extensions['startup_finished'] is True
+        deferred = [phase for phase, _, is_deferred in app.extensions['startup_timings'] if is_deferred]
+        assert 'organization settings' in deferred
+        assert 'scheduler' not in deferred
+
+    def test_dummy_password_hash_is_computed_once(self):
+        from application.routes import _dummy_password_hash
+        assert _dummy_password_hash() is _dummy_password_hash()
+
+    def test_startup_report(self, app):
+        result = app.test_cli_runner().invoke(args=['startup-report'])
+        assert result.exit_code == 0
+        assert 'At startup (create_app):' in result.output
+        assert 'login timing-safe hash' in result.output
+        assert 'Kept off startup:' in result.output
@@ -0,0 +1,235 @@
+"""
+Background tasks: the runner, progress and cancellation, the concurrency
+limit, recovery from a dead runner, retention and the status API.
+"""
+import csv
+import io
+import json
+from datetime import timedelta
+
+import pytest
+
+
+@pytest.fixture()
+def no_tasks(app):
+    with app.app_context():
+        from main import db
+        from application.models import Task
+        Task.query.delete()
+        db.session.commit()
+    yield
+    with app.app_context():
+        from main import db
+        from application.models import Task
+        Task.query.delete()
+        db.session.commit()
+
+
+def _task(app, task_id):
+    with app.app_context():
+        from application.models import Task
+        from application.tasks import task_status
+        return task_status(Task.query.get(task_id))
+
+
+def _enqueue(app, kind, params=None, user_email=None):
+    with app.app_context():
+        from application.models import User
+        from application.tasks import enqueue
+        from application.utils import hash_email
+        user_id = None
+        if user_email:
+            user_id = User.query.filter_by(email_hash=hash_email(user_email, app.config['SECRET_KEY'])).first().id
+        return enqueue(kind, params, user_id=user_id).id
+
+
+def _run(app):
+    with app.app_context():
+        from application.tasks import run_queued_tasks
+        return run_queued_tasks(wait=True)
+
+
+class TestRunner:
+    def test_ticket_export(self, app, no_tasks):
+        with app.app_context():
+            from main import db
+            from application.models import Ticket, Title
+            title = Title.query.first() or Title(title_name='Export Title')
+            db.session.add(Ticket(title=title, tck_status='1-pending', user_id=1, site_id=1))
+            db.session.commit()
+            expected = Ticket.query.filter_by(tck_status='1-pending').count()
+
+        task_id = _enqueue(app, 'export_tickets', {'status': '1-pending'})
+        assert _task(app, task_id)['status'] == 'queued'
+        assert _run(app) == 1
+
+        status = _task(app, task_id)
+        assert status['status'] == 'succeeded'
+        assert status['result'] == {'tickets': expected}
+        assert status['progress']['percent'] == 100
+        assert status['result_filename'].endswith('.csv')
+        with app.app_context():
+            from application.models import Task
+            rows = list(csv.reader(io.StringIO(Task.query.get(task_id).result_file.decode('utf-8'))))
+        assert rows[0][0] == 'Ticket #'
+        assert len(rows) == expected + 1
+        assert {row[2] for row in rows[1:]} == {'1-pending'}
+
+    def test_failure_is_recorded(self, app, no_tasks, monkeypatch):
+        from application import tasks
+
+        def broken(ctx):
+            raise RuntimeError('disk full')
+        monkeypatch.setitem(tasks.TASKS, 'broken', (broken, 'Broken'))
+        task_id = _enqueue(app, 'broken')
+        _run(app)
+        status = _task(app, task_id)
+        assert (status['status'], status['error'], status['finished']) == ('failed', 'disk full', True)
+
+    def test_running_task_stops_when_cancelled(self, app, no_tasks, monkeypatch):
+        from application import tasks
+
+        def slow(ctx):
+            # Cancelled from the page while the task is running
+            tasks._set(ctx.task_id, cancel_requested=True)
+            ctx.progress(1, 10, 'working')
+            return 'not reached'
+        monkeypatch.setitem(tasks.TASKS, 'slow', (slow, 'Slow'))
+        task_id = _enqueue(app, 'slow')
+        _run(app)
+        status = _task(app, task_id)
+        assert status['status'] == 'cancelled'
+        assert status['progress']['message'] == 'working'
+        assert status['result'] is None
+
+    def test_queued_task_is_cancelled_immediately(self, app, no_tasks):
+        task_id = _enqueue(app, 'export_tickets')
+        with app.app_context():
+            from application.models import Task
+            from application.tasks import cancel
+            cancel(Task.query.get(task_id))
+        assert _task(app, task_id)['status'] == 'cancelled'
+        assert _run(app) == 0
+
+    def test_concurrency_limit(self, app, no_tasks, monkeypatch):
+        monkeypatch.setitem(app.config, 'TASK_MAX_CONCURRENCY', 1)
+        with app.app_context():
+            from main import db
+            from application.models import Task, _utcnow
+            db.session.add(Task(kind='export_tickets', status='running', heartbeat_at=_utcnow()))
+            db.session.commit()
+        task_id = _enqueue(app, 'export_tickets')
+        assert _run(app) == 0
+        assert _task(app, task_id)['status'] == 'queued'
+
+    def test_task_of_dead_runner_is_failed(self, app, no_tasks):
+        with app.app_context():
+            from main import db
+            from application.models import Task, _utcnow
+            task = Task(kind='export_tickets', status='running', heartbeat_at=_utcnow() - timedelta(hours=1))
+            db.session.add(task)
+            db.session.commit()
+            task_id = task.id
+        _run(app)
+        status = _task(app, task_id)
+        assert status['status'] == 'failed'
+        assert 'stopped' in status['error']
+
+    def test_running_task_is_heartbeated_after_a_lease_handover(self, app, no_tasks, monkeypatch):
+        import threading
+        import time
+        from application import tasks
+        monkeypatch.setitem(app.config, 'TASK_STALE_SECONDS', 0.4)
+        release = threading.Event()
+
+        def long_export(ctx):
+            release.wait(5)
+            return 'done'
+        monkeypatch.setitem(tasks.TASKS, 'long_export', (long_export, 'Long export'))
+        task_id = _enqueue(app, 'long_export')
+        with app.app_context():
+            assert tasks.run_queued_tasks() == 1
+            from application.models import Task
+            started_at = Task.query.get(task_id).started_at
+
+        # The runner job has moved to another process and never runs here
+        # again, yet this process keeps the task alive...
+        time.sleep(0.6)
+        with app.app_context():
+            from main import db
+            from application.models import Task
+            assert Task.query.get(task_id).heartbeat_at > started_at
+            stale_before = tasks._utcnow() - timedelta(seconds=0.4)
+            assert Task.query.filter(Task.id == task_id, Task.heartbeat_at < stale_before).count() == 0
+            db.session.rollback()
+
+        # ...and records its result when it finishes
+        release.set()
+        for _ in range(50):
+            if _task(app, task_id)['finished']:
+                break
+            time.sleep(0.1)
+        assert _task(app, task_id)['status'] == 'succeeded'
+
+    def test_old_finished_tasks_are_purged(self, app, no_tasks):
+        with app.app_context():
+            from main import db
+            from application.models import Task, _utcnow
+            from application.tasks import purge_finished_tasks
+            db.session.add(Task(kind='export_tickets', status='succeeded', finished_at=_utcnow() - timedelta(days=30)))
+            db.session.add(Task(kind='export_tickets', status='succeeded', finished_at=_utcnow()))
+            db.session.commit()
+            assert purge_finished_tasks() == 1
+            assert Task.query.count() == 1
+
+    def test_unknown_kind_is_refused(self, app):
+        with app.app_context():
+            from application.tasks import enqueue
+            with pytest.raises(ValueError):
+                enqueue('no_such_task')
+
+
+class TestTaskPages:
+    def test_export_is_queued_polled_and_downloaded(self, app, admin_client, no_tasks):
+        r = admin_client.post('/tasks/export-tickets', data={'status_filter': '1-pending', 'site_filter': '1'})
+        assert r.status_code == 302 and r.location.endswith('/tasks')
+        with app.app_context():
+            from application.models import Task
+            task = Task.query.one()
+            task_id = task.id
+            assert json.loads(task.params) == {'status': '1-pending', 'site_id': 1}
+
+        assert admin_client.get('/tasks').status_code == 200
+        assert admin_client.get(f'/tasks/{task_id}').get_json()['status'] == 'queued'
+        assert admin_client.get(f'/tasks/{task_id}/download').status_code == 404
+
+        _run(app)
+        # The client's requests share this test's session; don't let them
+        # answer from the Task loaded by the earlier poll
+        from main import db
+        db.session.expire_all()
+        data = admin_client.get(f'/tasks/{task_id}').get_json()
+        assert data['finished'] and data['status'] == 'succeeded'
+        r = admin_client.get(f'/tasks/{task_id}/download')
+        assert r.status_code == 200
+        assert 'attachment' in r.headers['Content-Disposition']
+        assert r.data.startswith(b'Ticket #')
+
+    def test_cancel_from_page(self, app, admin_client, no_tasks):
+        task_id = _enqueue(app, 'export_tickets')
+        r = admin_client.post(f'/tasks/{task_id}/cancel')
+        assert r.status_code == 302
+        assert _task(app, task_id)['status'] == 'cancelled'
+
+    def test_non_admin_cannot_export_or_list(self, user_client):
+        assert user_client.post('/tasks/export-tickets').status_code == 403
+        assert user_client.get('/tasks').status_code == 403
+
+    def test_other_users_task_is_hidden(self, app, user_client, no_tasks):
+        task_id = _enqueue(app, 'export_tickets', user_email='admin@test.com')
+        assert user_client.get(f'/tasks/{task_id}').status_code == 404
+        assert user_client.post(f'/tasks/{task_id}/cancel').status_code == 404
+
+    def test_creator_can_poll_their_task(self, app, user_client, no_tasks):
+        task_id = _enqueue(app, 'export_tickets', user_email='user@test.com')
+        assert user_client.get(f'/tasks/{task_id}').get_json()['id'] == task_id